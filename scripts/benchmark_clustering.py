@@ -0,0 +1,146 @@
+"""
+Benchmark the clustering on the daily news exports in data/.
+
+It compares the previous implementation, where the silhouette of every threshold recomputed the
+pairwise distances, with the single distance matrix one in HierarchicalClusterModeler and with the
+two stage one in TwoStageClusterModeler, which does not hold a distance matrix of all the documents.
+
+The embeddings come from the local embedding model when it is in models/, otherwise from a
+TF-IDF + SVD projection of the articles, which is enough to time the clustering.
+
+python scripts/benchmark_clustering.py --scales 1 10
+python scripts/benchmark_clustering.py --scales 1 10 30 100 --implementations shared_matrix two_stage
+"""
+
+import json
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+from scipy.cluster.hierarchy import fcluster, linkage
+from scipy.spatial.distance import squareform
+from sklearn.decomposition import TruncatedSVD
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.metrics import silhouette_score
+
+from src.shared.logger import setup_logger
+from src.summarizer.cluster_modeler import HierarchicalClusterModeler
+from src.summarizer.data_puller import load_news_snapshot
+from src.summarizer.scalable_cluster_modeler import TwoStageClusterModeler
+
+logger = setup_logger("benchmark_clustering")
+
+
+def compute_embeddings(documents: list, embedding_model_id: str) -> np.array:
+	"""Embed with the local model if it is there, else with a TF-IDF + SVD projection"""
+	if Path.cwd().joinpath("models", embedding_model_id).exists():
+		from src.summarizer.embeddings_computer import EmbeddingsComputer
+
+		return EmbeddingsComputer(embedding_model_id=embedding_model_id).run(documents)
+	logger.info("embedding model not found, using a TF-IDF + SVD projection")
+	tfidf = TfidfVectorizer(max_features=20000, sublinear_tf=True).fit_transform(documents)
+	n_components = min(256, tfidf.shape[0] - 1, tfidf.shape[1] - 1)
+	return TruncatedSVD(n_components=n_components, random_state=42).fit_transform(tfidf)
+
+
+def scale_embeddings(embeddings: np.array, scale: int, seed: int = 42) -> np.array:
+	"""Repeat the embeddings scale times with a small noise so the copies are not identical"""
+	if scale == 1:
+		return embeddings
+	generator = np.random.default_rng(seed)
+	repeated = np.tile(embeddings, (scale, 1))
+	noise = generator.normal(scale=0.05 * embeddings.std(), size=repeated.shape)
+	return (repeated + noise).astype(np.float32)
+
+
+def legacy_clustering(embeddings: np.array) -> np.array:
+	"""The clustering before the shared distance matrix, kept here as the baseline"""
+	mergings = linkage(embeddings, method="complete", metric="cosine")
+	max_shilouette = float("-inf")
+	return_labels = np.zeros(embeddings.shape[0])
+	for k in np.arange(0.1, 0.4, 0.01):
+		labels = fcluster(mergings, k, criterion="distance")
+		if np.unique(labels).shape[0] < 2 or np.unique(labels).shape[0] >= embeddings.shape[0] - 1:
+			continue
+		score = silhouette_score(embeddings, labels)
+		if score > max_shilouette:
+			max_shilouette = score
+			return_labels = labels
+	return return_labels
+
+
+def shared_matrix_clustering(embeddings: np.array) -> np.array:
+	cluster_modeler = HierarchicalClusterModeler()
+	distance_matrix = cluster_modeler.compute_distance_matrix(embeddings)
+	mergings = cluster_modeler.compute_linkage(squareform(distance_matrix, checks=False))
+	labels, _ = cluster_modeler.select_best_distance(distance_matrix, mergings)
+	return labels
+
+
+def two_stage_clustering(embeddings: np.array) -> np.array:
+	labels, _ = TwoStageClusterModeler().compute_labels(embeddings)
+	return labels
+
+
+IMPLEMENTATIONS = {
+	"legacy": legacy_clustering,
+	"shared_matrix": shared_matrix_clustering,
+	"two_stage": two_stage_clustering,
+}
+
+
+def measure(function, embeddings: np.array) -> dict:
+	"""Return the wall time in seconds and the peak traced memory in MB of one call"""
+	tracemalloc.start()
+	start = time.perf_counter()
+	labels = function(embeddings)
+	elapsed = time.perf_counter() - start
+	_, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	return {
+		"seconds": elapsed,
+		"peak_mb": peak / 1024**2,
+		"number_of_clusters": int(np.unique(labels).shape[0]),
+	}
+
+
+if __name__ == "__main__":
+	parser = ArgumentParser()
+	parser.add_argument("--data_dir", default="data")
+	parser.add_argument("--scales", type=int, nargs="+", default=[1, 10])
+	parser.add_argument("--embedding_model_id", default="dunzhang/stella_en_400M_v5")
+	parser.add_argument(
+		"--implementations",
+		nargs="+",
+		choices=list(IMPLEMENTATIONS),
+		default=["legacy", "shared_matrix"],
+	)
+	parser.add_argument("--output", default=None, help="optional json file for the results")
+	args = parser.parse_args()
+
+	results = []
+	for snapshot_path in sorted(Path(args.data_dir).glob("*.csv")):
+		news_df = load_news_snapshot(snapshot_path)
+		embeddings = compute_embeddings(news_df["content"].tolist(), args.embedding_model_id)
+		for scale in args.scales:
+			scaled_embeddings = scale_embeddings(embeddings, scale)
+			for name in args.implementations:
+				function = IMPLEMENTATIONS[name]
+				result = {
+					"snapshot": snapshot_path.name,
+					"scale": scale,
+					"documents": scaled_embeddings.shape[0],
+					"implementation": name,
+					**measure(function, scaled_embeddings),
+				}
+				logger.info(
+					f"{result['snapshot']} x{scale} ({result['documents']} documents) {name}: "
+					f"{result['seconds']:.3f}s, peak {result['peak_mb']:.1f} MB, "
+					f"{result['number_of_clusters']} clusters"
+				)
+				results.append(result)
+	if args.output:
+		with open(args.output, "w") as output_file:
+			json.dump(results, output_file, indent=4)
@@ -0,0 +1,122 @@
+"""
+Time the pull of the articles of a day from the database with the previous and the current queries.
+
+- cast: the former query, posted_at::date BETWEEN the date and CURRENT_DATE, fetched with execute_query
+- range: the half open range on posted_at, fetched with execute_query, what read_data does
+- copy: the half open range exported with COPY ... TO STDOUT and parsed by pandas
+
+Each path is timed --repeats times on a connection of the pool, the peak memory comes from one more run
+traced with tracemalloc. The plans of the cast and range queries are logged, a sargable range shows an
+index scan on posted_at when the table has the index. It needs the credentials of .env_<environment>.
+
+python scripts/benchmark_data_pull.py -e dev -d 7 --output benchmarks/data_pull.json
+"""
+
+import json
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, Dict
+
+import numpy as np
+import pandas as pd
+
+from src.shared.database import (
+	close_connection_pools,
+	copy_query_to_dataframe,
+	execute_query,
+	pooled_connection,
+)
+from src.shared.logger import setup_logger
+from src.summarizer.data_puller import (
+	ARTICLE_COLUMNS,
+	ARTICLE_CSV_OPTIONS,
+	ARTICLE_RANGE_QUERY,
+	DataPuller,
+)
+
+logger = setup_logger("benchmark_data_pull")
+
+ARTICLE_CAST_QUERY = "SELECT id AS database_id, content, title, posted_at, url, website_origin FROM article WHERE posted_at::date BETWEEN %(start)s AND CURRENT_DATE"
+
+
+def make_paths(date_range: Dict) -> Dict[str, tuple[str, Callable]]:
+	"""The query of every path and the function reading it to a dataframe"""
+
+	def fetch(connection, query: str) -> pd.DataFrame:
+		return pd.DataFrame(execute_query(connection, query, date_range), columns=ARTICLE_COLUMNS)
+
+	def copy(connection, query: str) -> pd.DataFrame:
+		return copy_query_to_dataframe(connection, query, date_range, **ARTICLE_CSV_OPTIONS)
+
+	return {
+		"cast": (ARTICLE_CAST_QUERY, fetch),
+		"range": (ARTICLE_RANGE_QUERY, fetch),
+		"copy": (ARTICLE_RANGE_QUERY, copy),
+	}
+
+
+def explain(connection, query: str, date_range: Dict) -> str:
+	with connection.cursor() as cursor:
+		cursor.execute(f"EXPLAIN {query}", date_range)
+		return "\n".join(row[0] for row in cursor.fetchall())
+
+
+def benchmark_path(database_credentials: Dict, query: str, read: Callable, repeats: int) -> Dict:
+	"""Time the path repeats times and trace its memory once"""
+	latencies = []
+	with pooled_connection(database_credentials) as connection:
+		for _ in range(repeats):
+			start = time.perf_counter()
+			news_df = read(connection, query)
+			latencies.append(time.perf_counter() - start)
+			connection.rollback()
+		tracemalloc.start()
+		read(connection, query)
+		_, peak = tracemalloc.get_traced_memory()
+		tracemalloc.stop()
+	rows = news_df.shape[0]
+	median = float(np.median(latencies))
+	return {
+		"rows": rows,
+		"p50_seconds": median,
+		"min_seconds": float(np.min(latencies)),
+		"rows_per_second": rows / median if median > 0 else None,
+		"peak_mb": peak / 1024**2,
+	}
+
+
+if __name__ == "__main__":
+	parser = ArgumentParser()
+	parser.add_argument("-e", "--environment", default="dev")
+	parser.add_argument(
+		"-d", "--days_ago", type=int, default=0, help="pull from this many days ago"
+	)
+	parser.add_argument("--repeats", type=int, default=3)
+	parser.add_argument("--output", default=None, help="optional json file for the results")
+	args = parser.parse_args()
+
+	date = (datetime.now() - timedelta(days=args.days_ago)).strftime("%Y-%m-%d")
+	data_puller = DataPuller(environment=args.environment, date=date)
+	database_credentials = data_puller.load_database_credentials()
+	date_range = data_puller.get_date_range()
+	paths = make_paths(date_range)
+	with pooled_connection(database_credentials) as connection:
+		for name in ("cast", "range"):
+			logger.info(
+				f"plan of the {name} query:\n{explain(connection, paths[name][0], date_range)}"
+			)
+	results = {}
+	for name, (query, read) in paths.items():
+		results[name] = benchmark_path(database_credentials, query, read, args.repeats)
+		logger.info(
+			f"{name}: {results[name]['rows']} rows, p50 {results[name]['p50_seconds']:.3f}s, "
+			f"{results[name]['rows_per_second'] or 0:.0f} rows/s, peak {results[name]['peak_mb']:.1f}MB"
+		)
+	close_connection_pools()
+	if args.output:
+		Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+		with open(args.output, "w") as output_file:
+			json.dump({"date": date, "results": results}, output_file, indent=4)
@@ -0,0 +1,93 @@
+"""
+Benchmark the embedding throughput on the daily news exports in data/.
+
+It compares SentenceTransformer.encode with its default batching and the token budget batching of
+EmbeddingsComputer. The embedding model must be downloaded in models/, see src/summarizer/Readme.md.
+
+python scripts/benchmark_embeddings.py --token_budgets 8192 16384 32768
+"""
+
+import json
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+
+from src.shared.logger import setup_logger
+from src.summarizer.data_puller import load_news_snapshot
+from src.summarizer.embeddings_computer import EmbeddingsComputer, make_token_budget_batches
+
+logger = setup_logger("benchmark_embeddings")
+
+
+def padded_tokens(token_lengths: np.array, batches: list) -> int:
+	"""The number of tokens the model processes, every batch is padded to its longest document"""
+	return int(sum(len(batch) * token_lengths[batch].max() for batch in batches))
+
+
+if __name__ == "__main__":
+	parser = ArgumentParser()
+	parser.add_argument("--data_dir", default="data")
+	parser.add_argument("--embedding_model_id", default="dunzhang/stella_en_400M_v5")
+	parser.add_argument("--batch_size", type=int, default=32, help="the default encode batch size")
+	parser.add_argument("--token_budgets", type=int, nargs="+", default=[8192, 16384, 32768])
+	parser.add_argument("--output", default=None, help="optional json file for the results")
+	args = parser.parse_args()
+
+	if not Path.cwd().joinpath("models", args.embedding_model_id).exists():
+		raise SystemExit(f"download {args.embedding_model_id} in models/ to run this benchmark")
+	embeddings_computer = EmbeddingsComputer(embedding_model_id=args.embedding_model_id)
+	model = embeddings_computer.sentence_transformer_model
+	documents = [
+		document
+		for snapshot_path in sorted(Path(args.data_dir).glob("*.csv"))
+		for document in load_news_snapshot(snapshot_path)["content"].tolist()
+	]
+	token_ids = model.tokenizer(documents, add_special_tokens=True, truncation=False)["input_ids"]
+	token_lengths = np.minimum([len(ids) for ids in token_ids], model.max_seq_length)
+	logger.info(
+		f"{len(documents)} documents, {token_lengths.sum()} tokens, "
+		f"{(np.array([len(ids) for ids in token_ids]) > model.max_seq_length).sum()} longer than {model.max_seq_length}"
+	)
+
+	results = []
+	# the default encode sorts the documents by characters and batches them by count
+	character_order = np.argsort([-len(document) for document in documents], kind="stable")
+	default_batches = [
+		character_order[start : start + args.batch_size]
+		for start in range(0, len(documents), args.batch_size)
+	]
+	start = time.perf_counter()
+	model.encode(documents, batch_size=args.batch_size, show_progress_bar=False)
+	results.append(
+		{
+			"batching": f"default batch_size={args.batch_size}",
+			"seconds": time.perf_counter() - start,
+			"padded_tokens": padded_tokens(token_lengths, default_batches),
+		}
+	)
+	for token_budget in args.token_budgets:
+		embeddings_computer.token_budget = token_budget
+		start = time.perf_counter()
+		embeddings_computer.embed_documents(documents)
+		results.append(
+			{
+				"batching": f"token_budget={token_budget}",
+				"seconds": time.perf_counter() - start,
+				"padded_tokens": padded_tokens(
+					token_lengths, make_token_budget_batches(token_lengths, token_budget)
+				),
+			}
+		)
+	for result in results:
+		result["documents_per_second"] = len(documents) / result["seconds"]
+		result["tokens_per_second"] = int(token_lengths.sum()) / result["seconds"]
+		result["padding_ratio"] = result["padded_tokens"] / int(token_lengths.sum())
+		logger.info(
+			f"{result['batching']}: {result['seconds']:.1f}s, {result['documents_per_second']:.2f} documents/s, "
+			f"{result['tokens_per_second']:.0f} tokens/s, padding ratio {result['padding_ratio']:.2f}"
+		)
+	if args.output:
+		with open(args.output, "w") as output_file:
+			json.dump(results, output_file, indent=4)
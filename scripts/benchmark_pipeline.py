@@ -0,0 +1,232 @@
+"""
+Benchmark the clustering pipeline, deduplication -> embeddings -> clustering, on the exports in data/.
+
+Every snapshot is run as it is and scaled, the scaled copies have a part of their words replaced so
+they are new articles for the deduplication and the clustering. Each stage is timed --repeats times,
+the median and the slowest latency and the throughput come from these runs, the peak memory from one
+more run traced with tracemalloc.
+
+The embeddings come from the local embedding model when it is in models/, otherwise from a stub
+hashing model with the same interface, so the benchmark runs offline. Compare runs of the same model.
+
+python scripts/benchmark_pipeline.py --scales 1 10 100 --output benchmarks/baseline.json
+python scripts/benchmark_pipeline.py --scales 1 10 100 --compare benchmarks/baseline.json
+"""
+
+import json
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import Callable, Dict, List
+
+import numpy as np
+import pandas as pd
+from sklearn.feature_extraction.text import HashingVectorizer
+
+from src.shared.logger import setup_logger
+from src.summarizer.cluster_modeler import HierarchicalClusterModeler
+from src.summarizer.data_puller import load_news_snapshot
+from src.summarizer.deduplicator import NearDuplicateRemover
+from src.summarizer.embeddings_computer import EmbeddingsComputer
+
+logger = setup_logger("benchmark_pipeline")
+
+STAGES = ("deduplicate", "embed", "cluster")
+
+
+class HashingTokenizer:
+	"""Whitespace tokenizer with the interface EmbeddingsComputer uses"""
+
+	def __call__(self, texts: List[str], **kwargs) -> Dict:
+		return {"input_ids": [text.split() for text in texts]}
+
+	def decode(self, token_ids: List[str], **kwargs) -> str:
+		return " ".join(token_ids)
+
+
+class HashingEmbeddingModel:
+	"""Stub of the sentence transformer, normalized hashed tf-idf like vectors of the words"""
+
+	max_seq_length = 512
+
+	def __init__(self, dimension: int = 1024) -> None:
+		self.tokenizer = HashingTokenizer()
+		self.vectorizer = HashingVectorizer(n_features=dimension, alternate_sign=False, norm="l2")
+
+	def encode(self, texts: List[str], **kwargs) -> np.array:
+		texts = [" ".join(text.split()[: self.max_seq_length]) for text in texts]
+		return self.vectorizer.transform(texts).toarray().astype(np.float32)
+
+
+class StubEmbeddingsComputer(EmbeddingsComputer):
+	"""EmbeddingsComputer with the stub model, the batching and the pooling are the real ones"""
+
+	def init_sentence_transformer(self, transformer_kwargs: dict = None) -> HashingEmbeddingModel:
+		logger.info("embedding model not found, using the stub hashing model")
+		return HashingEmbeddingModel()
+
+
+def load_snapshot(snapshot_path: Path) -> pd.DataFrame:
+	news_df = load_news_snapshot(snapshot_path)
+	if "url" not in news_df.columns:
+		news_df["url"] = news_df["id"].astype(str)
+	return news_df[["title", "content", "url"]].fillna("")
+
+
+def scale_snapshot(
+	news_df: pd.DataFrame, scale: int, replace_rate: float = 0.2, seed: int = 42
+) -> pd.DataFrame:
+	"""Repeat the articles scale times, replace_rate of the words of every copy are replaced"""
+	if scale == 1:
+		return news_df
+	generator = np.random.default_rng(seed)
+	vocabulary = np.array(" ".join(news_df["content"]).split())
+	copies = [news_df]
+	for copy in range(1, scale):
+		contents = []
+		for content in news_df["content"]:
+			words = np.array(content.split())
+			is_replaced = generator.random(words.shape[0]) < replace_rate
+			words[is_replaced] = generator.choice(vocabulary, size=int(is_replaced.sum()))
+			contents.append(" ".join(words))
+		copies.append(
+			news_df.assign(
+				content=contents,
+				title=news_df["title"] + f" ({copy})",
+				url=news_df["url"] + f"#{copy}",
+			)
+		)
+	return pd.concat(copies, ignore_index=True)
+
+
+def make_stages(embeddings_computer: EmbeddingsComputer) -> Dict[str, Callable]:
+	"""Every stage takes the output of the previous one"""
+	deduplicator = NearDuplicateRemover()
+	cluster_modeler = HierarchicalClusterModeler()
+	return {
+		"deduplicate": deduplicator.run,
+		"embed": lambda news_df: embeddings_computer.run(news_df["content"]),
+		"cluster": lambda embeddings: cluster_modeler.compute_labels(embeddings)[0],
+	}
+
+
+def benchmark_stage(function: Callable, stage_input, repeats: int) -> tuple[Dict, object]:
+	"""Time the stage repeats times and trace its memory once, return the metrics and its output"""
+	latencies = []
+	for _ in range(repeats):
+		start = time.perf_counter()
+		output = function(stage_input)
+		latencies.append(time.perf_counter() - start)
+	tracemalloc.start()
+	function(stage_input)
+	_, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	rows = len(stage_input)
+	median = float(np.median(latencies))
+	return {
+		"rows": rows,
+		"p50_seconds": median,
+		# a few repeats have no meaningful tail percentile, the slowest run is reported instead
+		"max_seconds": float(np.max(latencies)),
+		"rows_per_second": rows / median if median > 0 else None,
+		"peak_mb": peak / 1024**2,
+	}, output
+
+
+def run_benchmark(
+	data_dir: str, scales: List[int], repeats: int, embeddings_computer: EmbeddingsComputer
+) -> List[Dict]:
+	stages = make_stages(embeddings_computer)
+	results = []
+	for snapshot_path in sorted(Path(data_dir).glob("*.csv")):
+		news_df = load_snapshot(snapshot_path)
+		for scale in scales:
+			stage_input = scale_snapshot(news_df, scale)
+			for stage in STAGES:
+				metrics, stage_input = benchmark_stage(stages[stage], stage_input, repeats)
+				result = {"snapshot": snapshot_path.name, "scale": scale, "stage": stage, **metrics}
+				logger.info(
+					f"{result['snapshot']} x{scale} {stage} ({metrics['rows']} rows): "
+					f"p50 {metrics['p50_seconds']:.3f}s, max {metrics['max_seconds']:.3f}s, "
+					f"{metrics['rows_per_second']:.0f} rows/s, peak {metrics['peak_mb']:.1f} MB"
+				)
+				results.append(result)
+	return results
+
+
+def compare_results(results: List[Dict], baseline: List[Dict], tolerance: float) -> List[Dict]:
+	"""Return the stages slower or using more memory than the baseline by more than tolerance"""
+	baseline_results = {
+		(result["snapshot"], result["scale"], result["stage"]): result for result in baseline
+	}
+	regressions = []
+	for result in results:
+		baseline_result = baseline_results.get(
+			(result["snapshot"], result["scale"], result["stage"])
+		)
+		if baseline_result is None:
+			continue
+		for metric in ("p50_seconds", "peak_mb"):
+			ratio = result[metric] / max(baseline_result[metric], 1e-9)
+			if ratio > 1 + tolerance:
+				regressions.append(
+					{
+						"snapshot": result["snapshot"],
+						"scale": result["scale"],
+						"stage": result["stage"],
+						"metric": metric,
+						"baseline": baseline_result[metric],
+						"value": result[metric],
+						"ratio": ratio,
+					}
+				)
+	return regressions
+
+
+if __name__ == "__main__":
+	parser = ArgumentParser()
+	parser.add_argument("--data_dir", default="data")
+	parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100])
+	parser.add_argument("--repeats", type=int, default=3)
+	parser.add_argument("--embedding_model_id", default="dunzhang/stella_en_400M_v5")
+	parser.add_argument("--output", default=None, help="optional json file for the results")
+	parser.add_argument("--compare", default=None, help="a json file of a previous run")
+	parser.add_argument(
+		"--tolerance",
+		type=float,
+		default=0.2,
+		help="the relative increase of the p50 latency or the peak memory flagged as a regression",
+	)
+	args = parser.parse_args()
+
+	if Path.cwd().joinpath("models", args.embedding_model_id).exists():
+		embeddings_computer = EmbeddingsComputer(embedding_model_id=args.embedding_model_id)
+		embedding_model = args.embedding_model_id
+	else:
+		embeddings_computer = StubEmbeddingsComputer(embedding_model_id=args.embedding_model_id)
+		embedding_model = "stub"
+	results = run_benchmark(args.data_dir, args.scales, args.repeats, embeddings_computer)
+	if args.output:
+		Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+		with open(args.output, "w") as output_file:
+			json.dump(
+				{"embedding_model": embedding_model, "results": results}, output_file, indent=4
+			)
+	if args.compare:
+		with open(args.compare) as baseline_file:
+			baseline = json.load(baseline_file)
+		if baseline["embedding_model"] != embedding_model:
+			logger.warning(
+				f"the baseline used the {baseline['embedding_model']} embeddings, this run {embedding_model}"
+			)
+		regressions = compare_results(results, baseline["results"], args.tolerance)
+		for regression in regressions:
+			logger.error(
+				f"regression {regression['snapshot']} x{regression['scale']} {regression['stage']} "
+				f"{regression['metric']}: {regression['baseline']:.3f} -> {regression['value']:.3f} "
+				f"(x{regression['ratio']:.2f})"
+			)
+		if regressions:
+			raise SystemExit(1)
+		logger.info(f"no regression above {args.tolerance:.0%} against {args.compare}")
@@ -0,0 +1,321 @@
+"""
+A local stand-in of the llama.cpp server to load test LLamaCppGeneratorComponent without a GPU.
+
+python scripts/fake_llama_server.py --port 8080 --slots 2 --tokens_per_second 40 --error_rate_503 0.05
+
+POST /tokenize answers one token per word of the content. POST /completion answers a SummarySchemas json after a prompt latency drawn from --latency_distribution
+and the decode time of the generated tokens at --tokens_per_second, with the llama.cpp tokens_* and
+timings fields. --error_rate_429 and --error_rate_503 inject errors, --slots limits the requests
+processed at the same time, the others wait like on llama.cpp or get a 503 with --reject_when_busy.
+With --prefill_tokens_per_second the prompt latency grows with the prompt length (words count as tokens).
+GET /ping and /health answer 503 during --cold_start_seconds, GET /stats returns the server counters.
+With "stream": true the tokens are sent as server sent events, --trailing_tokens whitespace tokens
+follow the json and --stall_rate of the streams stop sending tokens for --stall_seconds.
+"""
+
+import json
+import threading
+import time
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from src.shared.logger import setup_logger
+
+logger = setup_logger("fake_llama_server")
+
+FAKE_SUMMARY = {
+	"title": "Revue de presse congolaise",
+	"summary": "Les documents décrivent une actualité congolaise. Ce résumé est produit par le faux serveur.",
+}
+
+
+class FakeLlamaHandler(BaseHTTPRequestHandler):
+	server: "FakeLlamaServer"
+
+	def send_json(self, status: int, payload: dict, headers: dict | None = None) -> None:
+		body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		for name, value in (headers or {}).items():
+			self.send_header(name, value)
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_GET(self) -> None:
+		if self.path == "/stats":
+			self.send_json(200, self.server.get_stats())
+		elif self.path in ("/ping", "/health"):
+			if self.server.is_loading():
+				self.send_json(503, {"error": {"code": 503, "message": "Loading model"}})
+			else:
+				self.send_json(200, {"status": "ok"})
+		else:
+			self.send_json(404, {"error": f"unknown path {self.path}"})
+
+	def do_POST(self) -> None:
+		if self.path not in ("/completion", "/tokenize"):
+			self.send_json(404, {"error": f"unknown path {self.path}"})
+			return
+		content_length = int(self.headers["Content-Length"])
+		payload = json.loads(self.rfile.read(content_length))
+		if self.path == "/tokenize":
+			self.server.count("tokenize_requests")
+			words = payload.get("content", "").split()
+			self.send_json(200, {"tokens": list(range(len(words)))})
+			return
+		error_status = self.server.draw_error()
+		if self.server.is_loading():
+			error_status = 503
+		if error_status is not None:
+			self.server.count("errors_" + str(error_status))
+			self.send_json(
+				error_status,
+				{"error": {"code": error_status, "message": "injected error"}},
+				headers={"Retry-After": "1"} if error_status == 429 else None,
+			)
+			return
+		queue_start = time.perf_counter()
+		if not self.server.slots.acquire(blocking=not self.server.reject_when_busy):
+			self.server.count("errors_busy")
+			self.send_json(503, {"error": {"code": 503, "message": "no slot available"}})
+			return
+		self.server.count("queue_seconds", time.perf_counter() - queue_start)
+		try:
+			if payload.get("stream"):
+				self.stream_completion(payload)
+				return
+			completion = self.server.complete(payload)
+		finally:
+			self.server.slots.release()
+		self.send_json(200, completion)
+
+	def stream_completion(self, payload: dict) -> None:
+		"""Send the tokens one event at a time, the client closing the connection cancels the stream"""
+		self.send_response(200)
+		self.send_header("Content-Type", "text/event-stream")
+		self.end_headers()
+		start = time.perf_counter()
+		prompt_tokens = len(payload.get("prompt", "").split())
+		prompt_seconds = self.server.draw_prompt_seconds(prompt_tokens)
+		time.sleep(prompt_seconds)
+		pieces = self.server.make_pieces(payload)
+		stall_at = self.server.draw_stall_position(len(pieces))
+		sent_tokens = 0
+
+		def get_timings() -> dict:
+			return {
+				"prompt_n": prompt_tokens,
+				"prompt_ms": prompt_seconds * 1000,
+				"predicted_n": sent_tokens,
+				"predicted_ms": (time.perf_counter() - start - prompt_seconds) * 1000,
+			}
+
+		try:
+			for position, piece in enumerate(pieces):
+				if position == stall_at:
+					self.server.count("stalls")
+					time.sleep(self.server.stall_seconds)
+				time.sleep(1 / self.server.tokens_per_second)
+				event = {"content": piece, "stop": False}
+				if payload.get("timings_per_token"):
+					event["timings"] = get_timings()
+				self.send_event(event)
+				sent_tokens += 1
+			self.send_event(
+				{
+					"content": "",
+					"stop": True,
+					"tokens_evaluated": prompt_tokens,
+					"tokens_predicted": sent_tokens,
+					"timings": get_timings(),
+				}
+			)
+		except (BrokenPipeError, ConnectionResetError):
+			self.server.count("cancelled_streams")
+		finally:
+			self.server.count("completions")
+			self.server.count("completion_seconds", time.perf_counter() - start)
+			self.server.count("tokens_predicted", sent_tokens)
+
+	def send_event(self, event: dict) -> None:
+		self.wfile.write(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+		self.wfile.flush()
+
+	def log_message(self, format: str, *args) -> None:
+		logger.debug(format % args)
+
+
+class FakeLlamaServer(ThreadingHTTPServer):
+	"""The latencies, the token rate and the injected errors are drawn from a seeded generator"""
+
+	daemon_threads = True
+
+	def __init__(
+		self,
+		address: tuple[str, int],
+		slots: int = 1,
+		latency_distribution: str = "lognormal",
+		prompt_seconds: float = 0.5,
+		tokens_per_second: float = 30,
+		output_tokens: int = 120,
+		error_rate_429: float = 0,
+		error_rate_503: float = 0,
+		reject_when_busy: bool = False,
+		cold_start_seconds: float = 0,
+		trailing_tokens: int = 0,
+		stall_rate: float = 0,
+		stall_seconds: float = 60,
+		prefill_tokens_per_second: float = 0,
+		seed: int = 42,
+	) -> None:
+		super().__init__(address, FakeLlamaHandler)
+		self.slots = threading.Semaphore(slots)
+		self.latency_distribution = latency_distribution
+		self.prompt_seconds = prompt_seconds
+		self.tokens_per_second = tokens_per_second
+		self.output_tokens = output_tokens
+		self.error_rate_429 = error_rate_429
+		self.error_rate_503 = error_rate_503
+		self.reject_when_busy = reject_when_busy
+		self.ready_at = time.monotonic() + cold_start_seconds
+		self.trailing_tokens = trailing_tokens
+		self.stall_rate = stall_rate
+		self.stall_seconds = stall_seconds
+		self.prefill_tokens_per_second = prefill_tokens_per_second
+		self.generator = np.random.default_rng(seed)
+		self.lock = threading.Lock()
+		self.stats = {
+			"completions": 0,
+			"completion_seconds": 0.0,
+			"queue_seconds": 0.0,
+			"tokens_predicted": 0,
+		}
+
+	def is_loading(self) -> bool:
+		return time.monotonic() < self.ready_at
+
+	def count(self, name: str, value: float = 1) -> None:
+		with self.lock:
+			self.stats[name] = self.stats.get(name, 0) + value
+
+	def get_stats(self) -> dict:
+		with self.lock:
+			return dict(self.stats)
+
+	def draw_error(self) -> int | None:
+		with self.lock:
+			draw = self.generator.random()
+		if draw < self.error_rate_429:
+			return 429
+		if draw < self.error_rate_429 + self.error_rate_503:
+			return 503
+		return None
+
+	def draw_prompt_seconds(self, prompt_tokens: int = 0) -> float:
+		prefill_seconds = (
+			prompt_tokens / self.prefill_tokens_per_second if self.prefill_tokens_per_second else 0
+		)
+		return prefill_seconds + self.draw_latency()
+
+	def draw_latency(self) -> float:
+		with self.lock:
+			if self.latency_distribution == "constant":
+				return self.prompt_seconds
+			if self.latency_distribution == "exponential":
+				return float(self.generator.exponential(self.prompt_seconds))
+			# lognormal with the given median and a long tail
+			return float(self.prompt_seconds * self.generator.lognormal(0, 0.5))
+
+	def make_pieces(self, payload: dict) -> list[str]:
+		"""Cut the summary json in tokens of 4 characters, then the trailing whitespace tokens"""
+		content = json.dumps(FAKE_SUMMARY, ensure_ascii=False)
+		pieces = [content[start : start + 4] for start in range(0, len(content), 4)]
+		pieces.extend(["\n"] * self.trailing_tokens)
+		return pieces[: payload.get("n_predict", len(pieces))]
+
+	def draw_stall_position(self, number_of_pieces: int) -> int | None:
+		with self.lock:
+			if self.generator.random() >= self.stall_rate:
+				return None
+			return int(self.generator.integers(0, number_of_pieces))
+
+	def complete(self, payload: dict) -> dict:
+		"""Sleep like llama.cpp would and answer with its completion fields"""
+		prompt_tokens = len(payload.get("prompt", "").split())
+		predicted_tokens = min(self.output_tokens, payload.get("n_predict", self.output_tokens))
+		prompt_seconds = self.draw_prompt_seconds(prompt_tokens)
+		predicted_seconds = predicted_tokens / self.tokens_per_second
+		time.sleep(prompt_seconds + predicted_seconds)
+		self.count("completions")
+		self.count("completion_seconds", prompt_seconds + predicted_seconds)
+		self.count("tokens_predicted", predicted_tokens)
+		return {
+			"content": json.dumps(FAKE_SUMMARY, ensure_ascii=False),
+			"id_slot": payload.get("id_slot", -1),
+			"stop": True,
+			"tokens_evaluated": prompt_tokens,
+			"tokens_predicted": predicted_tokens,
+			"timings": {
+				"prompt_n": prompt_tokens,
+				"prompt_ms": prompt_seconds * 1000,
+				"predicted_n": predicted_tokens,
+				"predicted_ms": predicted_seconds * 1000,
+				"predicted_per_second": self.tokens_per_second,
+			},
+		}
+
+
+def add_server_arguments(parser: ArgumentParser) -> None:
+	parser.add_argument("--slots", type=int, default=1, help="like llama.cpp --parallel")
+	parser.add_argument(
+		"--latency_distribution",
+		default="lognormal",
+		choices=["constant", "exponential", "lognormal"],
+	)
+	parser.add_argument(
+		"--prompt_seconds", type=float, default=0.5, help="the median prompt processing time"
+	)
+	parser.add_argument("--tokens_per_second", type=float, default=30)
+	parser.add_argument("--output_tokens", type=int, default=120)
+	parser.add_argument("--error_rate_429", type=float, default=0)
+	parser.add_argument("--error_rate_503", type=float, default=0)
+	parser.add_argument("--reject_when_busy", action="store_true")
+	parser.add_argument("--cold_start_seconds", type=float, default=0)
+	parser.add_argument("--trailing_tokens", type=int, default=0)
+	parser.add_argument("--stall_rate", type=float, default=0)
+	parser.add_argument("--stall_seconds", type=float, default=60)
+	parser.add_argument("--prefill_tokens_per_second", type=float, default=0)
+
+
+def make_server(args, host: str = "127.0.0.1", port: int = 0) -> FakeLlamaServer:
+	"""Build the server from the parsed arguments of add_server_arguments, port 0 picks a free port"""
+	return FakeLlamaServer(
+		(host, port),
+		slots=args.slots,
+		latency_distribution=args.latency_distribution,
+		prompt_seconds=args.prompt_seconds,
+		tokens_per_second=args.tokens_per_second,
+		output_tokens=args.output_tokens,
+		error_rate_429=args.error_rate_429,
+		error_rate_503=args.error_rate_503,
+		reject_when_busy=args.reject_when_busy,
+		cold_start_seconds=args.cold_start_seconds,
+		trailing_tokens=args.trailing_tokens,
+		stall_rate=args.stall_rate,
+		stall_seconds=args.stall_seconds,
+		prefill_tokens_per_second=args.prefill_tokens_per_second,
+	)
+
+
+if __name__ == "__main__":
+	parser = ArgumentParser()
+	parser.add_argument("--host", default="127.0.0.1")
+	parser.add_argument("--port", type=int, default=8080)
+	add_server_arguments(parser)
+	args = parser.parse_args()
+	server = make_server(args, host=args.host, port=args.port)
+	logger.info(f"fake llama.cpp server on {args.host}:{args.port} with {args.slots} slots")
+	server.serve_forever()
@@ -0,0 +1,159 @@
+"""
+Load test LLamaCppGeneratorComponent and summarize_documents against the fake llama.cpp server.
+
+python scripts/load_test_generator.py --parallel_slots 4 --slots 4 --error_rate_503 0.1
+
+The clusters are consecutive groups of --cluster_size articles of the exports in data/, so the prompts
+have the length of the real ones. Without --api_url the fake server of scripts/fake_llama_server.py
+is started in this process with the server arguments. It reports the requests/s, the latency
+percentiles of the completion requests and the time lost to the retries and their backoff, which is
+the client time of the requests minus the server time of the completions and the time they waited
+for a slot (fake server only).
+"""
+
+import json
+import threading
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import Dict, List
+from urllib.request import urlopen
+
+import numpy as np
+from fake_llama_server import add_server_arguments, make_server
+
+from src.llm.generator import LLamaCppGeneratorComponent
+from src.llm.main import summarize_documents
+from src.schemas import SummarySchemas
+from src.shared.logger import setup_logger
+from src.shared.metrics import metrics_recorder
+from src.summarizer.data_puller import load_news_snapshot
+
+logger = setup_logger("load_test_generator")
+
+
+class TimedGenerator(LLamaCppGeneratorComponent):
+	"""Record the client latency of every completion request, with its retries"""
+
+	def __init__(self, *args, **kwargs) -> None:
+		super().__init__(*args, **kwargs)
+		self.latencies: List[float] = []
+		self.latencies_lock = threading.Lock()
+
+	def generate_response(self, chat_content: str, id_slot: int | None = None) -> SummarySchemas:
+		start = time.perf_counter()
+		try:
+			return super().generate_response(chat_content, id_slot=id_slot)
+		finally:
+			with self.latencies_lock:
+				self.latencies.append(time.perf_counter() - start)
+
+
+def load_cluster_rows(data_dir: str, cluster_size: int, max_clusters: int | None) -> List[Dict]:
+	"""The articles of the exports with a label for every cluster_size consecutive articles"""
+	rows = []
+	for snapshot_path in sorted(Path(data_dir).glob("*.csv")):
+		news_df = load_news_snapshot(snapshot_path).fillna("")
+		for position, news in enumerate(news_df.to_dict(orient="records")):
+			rows.append(
+				{
+					"labels": f"{snapshot_path.stem}-{position // cluster_size}",
+					"title": news["title"],
+					"url": news.get("url") or str(news.get("id", position)),
+					"content": news["content"],
+				}
+			)
+	if max_clusters is not None:
+		labels = list(dict.fromkeys(row["labels"] for row in rows))[:max_clusters]
+		rows = [row for row in rows if row["labels"] in set(labels)]
+	return rows
+
+
+def get_server_stats(api_url: str) -> Dict | None:
+	"""The counters of the fake server, None for a real llama.cpp server"""
+	try:
+		with urlopen(f"{api_url}/stats", timeout=10) as response:
+			return json.loads(response.read())
+	except Exception:
+		return None
+
+
+if __name__ == "__main__":
+	parser = ArgumentParser()
+	parser.add_argument("--data_dir", default="data")
+	parser.add_argument("--api_url", default=None, help="a running server, the fake one by default")
+	parser.add_argument("--cluster_size", type=int, default=5)
+	parser.add_argument("--max_clusters", type=int, default=40)
+	parser.add_argument("--parallel_slots", type=int, default=1, help="the client concurrency")
+	parser.add_argument("--pin_slots", action="store_true")
+	parser.add_argument("--output", default=None, help="optional json file for the report")
+	parser.add_argument("--time_budget", type=float, default=None, help="the client run budget")
+	parser.add_argument("--request_budget", type=float, default=600)
+	parser.add_argument("--max_attempts", type=int, default=8)
+	parser.add_argument("--backoff_seconds", type=float, default=2)
+	parser.add_argument("--stream", action="store_true", help="stream the tokens from the server")
+	parser.add_argument("--max_tokens_per_prompt", type=int, default=None)
+	parser.add_argument("--stall_timeout", type=float, default=30, help="the client stall_seconds")
+	add_server_arguments(parser)
+	args = parser.parse_args()
+
+	server = None
+	api_url = args.api_url
+	if api_url is None:
+		server = make_server(args)
+		threading.Thread(target=server.serve_forever, daemon=True).start()
+		api_url = f"http://127.0.0.1:{server.server_address[1]}"
+		logger.info(f"started the fake llama.cpp server on {api_url}")
+	rows = load_cluster_rows(args.data_dir, args.cluster_size, args.max_clusters)
+	generator = TimedGenerator(
+		api_url=api_url,
+		parallel_slots=args.parallel_slots,
+		time_budget=args.time_budget,
+		request_budget=args.request_budget,
+		max_attempts=args.max_attempts,
+		backoff_seconds=args.backoff_seconds,
+		stream=args.stream,
+		stall_seconds=args.stall_timeout,
+		max_tokens_per_prompt=args.max_tokens_per_prompt,
+	)
+	assert generator._ping_api(), "the server is not up"
+	start = time.perf_counter()
+	summaries, failures = summarize_documents(
+		rows, generator, max_concurrency=args.parallel_slots, pin_slots=args.pin_slots
+	)
+	wall_seconds = time.perf_counter() - start
+	generator.close()
+
+	latencies = np.array(generator.latencies)
+	completion_stage = metrics_recorder.get_stage("llm.completion")
+	report = {
+		"clusters": len(summaries) + len(failures),
+		"summaries": len(summaries),
+		"failures": len(failures),
+		"wall_seconds": wall_seconds,
+		"requests_per_second": len(latencies) / wall_seconds,
+		"p50_seconds": float(np.percentile(latencies, 50)),
+		"p90_seconds": float(np.percentile(latencies, 90)),
+		"p99_seconds": float(np.percentile(latencies, 99)),
+		"max_seconds": float(latencies.max()),
+		"retries": completion_stage.retries,
+		"tokens": completion_stage.counters.get("tokens", 0),
+	}
+	if args.stream and summaries:
+		report["mean_first_token_seconds"] = completion_stage.counters.get(
+			"first_token_seconds", 0
+		) / len(summaries)
+	server_stats = get_server_stats(api_url)
+	if server_stats is not None:
+		report["server"] = server_stats
+		report["slot_queue_seconds"] = server_stats["queue_seconds"]
+		# the rest of the client time went to the failed attempts and the backoff sleeps
+		report["seconds_lost_to_retries"] = float(
+			latencies.sum() - server_stats["completion_seconds"] - server_stats["queue_seconds"]
+		)
+	logger.info(json.dumps(report, indent=4))
+	if args.output:
+		with open(args.output, "w") as output_file:
+			json.dump(report, output_file, indent=4)
+	if server is not None:
+		server.shutdown()
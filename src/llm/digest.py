@@ -0,0 +1,274 @@
+"""
+Build the weekly digest from the daily cluster centroids and the daily summaries.
+
+python src/llm/digest.py -e prod -n 7 --save_to_s3 1
+
+The clusters of the last n days are merged by the cosine similarity of their centroids, the stories
+seen on more than one day get a new summary from their daily summaries, the other ones keep their
+daily summary. The article embeddings are never computed again.
+"""
+
+import argparse
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from io import BytesIO
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from src.llm.generator import LLamaCppGeneratorComponent
+from src.llm.prompts import DIGEST_PROMPT_TEMPLATE
+from src.shared.cloud_storage.cloud_storage_columnar import BackBlazeCloudStorageColumnar
+from src.shared.logger import setup_logger
+from src.shared.metrics import metrics_recorder
+
+logger = setup_logger("summarizer_digest")
+
+
+def load_daily_clusters(
+	cloud_storage: BackBlazeCloudStorageColumnar,
+	clusters_bucket_name: str,
+	summaries_bucket_name: str,
+	dates: List[str],
+) -> Tuple[List[Dict], np.array]:
+	"""
+	Return the summarized clusters of the dates and their centroids, in the same order.
+
+	A day without centroids or summaries is skipped with a warning, so is a cluster without a summary
+	and a summary without a label. Both files are keyed by the clustering date of the clusters.
+	"""
+	daily_clusters = []
+	centroids = []
+	for date in dates:
+		try:
+			columnar_file = cloud_storage.read_columns(
+				bucket_name=clusters_bucket_name,
+				file_name=cloud_storage.generate_centroids_file_name(date),
+			)
+			buffer = BytesIO()
+			cloud_storage.download_to(
+				bucket_name=summaries_bucket_name,
+				file_name=f"summaries/news-summaries-{date}.json",
+				destination=buffer,
+			)
+		except Exception as e:
+			logger.warning(f"skipping {date}, its centroids or summaries are missing: {e}")
+			continue
+		day_centroids = columnar_file.read(["labels", "centroid", "size"])
+		columnar_file.close()
+		day_summaries = json.loads(buffer.getvalue())
+		# the summaries files written before the label was kept cannot be matched to a centroid
+		summaries = {
+			int(summary["label"]): summary for summary in day_summaries if "label" in summary
+		}
+		if len(summaries) < len(day_summaries):
+			logger.warning(
+				f"skipping {len(day_summaries) - len(summaries)} summaries of {date} without a label"
+			)
+		for label, centroid, size in zip(
+			day_centroids["labels"].tolist(),
+			day_centroids["centroid"],
+			day_centroids["size"].tolist(),
+		):
+			if label not in summaries:
+				continue
+			daily_clusters.append({"date": date, "size": size, **summaries[label]})
+			centroids.append(centroid)
+		logger.info(f"loaded {len(summaries)} summarized clusters of {date}")
+	if not centroids:
+		return daily_clusters, np.zeros((0, 0), dtype=np.float32)
+	return daily_clusters, np.stack(centroids).astype(np.float32)
+
+
+def merge_daily_clusters(
+	centroids: np.array, sizes: np.array, merge_threshold: float = 0.25
+) -> np.array:
+	"""
+	Merge the clusters whose centroids are closer than merge_threshold (cosine distance).
+
+	The closest pair of stories is merged first and the story centroid is the size weighted mean of its
+	clusters, until no pair is close enough. Return the story index of every cluster.
+	"""
+	number_of_clusters = centroids.shape[0]
+	stories = np.arange(number_of_clusters)
+	if number_of_clusters < 2:
+		return stories
+	weights = np.asarray(sizes, dtype=np.float32)[:, None]
+	story_sums = centroids * weights
+	is_active = np.ones(number_of_clusters, dtype=bool)
+	while True:
+		norms = np.linalg.norm(story_sums, axis=1, keepdims=True)
+		story_centroids = story_sums / np.where(norms == 0, 1, norms)
+		similarities = story_centroids @ story_centroids.T
+		similarities[~is_active, :] = -np.inf
+		similarities[:, ~is_active] = -np.inf
+		np.fill_diagonal(similarities, -np.inf)
+		first, second = np.unravel_index(similarities.argmax(), similarities.shape)
+		if 1 - similarities[first, second] > merge_threshold:
+			break
+		story_sums[first] += story_sums[second]
+		is_active[second] = False
+		stories[stories == second] = first
+	return stories
+
+
+def parse_summary(summary: str) -> Dict:
+	"""The summaries are the json of SummarySchemas, keep the raw text if one is not"""
+	try:
+		return json.loads(summary)
+	except (TypeError, json.JSONDecodeError):
+		return {"title": "", "summary": summary}
+
+
+def summarize_story(story_clusters: List[Dict], generator: LLamaCppGeneratorComponent) -> Dict:
+	"""Summarize the daily summaries of a story seen on more than one day, reuse it otherwise"""
+	story_clusters = sorted(story_clusters, key=lambda cluster: cluster["date"])
+	dates = list(dict.fromkeys(cluster["date"] for cluster in story_clusters))
+	titles = list(dict.fromkeys(title for cluster in story_clusters for title in cluster["titles"]))
+	urls = list(dict.fromkeys(url for cluster in story_clusters for url in cluster["urls"]))
+	if len(story_clusters) == 1:
+		summary = story_clusters[0]["summary"]
+	else:
+		content = "\n".join(
+			f"{cluster['date']} : {parse_summary(cluster['summary'])['title']}. "
+			f"{parse_summary(cluster['summary'])['summary']}"
+			for cluster in story_clusters
+		)
+		generated_summary = generator.run(
+			template_values={"content": content}, prompt_template=DIGEST_PROMPT_TEMPLATE
+		)
+		if not generated_summary.summary:
+			raise ValueError(f"No digest generated for the story of {titles[0]}")
+		summary = generated_summary.model_dump_json()
+	return {
+		"dates": dates,
+		"number_of_articles": sum(cluster["size"] for cluster in story_clusters),
+		"titles": titles,
+		"urls": urls,
+		"summary": summary,
+	}
+
+
+def build_digest(
+	daily_clusters: List[Dict],
+	centroids: np.array,
+	generator: LLamaCppGeneratorComponent,
+	merge_threshold: float = 0.25,
+	max_stories: int = 10,
+	max_concurrency: int = 1,
+) -> Tuple[List[Dict], List[Dict]]:
+	"""Merge the daily clusters in stories and summarize the max_stories largest ones"""
+	if not daily_clusters:
+		return [], []
+	sizes = np.array([cluster["size"] for cluster in daily_clusters])
+	stories = merge_daily_clusters(centroids, sizes, merge_threshold=merge_threshold)
+	story_clusters = {}
+	for story, cluster in zip(stories.tolist(), daily_clusters):
+		story_clusters.setdefault(story, []).append(cluster)
+	# the stories that lasted more days come first, then the larger ones
+	ranked_stories = sorted(
+		story_clusters.values(),
+		key=lambda clusters: (
+			len({cluster["date"] for cluster in clusters}),
+			sum(cluster["size"] for cluster in clusters),
+		),
+		reverse=True,
+	)[:max_stories]
+	logger.info(
+		f"merged {len(daily_clusters)} daily clusters in {len(story_clusters)} stories, "
+		f"summarizing {len(ranked_stories)}"
+	)
+	digest = []
+	failures = []
+	with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+		futures = [
+			executor.submit(summarize_story, clusters, generator) for clusters in ranked_stories
+		]
+		for clusters, future in zip(ranked_stories, futures):
+			try:
+				digest.append(future.result())
+			except Exception as e:
+				logger.error(f"Error summarizing the story of {clusters[0]['titles'][0]}: {e}")
+				failures.append({"titles": clusters[0]["titles"], "error": repr(e)})
+	return digest, failures
+
+
+parser = argparse.ArgumentParser()
+
+if __name__ == "__main__":
+	parser.add_argument("-e", "--environment", default="dev", help="the environment to use")
+	parser.add_argument(
+		"-s",
+		"--save_to_s3",
+		default=False,
+		help="where or not to save the file to the cloud storage",
+	)
+	parser.add_argument(
+		"-d", "--day_ago", default=0, type=int, help="the number of days ago of the last day"
+	)
+	parser.add_argument(
+		"-n", "--number_of_days", default=7, type=int, help="the number of days in the digest"
+	)
+	parser.add_argument(
+		"--merge_threshold",
+		default=0.25,
+		type=float,
+		help="the maximum cosine distance between the centroids of the clusters of a story",
+	)
+	parser.add_argument("--max_stories", default=10, type=int)
+	parser.add_argument(
+		"-p",
+		"--parallel_slots",
+		default=int(os.getenv("LLAMA_PARALLEL_SLOTS", 1)),
+		type=int,
+		help="the number of stories summarized at the same time, match the llama.cpp server --parallel",
+	)
+	args = parser.parse_args()
+	# the metrics of a failed run are written too, its retries and stage timings matter most
+	try:
+		end_date = datetime.now() - timedelta(days=args.day_ago)
+		dates = [
+			(end_date - timedelta(days=days)).strftime("%Y-%m-%d")
+			for days in reversed(range(args.number_of_days))
+		]
+		cloud_storage = BackBlazeCloudStorageColumnar(environment=args.environment)
+		download_bucket_name = os.getenv("DOWNLOAD_BUCKET_NAME")
+		upload_bucket_name = os.getenv("UPLOAD_BUCKET_NAME")
+		daily_clusters, centroids = load_daily_clusters(
+			cloud_storage, download_bucket_name, upload_bucket_name, dates
+		)
+		api_url = os.getenv("API_URL")
+		api_key = os.getenv("RUN_POD_API_KEY")
+		assert api_url is not None, "API_URL is not set"
+		assert api_key is not None, "RUN_POD_API_KEY is not set"
+		llama_cpp_generator = LLamaCppGeneratorComponent(
+			api_url=api_url, api_key=api_key, parallel_slots=args.parallel_slots
+		)
+		assert llama_cpp_generator._ping_api(), "API is n ot up"
+		digest, failures = build_digest(
+			daily_clusters,
+			centroids,
+			llama_cpp_generator,
+			merge_threshold=args.merge_threshold,
+			max_stories=args.max_stories,
+			max_concurrency=args.parallel_slots,
+		)
+		llama_cpp_generator.close()
+		local_file_name = f"news-digest-{dates[0]}-to-{dates[-1]}.json"
+		with open(local_file_name, "w") as temp_file:
+			json.dump(digest, temp_file, ensure_ascii=False, indent=4)
+		logger.info(f"digest saved at {local_file_name}")
+		if failures:
+			logger.warning(f"{len(failures)} stories failed: {failures}")
+		if args.save_to_s3:
+			cloud_storage.upload_file(
+				bucket_name=upload_bucket_name,
+				file_name=f"digests/{local_file_name}",
+				file_path=local_file_name,
+				metadata={"content_type": "application/json"},
+			)
+			logger.info("done uploading the digest")
+	finally:
+		metrics_recorder.write("digest")
@@ -1,15 +1,57 @@
 import json
+import time
+from functools import lru_cache
+from typing import Callable
 
 import requests
+from pydantic import ValidationError
 from requests.adapters import HTTPAdapter
-from urllib3.util import Retry
+from tenacity import (
+	RetryCallState,
+	Retrying,
+	retry_base,
+	retry_if_exception,
+	wait_random_exponential,
+)
 
 from src.llm.base import BaseGenerator
+from src.llm.grammar import compile_grammar
+from src.llm.prompts import SUMMARIZATION_PROMPT_TEMPLATE
+from src.llm.resilience import CircuitBreaker, CircuitOpenError, Deadline, DeadlineExceededError
+from src.llm.streaming import JsonObjectScanner, iter_server_sent_events, set_read_timeout
 from src.schemas import SummarySchemas
 from src.shared.logger import setup_logger
+from src.shared.metrics import metrics_recorder
 
 logger = setup_logger("llm_generator")
 
+RETRY_STATUSES = {429, 430, 500, 502, 503, 504}
+CONNECT_TIMEOUT_SECONDS = 10
+# no attempt is started with less time than this before the deadline
+MINIMUM_ATTEMPT_SECONDS = 5
+# the token estimate when the server cannot tokenize
+CHARACTERS_PER_TOKEN = 4
+# the estimate is off by up to a third on french news, below this share of a budget it is enough
+TOKEN_ESTIMATE_MARGIN = 0.6
+
+
+def is_retryable(error: BaseException) -> bool:
+	"""The connection errors, the timeouts and the overloaded or unavailable server statuses"""
+	if isinstance(error, requests.HTTPError):
+		return error.response is not None and error.response.status_code in RETRY_STATUSES
+	return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+
+def get_retry_after(error: BaseException | None) -> float | None:
+	"""The seconds of the Retry-After header of a 429 or 503 response, if any"""
+	response = getattr(error, "response", None)
+	if response is None:
+		return None
+	try:
+		return float(response.headers.get("Retry-After"))
+	except (TypeError, ValueError):
+		return None
+
 
 class LLamaCppGeneratorComponent(BaseGenerator):
 	"""
@@ -22,79 +64,361 @@ class LLamaCppGeneratorComponent(BaseGenerator):
 		api_key: str = None,
 		temperature: float = 0.3,
 		n_predict: int = 768,
+		parallel_slots: int = 1,
+		cache_prompt: bool = True,
+		time_budget: float | None = None,
+		request_budget: float = 600,
+		request_timeout: float = 300,
+		max_attempts: int = 8,
+		backoff_seconds: float = 2,
+		max_backoff_seconds: float = 60,
+		warm_up_seconds: float = 600,
+		circuit_breaker: CircuitBreaker | None = None,
+		stream: bool = False,
+		stall_seconds: float = 30,
+		max_tokens_per_prompt: int | None = None,
 	) -> None:
+		"""
+		The requests are retried with a jittered exponential backoff on the connection errors, the
+		timeouts and the 429/5xx statuses, until max_attempts or the earliest of the request budget and
+		the run time budget (seconds, None is no run budget). An attempt never waits for the server
+		longer than request_timeout nor than the remaining budget. The circuit breaker stops sending
+		requests to an endpoint failing again and again.
+
+		With stream the tokens are read as llama.cpp generates them, the request stops at the end of the
+		json object and an attempt fails if no token comes for stall_seconds.
+
+		max_tokens_per_prompt is the prompt size above which a cluster is summarized by parts, see
+		summarize_cluster, None sends every cluster in one prompt.
+		"""
 		self.api_url = api_url
 		self.system_prompt = " Vous etes un journaliste d'acutualité congolaise."
 		self.api_key = api_key
 		self.temperature = temperature
 		self.n_predict = n_predict
-		self.headers = {
-			"Content-Type": "application/json",
-			"Authorization": f"Bearer {self.api_key}" if self.api_key else "",
-		}
-		self._setup_session()
-
-	def _setup_session(self):
-		"""Initializes a requests.Session with an HTTPAdapter for retries."""
-		retry_strategy = Retry(
-			total=10,
-			backoff_factor=2,
-			status_forcelist=[429, 430, 500, 502, 503, 504],
-			allowed_methods=["POST", "GET"],
-			raise_on_status=False,
-		)
-		adapter = HTTPAdapter(max_retries=retry_strategy)
-		self.session = requests.Session()
-		self.session.mount("https://", adapter)
-		self.session.headers.update(self.headers)
-
-	def generate_response(self, chat_content: str) -> str:
-		"""
-		This function generates response using the Llamma.cpp api
-		"""
-		data = {
-			"prompt": chat_content,
+		self.parallel_slots = parallel_slots
+		self.cache_prompt = cache_prompt
+		self.run_deadline = Deadline(time_budget)
+		self.request_budget = request_budget
+		self.request_timeout = request_timeout
+		self.max_attempts = max_attempts
+		self.backoff_seconds = backoff_seconds
+		self.max_backoff_seconds = max_backoff_seconds
+		self.warm_up_seconds = warm_up_seconds
+		self.circuit_breaker = circuit_breaker or CircuitBreaker()
+		self.stream = stream
+		self.stall_seconds = stall_seconds
+		self.max_tokens_per_prompt = max_tokens_per_prompt
+		# the articles are counted once, the prompts of the parts of a cluster share them
+		self.count_tokens = lru_cache(maxsize=4096)(self._count_tokens)
+		self.generation_parameters = {
 			"n_predict": self.n_predict,
 			"temperature": self.temperature,
 			"top_k": 40,
 			"top_p": 0.90,
 			"stopped_eos": True,
 			"repeat_penalty": 1.05,
-			"cache_prompt": False,
 			"stop": [
 				"assistant",
 				"<|im_end|>",
 			],
 			"seed": 42,
-			"json_schema": SummarySchemas.model_json_schema(),
 		}
+		self.headers = {
+			"Content-Type": "application/json",
+			"Authorization": f"Bearer {self.api_key}" if self.api_key else "",
+		}
+		self.payload_prefix = self._compile_payload_prefix()
+		self._setup_session()
+
+	def _compile_payload_prefix(self) -> str:
+		"""
+		Serialize the request fields that do not change between the requests once.
+
+		The grammar of SummarySchemas is sent instead of its json schema, so the server does not convert
+		the schema again for every request. The prompt is spliced in by _build_payload.
+		"""
+		static_payload = {
+			**self.generation_parameters,
+			"cache_prompt": self.cache_prompt,
+			"grammar": compile_grammar(SummarySchemas),
+			"stream": self.stream,
+			# the prompt tokens and the prefill time come with every event, the stream is closed early
+			"timings_per_token": self.stream,
+		}
+		return json.dumps(static_payload)[:-1]
+
+	def _build_payload(self, chat_content: str, id_slot: int | None = None) -> str:
+		"""The json body of a completion request, only the prompt and the slot are serialized"""
+		slot_field = f', "id_slot": {int(id_slot)}' if id_slot is not None else ""
+		return f'{self.payload_prefix}, "prompt": {json.dumps(chat_content)}{slot_field}}}'
+
+	def _setup_session(self):
+		"""Initializes a requests.Session with a connection pool for http and https.
+
+		The connection pool holds one connection per server slot so concurrent requests share the session.
+		The retries are done by _retrying, so they follow the time budget.
+		"""
+		adapter = HTTPAdapter(
+			max_retries=0,
+			pool_connections=1,
+			pool_maxsize=self.parallel_slots,
+			pool_block=True,
+		)
+		self.session = requests.Session()
+		self.session.mount("https://", adapter)
+		self.session.mount("http://", adapter)
+		self.session.headers.update(self.headers)
+
+	def _retrying(
+		self,
+		remaining: Callable[[], float],
+		retry: retry_base,
+		max_attempts: int | None = None,
+		stage=None,
+	) -> Retrying:
+		"""Retry with full jitter, the wait never goes past the deadline and Retry-After is respected"""
+		jittered_wait = wait_random_exponential(
+			multiplier=self.backoff_seconds, max=self.max_backoff_seconds
+		)
+
+		def wait(retry_state: RetryCallState) -> float:
+			seconds = jittered_wait(retry_state)
+			retry_after = get_retry_after(retry_state.outcome.exception())
+			if retry_after is not None:
+				seconds = max(seconds, retry_after)
+			return max(min(seconds, remaining() - MINIMUM_ATTEMPT_SECONDS), 0)
+
+		def stop(retry_state: RetryCallState) -> bool:
+			if max_attempts is not None and retry_state.attempt_number >= max_attempts:
+				return True
+			return remaining() <= MINIMUM_ATTEMPT_SECONDS
+
+		def before_sleep(retry_state: RetryCallState) -> None:
+			logger.warning(
+				f"attempt {retry_state.attempt_number} failed with {retry_state.outcome.exception()!r}, "
+				f"retrying in {retry_state.next_action.sleep:.1f}s"
+			)
+			if stage is not None:
+				stage.add_retries(1)
+				stage.add(backoff_seconds=retry_state.next_action.sleep)
 
-		json_data = json.dumps(data)
+		return Retrying(stop=stop, wait=wait, retry=retry, before_sleep=before_sleep, reraise=True)
+
+	def _complete_once(self, json_data: str, remaining: Callable[[], float], stage) -> str:
+		"""Send one completion attempt through the circuit breaker and return the content"""
+		if remaining() <= 0:
+			raise DeadlineExceededError("no time left in the budget to send the request")
+		self.circuit_breaker.before_call()
 		try:
+			# the queue for a slot and the prefill are done before the first token, the stall timeout
+			# only starts with the first event of a stream
 			response = self.session.post(
 				f"{self.api_url}/completion",
 				data=json_data,
-				timeout=300,
+				timeout=(CONNECT_TIMEOUT_SECONDS, min(self.request_timeout, remaining())),
+				stream=self.stream,
 			)
 			response.raise_for_status()
-		except requests.exceptions.RequestException as err:
-			logger.error(f"Llama.cpp API request failed: {err}")
-			raise err
+			if self.stream:
+				content = self._read_stream(response, remaining, stage)
+			else:
+				completion = response.json()
+				stage.add(
+					prompt_tokens=completion.get("tokens_evaluated", 0),
+					tokens=completion.get("tokens_predicted", 0),
+					prompt_seconds=completion.get("timings", {}).get("prompt_ms", 0) / 1000,
+				)
+				content = completion["content"]
+		except requests.exceptions.RequestException as error:
+			if is_retryable(error):
+				self.circuit_breaker.record_failure()
+			else:
+				# the server answered, the request is wrong
+				self.circuit_breaker.record_success()
+			raise
+		except Exception:
+			# an unreadable answer or the deadline, a half open circuit must not wait for this probe forever
+			self.circuit_breaker.release_probe()
+			raise
+		self.circuit_breaker.record_success()
+		return content
+
+	def _read_stream(
+		self, response: requests.Response, remaining: Callable[[], float], stage
+	) -> str:
+		"""
+		Read the streamed tokens until the json object is complete or the server stops.
+
+		Closing the response cancels the generation on the server, so the tokens after the closing
+		brace are not generated. After the first event an attempt fails when no token comes for
+		stall_seconds.
+		"""
+		start = time.perf_counter()
+		first_token_seconds = None
+		number_of_tokens = 0
+		scanner = JsonObjectScanner()
+		content = None
+		prompt_tokens = 0
+		timings = {}
+		try:
+			for number_of_events, event in enumerate(iter_server_sent_events(response)):
+				if number_of_events == 0:
+					set_read_timeout(response, max(min(self.stall_seconds, remaining()), 1))
+				prompt_tokens = event.get("tokens_evaluated", prompt_tokens)
+				timings = event.get("timings", timings)
+				piece = event.get("content", "")
+				if piece:
+					number_of_tokens += 1
+					if first_token_seconds is None:
+						first_token_seconds = time.perf_counter() - start
+				if remaining() <= 0:
+					raise DeadlineExceededError("the time budget ended during the generation")
+				content = scanner.feed(piece)
+				if content is not None or event.get("stop"):
+					break
+		finally:
+			response.close()
+		if content is None:
+			content = scanner.get_text()
+		elapsed = time.perf_counter() - start
+		decode_seconds = elapsed - (first_token_seconds or 0)
+		tokens_per_second = number_of_tokens / decode_seconds if decode_seconds > 0 else 0
+		stage.add(
+			prompt_tokens=prompt_tokens or timings.get("prompt_n", 0),
+			tokens=number_of_tokens,
+			prompt_seconds=timings.get("prompt_ms", 0) / 1000,
+			first_token_seconds=first_token_seconds or 0,
+		)
+		logger.debug(
+			f"streamed {number_of_tokens} tokens, first token after {first_token_seconds or 0:.2f}s, "
+			f"{tokens_per_second:.1f} tokens/s"
+		)
+		return content
+
+	@staticmethod
+	def estimate_tokens(text: str) -> int:
+		"""The number of tokens of the text at CHARACTERS_PER_TOKEN, without a request"""
+		return len(text) // CHARACTERS_PER_TOKEN + 1
+
+	def _count_tokens(self, text: str) -> int:
+		"""
+		The number of tokens of the text with the server tokenizer, estimated if it does not answer.
+
+		The request goes through the circuit breaker but it is not retried, the estimate is good enough
+		for one text.
+		"""
+		try:
+			self.circuit_breaker.before_call()
+		except CircuitOpenError:
+			return self.estimate_tokens(text)
+		try:
+			with metrics_recorder.stage("llm.tokenize", characters=len(text)):
+				response = self.session.post(
+					f"{self.api_url}/tokenize",
+					data=json.dumps({"content": text}),
+					timeout=(
+						CONNECT_TIMEOUT_SECONDS,
+						max(min(self.request_timeout, self.run_deadline.remaining()), 1),
+					),
+				)
+				response.raise_for_status()
+				number_of_tokens = len(response.json()["tokens"])
+		except requests.exceptions.RequestException as e:
+			if is_retryable(e):
+				self.circuit_breaker.record_failure()
+			else:
+				self.circuit_breaker.record_success()
+			logger.warning(f"could not tokenize on the server, estimating the tokens: {e!r}")
+			return self.estimate_tokens(text)
+		except (KeyError, ValueError) as e:
+			self.circuit_breaker.release_probe()
+			logger.warning(f"could not tokenize on the server, estimating the tokens: {e!r}")
+			return self.estimate_tokens(text)
+		self.circuit_breaker.record_success()
+		return number_of_tokens
+
+	def count_prompt_overhead_tokens(
+		self, prompt_template: str = SUMMARIZATION_PROMPT_TEMPLATE
+	) -> int:
+		"""The tokens of the chat prompt without the content, the system prompt and the instructions"""
+		chat_input = self.generate_chat_input({"content": ""}, prompt_template)
+		return self.count_tokens(
+			self.apply_chat_template(messages=chat_input, add_generation_prompt=True)
+		)
+
+	def generate_response(self, chat_content: str, id_slot: int | None = None) -> SummarySchemas:
+		"""
+		This function generates response using the Llamma.cpp api
 
-		return response.json()["content"]
+		With id_slot the request is pinned to that server slot, so the slot keeps the KV cache
+		of the shared prompt prefix between requests. A content that is not a valid SummarySchemas
+		raises a pydantic ValidationError, it is not retried.
+		"""
+		json_data = self._build_payload(chat_content, id_slot)
+		request_deadline = Deadline(self.request_budget)
+
+		def remaining() -> float:
+			return min(request_deadline.remaining(), self.run_deadline.remaining())
+
+		with metrics_recorder.stage("llm.completion") as stage:
+			try:
+				for attempt in self._retrying(
+					remaining, retry_if_exception(is_retryable), self.max_attempts, stage
+				):
+					with attempt:
+						content = self._complete_once(json_data, remaining, stage)
+				# the characters of the prompts the server counted the tokens of, for report_condensation
+				stage.add(prompt_characters=len(chat_content))
+			except requests.exceptions.RequestException as err:
+				logger.error(f"Llama.cpp API request failed: {err}")
+				raise err
+			try:
+				return SummarySchemas.model_validate_json(content)
+			except ValidationError:
+				stage.add(invalid_outputs=1)
+				logger.error(f"Llama.cpp returned an invalid summary: {content[:200]!r}")
+				raise
 
-	def run(self, template_values: dict) -> str:
+	def run(
+		self,
+		template_values: dict,
+		id_slot: int | None = None,
+		prompt_template: str = SUMMARIZATION_PROMPT_TEMPLATE,
+	) -> SummarySchemas:
 		"""Generate response using the Llama.cpp api"""
-		chat_input = self.generate_chat_input(template_values)
+		chat_input = self.generate_chat_input(template_values, prompt_template)
 		chat_tokens = self.apply_chat_template(messages=chat_input, add_generation_prompt=True)
-		response = self.generate_response(chat_tokens)
+		response = self.generate_response(chat_tokens, id_slot=id_slot)
 		return response
 
 	def _ping_api(self) -> bool:
-		"""Ping the Llama.cpp api to check if it is up"""
+		"""
+		Ping the Llama.cpp api to check if it is up.
+
+		A serverless GPU answers 503 or drops the connection while it starts and loads the model, the
+		ping is retried with the backoff until the server is ready or warm_up_seconds are spent. The
+		other errors, like a wrong api key, fail at once.
+		"""
+		warm_up_deadline = Deadline(self.warm_up_seconds)
+
+		def remaining() -> float:
+			return min(warm_up_deadline.remaining(), self.run_deadline.remaining())
+
 		try:
-			response = self.session.get(f"{self.api_url}/ping", timeout=300)
-			response.raise_for_status()
+			with metrics_recorder.stage("llm.ping") as stage:
+				for attempt in self._retrying(
+					remaining, retry_if_exception(is_retryable), stage=stage
+				):
+					with attempt:
+						response = self.session.get(
+							f"{self.api_url}/ping",
+							timeout=(
+								CONNECT_TIMEOUT_SECONDS,
+								max(min(self.request_timeout, remaining()), 1),
+							),
+						)
+						response.raise_for_status()
 			return response.status_code == 200 and response.json().get("status") == "ok"
 		except Exception as e:
 			logger.error(f"Error during HTTP request with retries: {e}")
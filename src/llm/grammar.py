@@ -0,0 +1,53 @@
+import json
+from functools import lru_cache
+
+from pydantic import BaseModel
+
+# the same rules as the json schema conversion of the llama.cpp server
+SPACE_RULE = 'space ::= | " " | "\\n" [ \\t]{0,20}'
+PRIMITIVE_RULES = {
+	"string": [
+		'string ::= "\\"" char* "\\"" space',
+		'char ::= [^"\\\\\\x7F\\x00-\\x1F] | [\\\\] (["\\\\bfnrt] | "u" [0-9a-fA-F]{4})',
+	],
+	"integer": ['integer ::= ("-"? ([0-9] | [1-9] [0-9]{0,15})) space'],
+	"number": [
+		'number ::= ("-"? ([0-9] | [1-9] [0-9]{0,15})) ("." [0-9]+)? ([eE] [-+]? [0-9]+)? space'
+	],
+	"boolean": ['boolean ::= ("true" | "false") space'],
+}
+
+
+def json_schema_to_gbnf(json_schema: dict) -> str:
+	"""
+	Convert the json schema of a flat object to a llama.cpp GBNF grammar.
+
+	The properties are all required and generated in the order of the schema, their type is a string,
+	an integer, a number or a boolean.
+	"""
+	properties = json_schema.get("properties", {})
+	if json_schema.get("type") != "object" or not properties:
+		raise ValueError("only the json schema of an object with properties is supported")
+	missing = set(properties) - set(json_schema.get("required", []))
+	if missing:
+		raise ValueError(f"the properties {sorted(missing)} are not required")
+	members = []
+	types = []
+	for name, property_schema in properties.items():
+		property_type = property_schema.get("type")
+		if property_type not in PRIMITIVE_RULES:
+			raise ValueError(f"the property {name} of type {property_type} is not supported")
+		quoted_name = json.dumps(json.dumps(name))
+		members.append(f'{quoted_name} space ":" space {property_type}')
+		types.append(property_type)
+	root = ' "," space '.join(members)
+	rules = [f'root ::= "{{" space {root} "}}" space', SPACE_RULE]
+	for property_type in dict.fromkeys(types):
+		rules.extend(PRIMITIVE_RULES[property_type])
+	return "\n".join(rules) + "\n"
+
+
+@lru_cache(maxsize=None)
+def compile_grammar(model: type[BaseModel]) -> str:
+	"""Convert the json schema of the model to a grammar once per process"""
+	return json_schema_to_gbnf(model.model_json_schema())
@@ -1,47 +1,386 @@
 import argparse
 import json
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from itertools import groupby
-from typing import List
+from queue import Queue
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
 from unicodedata import normalize
 
-from src.llm.generator import LLamaCppGeneratorComponent
+from src.llm.generator import TOKEN_ESTIMATE_MARGIN, LLamaCppGeneratorComponent
+from src.llm.prompts import REDUCE_PROMPT_TEMPLATE, SUMMARIZATION_PROMPT_TEMPLATE
+from src.llm.summary_cache import SummaryCache
+from src.schemas import SummarySchemas
+from src.shared.cloud_storage.cloud_storage_columnar import BackBlazeCloudStorageColumnar
 from src.shared.cloud_storage.cloud_storage_non_numpy import BackBlazeCloudStorageCSV
+from src.shared.columnar import DUPLICATE_SEPARATOR
 from src.shared.logger import setup_logger
+from src.shared.metrics import metrics_recorder
 
 logger = setup_logger("summarizer_generative")
 
+CLUSTERS_FILE_DATE = re.compile(r"-to-(\d{4}-\d{2}-\d{2})\.\w+$")
 
-def summarize_documents(data: List, generator: LLamaCppGeneratorComponent):
-	summaries = []
+
+def group_documents_by_label(data: Iterable[Dict]) -> Iterator[Tuple[str, List[Dict]]]:
+	"""Group the clustered news by label, in label order"""
 
 	def sort_function(x):
 		return x["labels"]
 
 	sorted_data = sorted(data, key=sort_function)
-	grouped_data = groupby(sorted_data, key=sort_function)
-	for label, group in grouped_data:
-		news_data = list(group)
-		titles = [news["title"] for news in news_data]
-		urls = [news["url"] for news in news_data]
-		content = "\n".join([news["content"] for news in news_data])
-		content = normalize("NFKD", content)
-		try:
-			summary = generator.run(template_values={"content": content})
-			logger.info(f"Done summarizing the documents  {label}")
-			if summary:
-				news_data = {"titles": titles, "urls": urls, "summary": summary}
-				summaries.append(news_data)
-			else:
-				logger.warning(f"No summary generated for documents with label {label}")
-				continue
-		except Exception as e:
-			logger.error(f"Error summarizing documents for label {label}: {e}")
+	for label, group in groupby(sorted_data, key=sort_function):
+		yield label, list(group)
+
+
+def expand_duplicates(news_data: List[Dict], column: str) -> List[str]:
+	"""List the values of the column, with the values of the near duplicates removed before the clustering"""
+	values = []
+	for news in news_data:
+		duplicates = news.get(f"duplicate_{column}s")
+		values.extend(duplicates.split(DUPLICATE_SEPARATOR) if duplicates else [news[column]])
+	return list(dict.fromkeys(values))
+
+
+def get_clustering_date(file_name: str, default: str) -> str:
+	"""
+	The date of the clusters in the file name, news-clusters-<upload day>-to-<date>.
+
+	The summaries are saved under this date, like the centroids of the clusters, so the digest can
+	match them.
+	"""
+	match = CLUSTERS_FILE_DATE.search(file_name)
+	return match.group(1) if match else default
+
+
+# the summaries of the parts are summarized again at most this number of times
+MAX_REDUCE_DEPTH = 3
+
+
+def get_cluster_pieces(news_data: List[Dict]) -> List[str]:
+	"""The content of the news, only their selected sentences when the clustering condensed them"""
+	if any(news.get("condensed_content") for news in news_data):
+		return [news["condensed_content"] for news in news_data if news.get("condensed_content")]
+	return [news["content"] for news in news_data]
+
+
+def split_in_parts(
+	pieces: List[str], generator: LLamaCppGeneratorComponent, max_tokens: int
+) -> List[str]:
+	"""
+	Group the consecutive pieces in parts of at most max_tokens.
+
+	A piece longer than max_tokens is cut in words first, its parts are estimated from its token count.
+	"""
+	sized_pieces = []
+	for piece in pieces:
+		piece_tokens = generator.count_tokens(piece)
+		if piece_tokens <= max_tokens:
+			sized_pieces.append((piece, piece_tokens))
 			continue
-		generator.close()
-	logger.info("Done summarizing all the documents")
-	return summaries
+		words = piece.split()
+		number_of_cuts = -(-piece_tokens // max(int(max_tokens * 0.9), 1))
+		words_per_cut = -(-len(words) // number_of_cuts)
+		for start in range(0, len(words), words_per_cut):
+			cut = words[start : start + words_per_cut]
+			sized_pieces.append((" ".join(cut), piece_tokens * len(cut) // len(words) + 1))
+	parts = []
+	part_pieces = []
+	part_tokens = 0
+	for piece, piece_tokens in sized_pieces:
+		if part_pieces and part_tokens + piece_tokens + 1 > max_tokens:
+			parts.append("\n".join(part_pieces))
+			part_pieces, part_tokens = [], 0
+		part_pieces.append(piece)
+		part_tokens += piece_tokens + 1
+	parts.append("\n".join(part_pieces))
+	return parts
+
+
+def map_reduce_summarize(
+	pieces: List[str],
+	generator: LLamaCppGeneratorComponent,
+	generate: Callable[[str, str], SummarySchemas],
+	prompt_template: str = SUMMARIZATION_PROMPT_TEMPLATE,
+	depth: int = 0,
+) -> SummarySchemas:
+	"""
+	Summarize the pieces in one prompt when they fit in generator.max_tokens_per_prompt.
+
+	Otherwise the pieces are split in parts summarized in parallel (map), and the summaries of the parts
+	are summarized together with REDUCE_PROMPT_TEMPLATE (reduce), by parts again if they do not fit.
+	The requests in flight are bounded by generate, which takes a slot shared with the other clusters.
+	"""
+	content = "\n".join(pieces)
+	if generator.max_tokens_per_prompt is None or depth >= MAX_REDUCE_DEPTH:
+		return generate(content, prompt_template)
+	max_tokens = generator.max_tokens_per_prompt - generator.count_prompt_overhead_tokens(
+		prompt_template
+	)
+	if max_tokens <= 0:
+		raise ValueError(
+			f"max_tokens_per_prompt {generator.max_tokens_per_prompt} leaves no room for the content"
+		)
+	# the server counts the tokens only of the contents close to the budget, in one request
+	if generator.estimate_tokens(content) <= max_tokens * TOKEN_ESTIMATE_MARGIN:
+		return generate(content, prompt_template)
+	content_tokens = generator.count_tokens(content)
+	if content_tokens <= max_tokens:
+		return generate(content, prompt_template)
+	parts = split_in_parts(pieces, generator, max_tokens)
+	logger.info(
+		f"the content of {content_tokens} tokens is over {max_tokens} tokens, "
+		f"summarizing it in {len(parts)} parts"
+	)
+	metrics_recorder.get_stage("summarize.map_reduce").add(prompts=1, parts=len(parts))
+	with ThreadPoolExecutor(max_workers=min(generator.parallel_slots, len(parts))) as executor:
+		part_summaries = list(executor.map(lambda part: generate(part, prompt_template), parts))
+	summaries = [f"{part_summary.title}. {part_summary.summary}" for part_summary in part_summaries]
+	return map_reduce_summarize(summaries, generator, generate, REDUCE_PROMPT_TEMPLATE, depth + 1)
+
+
+def summarize_cluster(
+	label: str,
+	news_data: List[Dict],
+	generator: LLamaCppGeneratorComponent,
+	free_slots: Queue | None = None,
+	summary_cache: SummaryCache | None = None,
+	pin_slots: bool = False,
+) -> Dict:
+	"""
+	Summarize the news of one cluster, raise a ValueError if the generator returns nothing.
+
+	When free_slots is given every request, map and reduce included, takes a server slot id from it and
+	gives it back once done, so the clusters sharing free_slots never send more requests than its slots.
+	With pin_slots the request is sent to that slot.
+	When summary_cache is given a cached summary is reused and a new one is written as soon as it is done.
+	"""
+	titles = expand_duplicates(news_data, "title")
+	urls = expand_duplicates(news_data, "url")
+	pieces = [normalize("NFKD", piece) for piece in get_cluster_pieces(news_data)]
+	content = "\n".join(pieces)
+	cache_key = None
+	if summary_cache is not None:
+		cache_key = SummaryCache.compute_key(
+			content,
+			SUMMARIZATION_PROMPT_TEMPLATE,
+			{**generator.generation_parameters, "system_prompt": generator.system_prompt},
+		)
+		cached_summary = summary_cache.get(cache_key)
+		if cached_summary is not None:
+			logger.info(f"Found the summary of the documents {label} in the cache")
+			return {
+				"label": label,
+				"titles": titles,
+				"urls": urls,
+				"summary": cached_summary["summary"],
+			}
+	# the full content would have been sent without the condensation, the cached clusters are not counted
+	full_content = "\n".join([news["content"] for news in news_data])
+	is_condensed = any(news.get("condensed_content") for news in news_data)
+	metrics_recorder.get_stage("summarize.prompt").add(
+		clusters=1,
+		content_characters=len(normalize("NFKD", full_content)) if is_condensed else len(content),
+		prompt_characters=len(content),
+	)
+
+	def generate(prompt_content: str, prompt_template: str) -> SummarySchemas:
+		if free_slots is None:
+			return generator.run({"content": prompt_content}, prompt_template=prompt_template)
+		id_slot = free_slots.get()
+		try:
+			return generator.run(
+				{"content": prompt_content},
+				id_slot=id_slot if pin_slots else None,
+				prompt_template=prompt_template,
+			)
+		finally:
+			free_slots.put(id_slot)
+
+	generated_summary = map_reduce_summarize(pieces, generator, generate)
+	if not generated_summary.summary:
+		raise ValueError(f"No summary generated for documents with label {label}")
+	# the summaries file keeps the json text of SummarySchemas
+	summary = generated_summary.model_dump_json()
+	if summary_cache is not None:
+		summary_cache.put(cache_key, {"summary": summary})
+	logger.info(f"Done summarizing the documents  {label}")
+	return {"label": label, "titles": titles, "urls": urls, "summary": summary}
+
+
+def report_condensation() -> None:
+	"""
+	Estimate the prompt tokens and the prefill time saved by the condensation of the clusters.
+
+	The characters are converted with the tokens per character of the requests sent, the map and the
+	reduce requests of a cluster each count their own prompt, and the tokens with the prefill time per
+	token reported by the server.
+	"""
+	prompt_stage = metrics_recorder.get_stage("summarize.prompt")
+	completion_stage = metrics_recorder.get_stage("llm.completion")
+	request_characters = completion_stage.counters.get("prompt_characters", 0)
+	prompt_tokens = completion_stage.counters.get("prompt_tokens", 0)
+	if not prompt_stage.counters.get("clusters") or not request_characters or not prompt_tokens:
+		return
+	saved_characters = (
+		prompt_stage.counters["content_characters"] - prompt_stage.counters["prompt_characters"]
+	)
+	saved_tokens = saved_characters * prompt_tokens / request_characters
+	prefill_seconds_per_token = completion_stage.counters.get("prompt_seconds", 0) / prompt_tokens
+	saved_seconds = saved_tokens * prefill_seconds_per_token
+	clusters = prompt_stage.counters["clusters"]
+	prompt_stage.add(saved_prompt_tokens=saved_tokens, saved_prefill_seconds=saved_seconds)
+	logger.info(
+		f"the condensation saved about {saved_tokens / clusters:.0f} prompt tokens and "
+		f"{saved_seconds / clusters:.2f}s of prefill per cluster"
+	)
+
+
+def summarize_groups(
+	groups: Iterable[Tuple[str, List[Dict]]],
+	generator: LLamaCppGeneratorComponent,
+	max_concurrency: int = 1,
+	pin_slots: bool = False,
+	summary_cache: SummaryCache | None = None,
+) -> Tuple[List[Dict], List[Dict]]:
+	"""
+	Summarize every (label, news) group, with up to max_concurrency requests in flight on the generator session.
+
+	A group is submitted as soon as the iterator yields it, so a streamed file is summarized while it downloads.
+	Every request takes one of max_concurrency slot ids while it runs, with pin_slots it is sent to that
+	server slot, from 0 to max_concurrency - 1.
+	With summary_cache only the clusters without a cached summary are sent to the generator.
+	Returns the summaries and the failures, both in the order of the groups.
+	"""
+	summaries = []
+	failures = []
+	free_slots = Queue()
+	for id_slot in range(max_concurrency):
+		free_slots.put(id_slot)
+	with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+		futures = {
+			label: executor.submit(
+				summarize_cluster,
+				label,
+				news_data,
+				generator,
+				free_slots,
+				summary_cache,
+				pin_slots,
+			)
+			for label, news_data in groups
+		}
+		for label, future in futures.items():
+			try:
+				summaries.append(future.result())
+			except Exception as e:
+				logger.error(f"Error summarizing documents for label {label}: {e}")
+				failures.append({"label": label, "error": repr(e)})
+	logger.info(
+		f"Done summarizing all the documents, {len(summaries)} summaries and {len(failures)} failures"
+	)
+	report_condensation()
+	return summaries, failures
+
+
+def summarize_documents(
+	data: Iterable[Dict],
+	generator: LLamaCppGeneratorComponent,
+	max_concurrency: int = 1,
+	pin_slots: bool = False,
+	summary_cache: SummaryCache | None = None,
+) -> Tuple[List[Dict], List[Dict]]:
+	"""Group the clustered news by label and summarize every cluster, see summarize_groups"""
+	return summarize_groups(
+		group_documents_by_label(data),
+		generator,
+		max_concurrency=max_concurrency,
+		pin_slots=pin_slots,
+		summary_cache=summary_cache,
+	)
+
+
+def add_generator_arguments(parser: argparse.ArgumentParser) -> None:
+	"""The options of the llama.cpp generator, shared by the generator job and the pipeline"""
+	parser.add_argument(
+		"-p",
+		"--parallel_slots",
+		default=int(os.getenv("LLAMA_PARALLEL_SLOTS", 1)),
+		type=int,
+		help="the number of clusters summarized at the same time, match the llama.cpp server --parallel",
+	)
+	parser.add_argument(
+		"--pin_slots",
+		action="store_true",
+		help="pin every in flight request to its own server slot to reuse the prompt prefix cache",
+	)
+	parser.add_argument(
+		"--no_cache_prompt",
+		action="store_true",
+		help="ask llama.cpp to process the whole prompt again for every request",
+	)
+	parser.add_argument(
+		"--time_budget_minutes",
+		type=float,
+		default=None,
+		help="no request is sent or retried after this time, the remaining clusters fail",
+	)
+	parser.add_argument(
+		"--request_budget_seconds",
+		type=float,
+		default=600,
+		help="the time budget of one cluster, with its retries",
+	)
+	parser.add_argument(
+		"--warm_up_seconds",
+		type=float,
+		default=600,
+		help="how long to wait for a cold starting server to answer the ping",
+	)
+	parser.add_argument(
+		"--max_attempts",
+		type=int,
+		default=8,
+		help="the attempts of a request, with the first one",
+	)
+	parser.add_argument(
+		"--max_tokens_per_prompt",
+		type=int,
+		default=int(os.getenv("LLAMA_MAX_TOKENS_PER_PROMPT", 6144)),
+		help="summarize the larger clusters by parts, the context of a server slot minus n_predict, 0 disables it",
+	)
+	parser.add_argument(
+		"--stream_tokens",
+		action="store_true",
+		help="read the tokens as they are generated and stop at the end of the json summary",
+	)
+	parser.add_argument(
+		"--stall_seconds",
+		type=float,
+		default=30,
+		help="with --stream_tokens, retry the request when no token comes for this time",
+	)
+
+
+def make_generator(
+	args: argparse.Namespace, api_url: str, api_key: str | None
+) -> LLamaCppGeneratorComponent:
+	"""The generator of the options of add_generator_arguments"""
+	return LLamaCppGeneratorComponent(
+		api_url=api_url,
+		api_key=api_key,
+		parallel_slots=args.parallel_slots,
+		cache_prompt=not args.no_cache_prompt,
+		time_budget=args.time_budget_minutes * 60 if args.time_budget_minutes else None,
+		request_budget=args.request_budget_seconds,
+		max_attempts=args.max_attempts,
+		warm_up_seconds=args.warm_up_seconds,
+		stream=args.stream_tokens,
+		stall_seconds=args.stall_seconds,
+		max_tokens_per_prompt=args.max_tokens_per_prompt or None,
+	)
 
 
 parser = argparse.ArgumentParser()
@@ -66,36 +405,85 @@ if __name__ == "__main__":
 		type=int,
 		help="the number of days ago when to save the file, if we run on 23/01/2013 and this is 2 the file will be saved with date 21/01/2013",
 	)
+	parser.add_argument(
+		"-c",
+		"--cache_directory",
+		default="cache/summaries",
+		help="where to checkpoint the cluster summaries, pass an empty string to disable it",
+	)
+	parser.add_argument(
+		"--input_format",
+		default="npz",
+		choices=["npz", "csv"],
+		help="npz is the typed columnar handoff, csv is the legacy pipe separated file",
+	)
+	parser.add_argument(
+		"--no_stream",
+		action="store_true",
+		help="download the whole file before summarizing instead of reading the download stream",
+	)
+	add_generator_arguments(parser)
 	args = parser.parse_args()
-	cloud_storage = BackBlazeCloudStorageCSV(environment=args.environment)
-	date = (datetime.now() - timedelta(days=args.day_ago)).strftime("%Y-%m-%d")
-	if args.file_name:
-		today_file_name = args.file_name
-	else:
-		today_file_name = cloud_storage.generate_file_name(date=date)
-	download_bucket_name = os.getenv("DOWNLOAD_BUCKET_NAME")
-	upload_bucket_name = os.getenv("UPLOAD_BUCKET_NAME")
-	logger.info(f"downloading form {today_file_name}")
-	api_url = os.getenv("API_URL")
-	api_key = os.getenv("RUN_POD_API_KEY")
-	assert api_url is not None, "API_URL is not set"
-	assert api_key is not None, "RUN_POD_API_KEY is not set"
-	data = cloud_storage.read_file_as_list(
-		bucket_name=download_bucket_name, file_name=today_file_name
-	)
-	logger.info("done downloading the document")
-	llama_cpp_generator = LLamaCppGeneratorComponent(api_url=api_url, api_key=api_key)
-	assert llama_cpp_generator._ping_api(), "API is n ot up"
-	summaries = summarize_documents(data, llama_cpp_generator)
-	local_file_name = f"news-summaries-{date}.json"
-	with open(local_file_name, "w") as temp_file:
-		json.dump(summaries, temp_file, ensure_ascii=False, indent=4)
-	logger.info(f"summaries saved at {local_file_name}")
-	if args.save_to_s3:
-		cloud_storage.upload_file(
-			bucket_name=upload_bucket_name,
-			file_name=f"summaries/news-summaries-{date}.json",
-			file_path=local_file_name,
-			metadata={"content_type": "application/json"},
-		)
-		logger.info("done uploading the document")
+	# the metrics of a failed run are written too, its retries and stage timings matter most
+	try:
+		if args.input_format == "npz":
+			cloud_storage = BackBlazeCloudStorageColumnar(environment=args.environment)
+		else:
+			cloud_storage = BackBlazeCloudStorageCSV(environment=args.environment)
+		date = (datetime.now() - timedelta(days=args.day_ago)).strftime("%Y-%m-%d")
+		if args.file_name:
+			today_file_name = args.file_name
+			date = get_clustering_date(args.file_name, default=date)
+		else:
+			today_file_name = cloud_storage.generate_file_name(
+				date=date, extension=args.input_format
+			)
+		download_bucket_name = os.getenv("DOWNLOAD_BUCKET_NAME")
+		upload_bucket_name = os.getenv("UPLOAD_BUCKET_NAME")
+		logger.info(f"downloading form {today_file_name}")
+		api_url = os.getenv("API_URL")
+		api_key = os.getenv("RUN_POD_API_KEY")
+		assert api_url is not None, "API_URL is not set"
+		assert api_key is not None, "RUN_POD_API_KEY is not set"
+		llama_cpp_generator = make_generator(args, api_url=api_url, api_key=api_key)
+		assert llama_cpp_generator._ping_api(), "API is n ot up"
+		summary_cache = SummaryCache(args.cache_directory) if args.cache_directory else None
+		if args.input_format == "csv" and args.no_stream:
+			data = cloud_storage.read_file_as_list(
+				bucket_name=download_bucket_name, file_name=today_file_name
+			)
+			logger.info("done downloading the document")
+			groups = group_documents_by_label(data)
+		else:
+			groups = cloud_storage.iter_label_groups(
+				bucket_name=download_bucket_name, file_name=today_file_name
+			)
+		with metrics_recorder.stage("summarize") as stage:
+			summaries, failures = summarize_groups(
+				groups,
+				llama_cpp_generator,
+				max_concurrency=args.parallel_slots,
+				pin_slots=args.pin_slots,
+				summary_cache=summary_cache,
+			)
+			stage.add(clusters=len(summaries), failures=len(failures))
+		llama_cpp_generator.close()
+		local_file_name = f"news-summaries-{date}.json"
+		with open(local_file_name, "w") as temp_file:
+			json.dump(summaries, temp_file, ensure_ascii=False, indent=4)
+		logger.info(f"summaries saved at {local_file_name}")
+		if failures:
+			failures_file_name = f"news-summaries-{date}-failures.json"
+			with open(failures_file_name, "w") as temp_file:
+				json.dump(failures, temp_file, ensure_ascii=False, indent=4)
+			logger.warning(f"{len(failures)} clusters failed, see {failures_file_name}")
+		if args.save_to_s3:
+			cloud_storage.upload_file(
+				bucket_name=upload_bucket_name,
+				file_name=f"summaries/news-summaries-{date}.json",
+				file_path=local_file_name,
+				metadata={"content_type": "application/json"},
+			)
+			logger.info("done uploading the document")
+	finally:
+		metrics_recorder.write("generator")
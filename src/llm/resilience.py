@@ -0,0 +1,84 @@
+import math
+import threading
+import time
+
+from src.shared.logger import setup_logger
+
+logger = setup_logger("llm_generator")
+
+
+class DeadlineExceededError(TimeoutError):
+	"""The time budget of the run or of the request is spent"""
+
+
+class CircuitOpenError(RuntimeError):
+	"""The endpoint failed too many times in a row, the requests are not sent until it cools down"""
+
+
+class Deadline:
+	"""A point in time after which no request is sent, None is no deadline"""
+
+	def __init__(self, seconds: float | None) -> None:
+		self.seconds = seconds
+		self.expires_at = None if seconds is None else time.monotonic() + seconds
+
+	def remaining(self) -> float:
+		if self.expires_at is None:
+			return math.inf
+		return max(self.expires_at - time.monotonic(), 0)
+
+	def expired(self) -> bool:
+		return self.remaining() <= 0
+
+
+class CircuitBreaker:
+	"""
+	Stop calling an endpoint after failure_threshold consecutive failures.
+
+	The circuit stays open reset_seconds, then one request goes through (half open): it closes the
+	circuit if it succeeds and opens it again if it fails. It is shared by the threads of a run.
+	"""
+
+	def __init__(self, failure_threshold: int = 5, reset_seconds: float = 60) -> None:
+		self.failure_threshold = failure_threshold
+		self.reset_seconds = reset_seconds
+		self.consecutive_failures = 0
+		self.opened_at = None
+		self.is_probing = False
+		self.lock = threading.Lock()
+
+	def before_call(self) -> None:
+		"""Raise a CircuitOpenError when the circuit is open, let one probe through after reset_seconds"""
+		with self.lock:
+			if self.opened_at is None:
+				return
+			if time.monotonic() - self.opened_at < self.reset_seconds or self.is_probing:
+				raise CircuitOpenError(
+					f"the circuit is open after {self.consecutive_failures} consecutive failures"
+				)
+			self.is_probing = True
+
+	def release_probe(self) -> None:
+		"""Let a new probe through, the call failed for a reason that says nothing about the endpoint"""
+		with self.lock:
+			self.is_probing = False
+
+	def record_success(self) -> None:
+		with self.lock:
+			if self.opened_at is not None:
+				logger.info("the endpoint answered again, closing the circuit")
+			self.consecutive_failures = 0
+			self.opened_at = None
+			self.is_probing = False
+
+	def record_failure(self) -> None:
+		with self.lock:
+			self.consecutive_failures += 1
+			if self.is_probing or self.consecutive_failures >= self.failure_threshold:
+				if self.opened_at is None or self.is_probing:
+					logger.warning(
+						f"opening the circuit for {self.reset_seconds}s after "
+						f"{self.consecutive_failures} consecutive failures"
+					)
+				self.opened_at = time.monotonic()
+				self.is_probing = False
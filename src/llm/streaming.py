@@ -0,0 +1,82 @@
+import json
+from typing import Iterator
+
+import requests
+
+SSE_DATA_PREFIX = "data: "
+
+
+class JsonObjectScanner:
+	"""
+	Find the end of the first json object of a text received piece by piece.
+
+	It follows the braces outside of the strings, so it does not parse the text again at every piece.
+	"""
+
+	def __init__(self) -> None:
+		self.text = []
+		self.depth = 0
+		self.is_in_string = False
+		self.is_escaped = False
+		self.has_started = False
+
+	def feed(self, piece: str) -> str | None:
+		"""Add the piece, return the text up to the closing brace once the object is complete"""
+		for position, character in enumerate(piece):
+			if self.is_in_string:
+				if self.is_escaped:
+					self.is_escaped = False
+				elif character == "\\":
+					self.is_escaped = True
+				elif character == '"':
+					self.is_in_string = False
+			elif character == '"':
+				self.is_in_string = True
+			elif character == "{":
+				self.depth += 1
+				self.has_started = True
+			elif character == "}" and self.has_started:
+				self.depth -= 1
+				if self.depth == 0:
+					self.text.append(piece[: position + 1])
+					return "".join(self.text)
+		self.text.append(piece)
+		return None
+
+	def get_text(self) -> str:
+		return "".join(self.text)
+
+
+def set_read_timeout(response: requests.Response, seconds: float) -> None:
+	"""
+	Change the read timeout of the socket of a streamed response, for the next reads.
+
+	requests applies the read timeout of the request to every read of the body, there is no other way
+	to wait longer for the first token than between two tokens. The socket is the one of the urllib3
+	connection, or the one of the http.client response when the connection was released to it (a
+	response that closes the connection). Nothing is done without a socket.
+	"""
+	sock = getattr(getattr(response.raw, "connection", None), "sock", None)
+	if sock is None:
+		http_client_response = getattr(response.raw, "_fp", None)
+		socket_reader = getattr(getattr(http_client_response, "fp", None), "raw", None)
+		sock = getattr(socket_reader, "_sock", None)
+	if sock is not None:
+		sock.settimeout(seconds)
+
+
+def iter_server_sent_events(response: requests.Response) -> Iterator[dict]:
+	"""
+	Yield the json payload of every data line of a llama.cpp stream.
+
+	The lines are decoded as utf-8: llama.cpp sends text/event-stream without a charset, requests would
+	decode them as ISO-8859-1.
+	"""
+	for raw_line in response.iter_lines():
+		line = raw_line.decode("utf-8")
+		if not line or not line.startswith(SSE_DATA_PREFIX):
+			continue
+		payload = line[len(SSE_DATA_PREFIX) :]
+		if payload == "[DONE]":
+			return
+		yield json.loads(payload)
@@ -0,0 +1,58 @@
+import json
+import os
+import threading
+from hashlib import sha256
+from pathlib import Path
+from typing import Dict
+
+from src.shared.logger import setup_logger
+
+logger = setup_logger("summary_cache")
+
+
+class SummaryCache:
+	"""
+	Local cache of the cluster summaries, one json file per cluster.
+
+	The key is a hash of the normalized cluster content, the prompt template and the generation parameters,
+	so a summary is only reused when the same request would be sent to the server again.
+	"""
+
+	def __init__(self, cache_directory: str | Path) -> None:
+		self.cache_directory = Path(cache_directory)
+		self.cache_directory.mkdir(parents=True, exist_ok=True)
+
+	@staticmethod
+	def compute_key(content: str, prompt_template: str, generation_parameters: Dict) -> str:
+		"""Hash what decides the summary, the whitespaces in the content do not change the key"""
+		key_data = {
+			"content": " ".join(content.split()),
+			"prompt_template": prompt_template,
+			"generation_parameters": generation_parameters,
+		}
+		return sha256(
+			json.dumps(key_data, sort_keys=True, ensure_ascii=False).encode("utf-8")
+		).hexdigest()
+
+	def _path(self, key: str) -> Path:
+		return self.cache_directory.joinpath(f"{key}.json")
+
+	def get(self, key: str) -> Dict | None:
+		"""Return the cached summary or None, an unreadable file counts as a miss"""
+		path = self._path(key)
+		if not path.exists():
+			return None
+		try:
+			with open(path, encoding="utf-8") as cache_file:
+				return json.load(cache_file)
+		except (OSError, json.JSONDecodeError) as e:
+			logger.warning(f"ignoring the unreadable cached summary {path}: {e}")
+			return None
+
+	def put(self, key: str, summary: Dict) -> None:
+		"""Write the summary as soon as it is generated, the rename makes the write atomic"""
+		path = self._path(key)
+		temporary_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+		with open(temporary_path, "w", encoding="utf-8") as cache_file:
+			json.dump(summary, cache_file, ensure_ascii=False)
+		os.replace(temporary_path, path)
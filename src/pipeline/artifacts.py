@@ -0,0 +1,130 @@
+import json
+import os
+import shutil
+import threading
+import time
+from datetime import datetime
+from hashlib import sha256
+from pathlib import Path
+from typing import Dict
+
+import numpy as np
+import pandas as pd
+
+from src.shared.cloud_storage.cloud_storage import dataframe_to_columns
+from src.shared.columnar import ColumnarFile, write_columns
+from src.shared.logger import setup_logger
+
+logger = setup_logger("pipeline_artifacts")
+
+ARTIFACT_SUFFIXES = {"frame": ".npz", "array": ".npy", "json": ".json"}
+
+
+class StageArtifacts:
+	"""
+	The outputs of the pipeline stages of one day, with a manifest of the key of every output.
+
+	The key of a stage is the hash of its parameters and of the key of its input, so an output is only
+	reused by a run that would compute it from the same input with the same parameters. The outputs are
+	written with a rename, a stage stopped in the middle leaves the previous output.
+
+	The directories of the other days, next to this one, are removed at startup when their manifest was
+	not written for max_age_days, None keeps them.
+	"""
+
+	def __init__(self, directory: str | Path, max_age_days: float | None = None) -> None:
+		self.directory = Path(directory)
+		self.directory.mkdir(parents=True, exist_ok=True)
+		self.max_age_days = max_age_days
+		self.manifest_path = self.directory.joinpath("manifest.json")
+		self.manifest = self.load_manifest()
+		if max_age_days is not None:
+			self.prune()
+
+	def prune(self) -> int:
+		"""Remove the stage outputs of the days not written for max_age_days, return their number"""
+		oldest_allowed = time.time() - self.max_age_days * 24 * 3600
+		removed = 0
+		for day_directory in self.directory.parent.iterdir():
+			manifest_path = day_directory.joinpath("manifest.json")
+			if day_directory == self.directory or not manifest_path.exists():
+				continue
+			if manifest_path.stat().st_mtime < oldest_allowed:
+				shutil.rmtree(day_directory, ignore_errors=True)
+				removed += 1
+		if removed:
+			logger.info(
+				f"removed the stage outputs of {removed} days older than {self.max_age_days} days"
+			)
+		return removed
+
+	def load_manifest(self) -> Dict:
+		if not self.manifest_path.exists():
+			return {}
+		try:
+			with open(self.manifest_path, encoding="utf-8") as manifest_file:
+				return json.load(manifest_file)
+		except (OSError, json.JSONDecodeError) as e:
+			logger.warning(f"ignoring the unreadable manifest {self.manifest_path}: {e}")
+			return {}
+
+	@staticmethod
+	def compute_key(stage: str, parameters: Dict, input_key: str | None = None) -> str:
+		key_data = {"stage": stage, "parameters": parameters, "input_key": input_key}
+		return sha256(json.dumps(key_data, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+	def get_path(self, stage: str, kind: str) -> Path:
+		return self.directory.joinpath(f"{stage}{ARTIFACT_SUFFIXES[kind]}")
+
+	def has(self, stage: str, key: str) -> bool:
+		"""Whether the output of the stage was computed with this key and is still on disk"""
+		entry = self.manifest.get(stage)
+		return (
+			entry is not None
+			and entry["key"] == key
+			and self.get_path(stage, entry["kind"]).exists()
+		)
+
+	def load(self, stage: str) -> pd.DataFrame | np.ndarray | Dict | list:
+		kind = self.manifest[stage]["kind"]
+		path = self.get_path(stage, kind)
+		if kind == "frame":
+			columnar_file = ColumnarFile(path)
+			frame = pd.DataFrame(columnar_file.read())
+			columnar_file.close()
+			return frame
+		if kind == "array":
+			return np.load(path, allow_pickle=False)
+		with open(path, encoding="utf-8") as artifact_file:
+			return json.load(artifact_file)
+
+	def save(
+		self,
+		stage: str,
+		key: str,
+		kind: str,
+		value: pd.DataFrame | np.ndarray | Dict | list,
+		seconds: float,
+	) -> None:
+		"""Write the output of the stage, then its key in the manifest"""
+		path = self.get_path(stage, kind)
+		temporary_path = path.with_name(f"{path.stem}.{os.getpid()}.{threading.get_ident()}.tmp")
+		with open(temporary_path, "wb") as artifact_file:
+			if kind == "frame":
+				write_columns(artifact_file, dataframe_to_columns(value))
+			elif kind == "array":
+				np.save(artifact_file, value, allow_pickle=False)
+			else:
+				artifact_file.write(json.dumps(value, ensure_ascii=False, indent=4).encode("utf-8"))
+		os.replace(temporary_path, path)
+		self.manifest[stage] = {
+			"key": key,
+			"kind": kind,
+			"file": path.name,
+			"seconds": seconds,
+			"created_at": datetime.now().isoformat(timespec="seconds"),
+		}
+		temporary_manifest_path = self.manifest_path.with_suffix(".tmp")
+		with open(temporary_manifest_path, "w", encoding="utf-8") as manifest_file:
+			json.dump(self.manifest, manifest_file, indent=4)
+		os.replace(temporary_manifest_path, self.manifest_path)
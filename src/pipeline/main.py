@@ -0,0 +1,252 @@
+# Run the clustering and the summaries of a day in one process
+
+import argparse
+import json
+import os
+import time
+from datetime import datetime, timedelta
+from tempfile import NamedTemporaryFile
+
+import pandas as pd
+
+from src.llm.main import add_generator_arguments, make_generator, summarize_documents
+from src.llm.prompts import REDUCE_PROMPT_TEMPLATE, SUMMARIZATION_PROMPT_TEMPLATE
+from src.llm.summary_cache import SummaryCache
+from src.pipeline.artifacts import StageArtifacts
+from src.pipeline.runner import STAGES, PipelineRunner
+from src.shared.cloud_storage.cloud_storage import BackBlazeCloudStorage
+from src.shared.cloud_storage.cloud_storage_columnar import SUMMARY_COLUMNS
+from src.shared.logger import setup_logger
+from src.shared.metrics import metrics_recorder
+from src.summarizer.cluster_modeler import HierarchicalClusterModeler
+from src.summarizer.cluster_ranker import ClusterRanker, add_budget_arguments
+from src.summarizer.condenser import ExtractiveCondenser
+from src.summarizer.data_puller import DataPuller
+from src.summarizer.deduplicator import NearDuplicateRemover
+from src.summarizer.embeddings_cache import EmbeddingsCache
+from src.summarizer.embeddings_computer import EmbeddingsComputer
+from src.summarizer.scalable_cluster_modeler import TwoStageClusterModeler
+
+logger = setup_logger("pipeline_main")
+
+EMBEDDING_MODEL_ID = "dunzhang/stella_en_400M_v5"
+
+
+def make_embeddings_computer(args) -> EmbeddingsComputer:
+	embeddings_cache = EmbeddingsCache(args.embeddings_cache) if args.embeddings_cache else None
+	return EmbeddingsComputer(
+		embedding_model_id=EMBEDDING_MODEL_ID,
+		embeddings_cache=embeddings_cache,
+		chunk_long_documents=args.chunk_long_documents,
+		embedding_server_url=args.embedding_server_url,
+	)
+
+
+def condense_clusters(clusters_df: pd.DataFrame, embeddings, args) -> pd.DataFrame:
+	"""Add the condensed content of the clusters, the clusters are indexed by their embedding row"""
+	if not args.condense_token_budget:
+		return clusters_df
+	condenser = ExtractiveCondenser(
+		make_embeddings_computer(args), token_budget=args.condense_token_budget
+	)
+	condensed_df = condenser.run(
+		clusters_df.set_index(clusters_df["embedding_row"].to_numpy()), embeddings
+	)
+	return condensed_df.reset_index(drop=True)
+
+
+def compute_clusters(news_df: pd.DataFrame, embeddings, args) -> pd.DataFrame:
+	"""The news of the top clusters, with the row of their embedding"""
+	if args.clustering_backend == "two_stage":
+		cluster_modeler = TwoStageClusterModeler(max_block_size=args.max_block_size)
+	else:
+		cluster_modeler = HierarchicalClusterModeler()
+	important_news_df = cluster_modeler.run(
+		today_news_embeddings=embeddings, documents=news_df.copy()
+	)
+	cluster_ranker = ClusterRanker.from_args(args)
+	important_news_df = cluster_ranker.run(important_news_df, embeddings)
+	return important_news_df.assign(embedding_row=important_news_df.index).reset_index(drop=True)
+
+
+def summarize_clusters(clusters_df: pd.DataFrame, generator, args) -> dict:
+	"""Summarize the clusters on the llama.cpp server, the failed clusters are listed apart"""
+	assert generator.api_url is not None, "API_URL is not set"
+	assert generator._ping_api(), "API is not up"
+	columns = [column for column in SUMMARY_COLUMNS if column in clusters_df.columns]
+	summary_cache = SummaryCache(args.summary_cache) if args.summary_cache else None
+	with metrics_recorder.stage("summarize") as stage:
+		summaries, failures = summarize_documents(
+			clusters_df[columns].to_dict(orient="records"),
+			generator,
+			max_concurrency=args.parallel_slots,
+			pin_slots=args.pin_slots,
+			summary_cache=summary_cache,
+		)
+		stage.add(clusters=len(summaries), failures=len(failures))
+	return {"summaries": summaries, "failures": failures}
+
+
+def upload_outputs(
+	clusters_df: pd.DataFrame, embeddings, summaries: list, date: str, environment: str
+) -> None:
+	"""Upload the files of the separate jobs, for the digest and the readers of the bucket"""
+	cloud_storage = BackBlazeCloudStorage(environment=environment)
+	cloud_storage.save_df_as_columns(clusters_df.drop(columns=["embedding_row"]), date=date)
+	labels, centroids, sizes = HierarchicalClusterModeler.compute_centroids(
+		clusters_df["labels"].to_numpy(), embeddings[clusters_df["embedding_row"].to_numpy()]
+	)
+	cloud_storage.save_centroids(labels, centroids, sizes, date=date)
+	if not summaries:
+		logger.info("done uploading the clusters and the centroids")
+		return
+	with NamedTemporaryFile(mode="w", suffix=".json", encoding="utf-8") as summaries_file:
+		json.dump(summaries, summaries_file, ensure_ascii=False, indent=4)
+		summaries_file.flush()
+		cloud_storage.upload_file(
+			bucket_name=os.getenv("UPLOAD_BUCKET_NAME"),
+			file_name=f"summaries/news-summaries-{date}.json",
+			file_path=summaries_file.name,
+			metadata={"content_type": "application/json"},
+		)
+	logger.info("done uploading the clusters, the centroids and the summaries")
+
+
+parser = argparse.ArgumentParser(prog="news pipeline", description="cluster and summarize the news")
+if __name__ == "__main__":
+	parser.add_argument("-e", "--environment", default="dev")
+	parser.add_argument("-d", "--days_ago", type=int, default=0)
+	parser.add_argument(
+		"-a",
+		"--artifacts_directory",
+		default="cache/pipeline",
+		help="where to keep the output of every stage, one directory per environment and day",
+	)
+	parser.add_argument(
+		"--artifacts_max_age_days",
+		type=float,
+		default=7,
+		help="remove the stage outputs of the days older than this at startup, 0 keeps them",
+	)
+	parser.add_argument(
+		"--rerun_from",
+		default=None,
+		choices=STAGES,
+		help="compute this stage and the next ones again even if their outputs are stored",
+	)
+	parser.add_argument(
+		"--last_stage",
+		default="summarize",
+		choices=["cluster", "summarize"],
+		help="stop after this stage, e.g. cluster to summarize later with --rerun_from summarize",
+	)
+	parser.add_argument("--near_duplicate_threshold", type=float, default=0.8)
+	parser.add_argument("-c", "--embeddings_cache", default="cache/embeddings.sqlite3")
+	parser.add_argument("--embedding_server_url", default=os.getenv("EMBEDDING_SERVER_URL"))
+	parser.add_argument("--chunk_long_documents", action="store_true")
+	parser.add_argument("--clustering_backend", default="dense", choices=["dense", "two_stage"])
+	parser.add_argument("--max_block_size", type=int, default=2000)
+	parser.add_argument("--summary_cache", default="cache/summaries")
+	add_generator_arguments(parser)
+	parser.add_argument(
+		"-s",
+		"--save_to_s3",
+		action="store_true",
+		help="upload the clusters, the centroids and the summaries like the separate jobs",
+	)
+	add_budget_arguments(parser)
+	args = parser.parse_args()
+	# the metrics of a failed run are written too, its retries and stage timings matter most
+	try:
+		start = time.perf_counter()
+		date = (datetime.now() - timedelta(days=args.days_ago)).strftime("%Y-%m-%d")
+		artifacts = StageArtifacts(
+			os.path.join(args.artifacts_directory, args.environment, date),
+			max_age_days=args.artifacts_max_age_days or None,
+		)
+		runner = PipelineRunner(artifacts, rerun_from=args.rerun_from)
+
+		data_puller = DataPuller(environment=args.environment, date=date)
+		# the range is open until the end of the day, a pull is reused only if no article came since
+		news_df, pull_key = runner.run_stage(
+			"pull",
+			"frame",
+			{"environment": args.environment, "date": date, **data_puller.get_fingerprint()},
+			None,
+			data_puller.run,
+		)
+		if news_df.empty:
+			logger.info("no articles to cluster, exiting")
+			raise SystemExit(0)
+		news_df, deduplicate_key = runner.run_stage(
+			"deduplicate",
+			"frame",
+			{"threshold": args.near_duplicate_threshold},
+			pull_key,
+			lambda: (
+				NearDuplicateRemover(threshold=args.near_duplicate_threshold).run(news_df)
+				if args.near_duplicate_threshold > 0
+				else news_df
+			),
+		)
+
+		embeddings, embed_key = runner.run_stage(
+			"embed",
+			"array",
+			{"model": EMBEDDING_MODEL_ID, "chunk_long_documents": args.chunk_long_documents},
+			deduplicate_key,
+			lambda: make_embeddings_computer(args).run(documents=news_df["content"]),
+		)
+		clusters_df, cluster_key = runner.run_stage(
+			"cluster",
+			"frame",
+			{
+				"backend": args.clustering_backend,
+				"max_block_size": args.max_block_size,
+				"max_clusters": args.max_clusters,
+				"max_prompt_tokens": args.max_prompt_tokens,
+				"summary_budget_minutes": args.summary_budget_minutes,
+				"seconds_per_cluster": args.seconds_per_cluster,
+			},
+			embed_key,
+			lambda: compute_clusters(news_df, embeddings, args),
+		)
+		clusters_df, condense_key = runner.run_stage(
+			"condense",
+			"frame",
+			{"token_budget": args.condense_token_budget},
+			cluster_key,
+			lambda: condense_clusters(clusters_df, embeddings, args),
+		)
+		summaries = []
+		if args.last_stage == "summarize":
+			generator = make_generator(
+				args, api_url=os.getenv("API_URL"), api_key=os.getenv("RUN_POD_API_KEY")
+			)
+			generation_output, _ = runner.run_stage(
+				"summarize",
+				"json",
+				{
+					"prompt_template": SUMMARIZATION_PROMPT_TEMPLATE,
+					"reduce_prompt_template": REDUCE_PROMPT_TEMPLATE,
+					"system_prompt": generator.system_prompt,
+					"generation_parameters": generator.generation_parameters,
+					"max_tokens_per_prompt": generator.max_tokens_per_prompt,
+					"stream": args.stream_tokens,
+				},
+				condense_key,
+				lambda: summarize_clusters(clusters_df, generator, args),
+				is_complete=lambda output: not output["failures"],
+			)
+			generator.close()
+			summaries = generation_output["summaries"]
+			logger.info(
+				f"{len(summaries)} summaries and {len(generation_output['failures'])} failures, "
+				f"see {artifacts.directory}"
+			)
+		if args.save_to_s3:
+			# the in process handoff does not need the bucket, the files are for the digest and the readers
+			upload_outputs(clusters_df, embeddings, summaries, date, args.environment)
+		logger.info(f"the pipeline of {date} took {time.perf_counter() - start:.1f}s")
+	finally:
+		metrics_recorder.write("pipeline")
@@ -0,0 +1,62 @@
+import time
+from typing import Any, Callable, Dict, Tuple
+
+from src.pipeline.artifacts import StageArtifacts
+from src.shared.logger import setup_logger
+from src.shared.metrics import metrics_recorder
+
+logger = setup_logger("pipeline_runner")
+
+STAGES = ("pull", "deduplicate", "embed", "cluster", "condense", "summarize")
+
+
+class PipelineRunner:
+	"""
+	Run the stages in order and pass their outputs in memory, reuse the stored output of a stage when
+	its key did not change.
+
+	The stages from rerun_from are computed again, and so are all the stages after a computed one.
+	"""
+
+	def __init__(self, artifacts: StageArtifacts, rerun_from: str | None = None) -> None:
+		if rerun_from is not None and rerun_from not in STAGES:
+			raise ValueError(f"unknown stage {rerun_from}, the stages are {STAGES}")
+		self.artifacts = artifacts
+		self.rerun_from = rerun_from
+		self.has_computed = False
+
+	def must_compute(self, stage: str, key: str) -> bool:
+		if self.has_computed or not self.artifacts.has(stage, key):
+			return True
+		return self.rerun_from is not None and STAGES.index(stage) >= STAGES.index(self.rerun_from)
+
+	def run_stage(
+		self,
+		stage: str,
+		kind: str,
+		parameters: Dict,
+		input_key: str | None,
+		compute: Callable[[], Any],
+		is_complete: Callable[[Any], bool] | None = None,
+	) -> Tuple[Any, str]:
+		"""
+		Return the output of the stage and its key.
+
+		An output for which is_complete is false is returned but not stored, the next run computes it again.
+		"""
+		key = self.artifacts.compute_key(stage, parameters, input_key)
+		with metrics_recorder.stage(f"pipeline.{stage}") as metrics_stage:
+			if not self.must_compute(stage, key):
+				logger.info(f"reusing the {stage} output of {self.artifacts.directory}")
+				metrics_stage.add(cache_hits=1)
+				return self.artifacts.load(stage), key
+			self.has_computed = True
+			start = time.perf_counter()
+			value = compute()
+			seconds = time.perf_counter() - start
+			if is_complete is None or is_complete(value):
+				self.artifacts.save(stage, key, kind, value, seconds)
+			else:
+				logger.warning(f"the {stage} output is incomplete, it is not stored")
+			logger.info(f"computed the {stage} stage in {seconds:.1f}s")
+		return value, key
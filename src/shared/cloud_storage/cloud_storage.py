@@ -4,7 +4,7 @@ from tempfile import NamedTemporaryFile
 import numpy as np
 import pandas as pd
 
-from src.shared.cloud_storage.cloud_storage_base import BackBlazeCloudStorageBase
+from src.shared.cloud_storage.cloud_storage_columnar import BackBlazeCloudStorageColumnar
 from src.shared.logger import setup_logger
 
 logger = setup_logger("data_puller")
@@ -12,7 +12,22 @@ logger = setup_logger("data_puller")
 BUCKET_NAME = "congonews-clusters"
 
 
-class BackBlazeCloudStorage(BackBlazeCloudStorageBase):
+def dataframe_to_columns(data: pd.DataFrame) -> dict:
+	"""Convert the dataframe columns to typed numpy arrays, the other columns become text"""
+	columns = {}
+	for name, values in data.items():
+		if pd.api.types.is_datetime64_any_dtype(values):
+			if values.dt.tz is not None:
+				values = values.dt.tz_convert("UTC").dt.tz_localize(None)
+			columns[name] = values.to_numpy(dtype="datetime64[us]")
+		elif pd.api.types.is_numeric_dtype(values):
+			columns[name] = values.to_numpy()
+		else:
+			columns[name] = values.fillna("").astype(str).tolist()
+	return columns
+
+
+class BackBlazeCloudStorage(BackBlazeCloudStorageColumnar):
 	def save_df_to_blackbaze_bucket(
 		self, data: pd.DataFrame, bucket_name: str = BUCKET_NAME, **kwargs
 	) -> None:
@@ -30,11 +45,55 @@ class BackBlazeCloudStorage(BackBlazeCloudStorageBase):
 			logger.info(f"Saved {file_name} news to the cloud bucket")
 			return file_name
 
+	def save_df_as_columns(
+		self,
+		data: pd.DataFrame,
+		bucket_name: str = BUCKET_NAME,
+		embeddings: np.array = None,
+		**kwargs,
+	) -> str:
+		"""Save a dataframe, and optionally the embeddings of its rows, as a columnar file in the cloud bucket."""
+		columns = dataframe_to_columns(data)
+		if embeddings is not None:
+			columns["embedding"] = np.asarray(embeddings, dtype=np.float32)
+		file_name = self.save_columns(columns, bucket_name=bucket_name, **kwargs)
+		logger.info(f"Saved {file_name} news to the cloud bucket")
+		return file_name
+
+	def save_centroids(
+		self,
+		labels: np.array,
+		centroids: np.array,
+		sizes: np.array,
+		date: str,
+		bucket_name: str = BUCKET_NAME,
+	) -> str:
+		"""Save the centroid and the size of every cluster of the day, the weekly digest merges them"""
+		file_name = self.save_columns(
+			{"labels": labels, "centroid": centroids, "size": sizes},
+			bucket_name=bucket_name,
+			file_name=self.generate_centroids_file_name(date),
+			date=date,
+		)
+		logger.info(f"Saved the centroids of {labels.shape[0]} clusters in {file_name}")
+		return file_name
+
+	def download_columns_as_df(
+		self, bucket_name: str, file_name: str, columns: list = None
+	) -> pd.DataFrame:
+		"""Download the columnar file and return the given 1-D columns as a dataframe"""
+		columnar_file = self.read_columns(bucket_name=bucket_name, file_name=file_name)
+		columns = columns or [column for column in columnar_file.columns if column != "embedding"]
+		news_df = pd.DataFrame(columnar_file.read(columns))
+		columnar_file.close()
+		return news_df
+
 	def download_file_as_numpy_array(self, bucket_name: str, file_name: str) -> np.array:
 		"""Given the filename, download the file and return it as a numpy array"""
-		documents = self.download_by_name(bucket_name=bucket_name, file_name=file_name)
 		with NamedTemporaryFile(delete=True, suffix=".csv") as temp_file:
-			documents.save_to(temp_file.name)
+			self.download_to(
+				bucket_name=bucket_name, file_name=file_name, destination=temp_file.name
+			)
 			csv_data = np.loadtxt(
 				temp_file.name,
 				delimiter="|",
@@ -47,7 +106,8 @@ class BackBlazeCloudStorage(BackBlazeCloudStorageBase):
 
 	def download_npy_file(self, bucket_name: str, file_name: str) -> np.array:
 		"""Given the filename, download the file and return it as a numpy array"""
-		documents = self.download_by_name(bucket_name=bucket_name, file_name=file_name)
 		with NamedTemporaryFile(delete=True, suffix=".npy") as temp_file:
-			documents.save_to(temp_file.name)
+			self.download_to(
+				bucket_name=bucket_name, file_name=file_name, destination=temp_file.name
+			)
 			return np.load(temp_file.name)
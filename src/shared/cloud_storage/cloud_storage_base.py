@@ -1,12 +1,14 @@
 import os
 from datetime import datetime
 from pathlib import Path
-from typing import Tuple
+from typing import BinaryIO, Tuple
 
 import b2sdk.v2 as back_blaze
 from b2sdk._internal.transfer.inbound.downloaded_file import DownloadedFile
 from dotenv import load_dotenv
 
+from src.shared.metrics import metrics_recorder
+
 
 class BackBlazeCloudStorageBase:
 	"""
@@ -42,20 +44,38 @@ class BackBlazeCloudStorageBase:
 
 	def upload_file(self, bucket_name: str, file_path: str, file_name: str, metadata: dict) -> str:
 		"""upload the file to the bucket with the given name"""
-		bucket = self.get_bucket(bucket_name)
-		uploaded_file = bucket.upload_local_file(
-			local_file=file_path, file_name=file_name, file_infos=metadata
-		)
+		with metrics_recorder.stage("cloud_storage.upload", bytes=os.path.getsize(file_path)):
+			bucket = self.get_bucket(bucket_name)
+			uploaded_file = bucket.upload_local_file(
+				local_file=file_path, file_name=file_name, file_infos=metadata
+			)
 		return self.back_blaze_api.get_download_url_for_fileid(uploaded_file.id_)
 
 	def download_by_name(self, bucket_name: str, file_name: str) -> DownloadedFile:
-		"""download the file from the bucket with the given name"""
+		"""
+		open the download of the file from the bucket with the given name, the body is not read yet.
+
+		The transfer is timed where the body is read, in download_to or by the stream readers.
+		"""
 		bucket = self.get_bucket(bucket_name)
 		return bucket.download_file_by_name(file_name)
 
-	def generate_file_name(self, date: str = None) -> str:
+	def download_to(
+		self, bucket_name: str, file_name: str, destination: str | BinaryIO
+	) -> DownloadedFile:
+		"""download the file to the path or the file object, the stage times the whole transfer"""
+		with metrics_recorder.stage("cloud_storage.download") as stage:
+			documents = self.download_by_name(bucket_name=bucket_name, file_name=file_name)
+			if isinstance(destination, str):
+				documents.save_to(destination)
+			else:
+				documents.save(destination)
+			stage.add(bytes=documents.download_version.content_length)
+		return documents
+
+	def generate_file_name(self, date: str = None, extension: str = "csv") -> str:
 		today = datetime.now().strftime("%Y-%m-%d")
 		if not date:
 			date = today
-		file_name = f"news-clusters-{today}-to-{date}.csv"
+		file_name = f"news-clusters-{today}-to-{date}.{extension}"
 		return file_name
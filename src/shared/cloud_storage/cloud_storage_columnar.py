@@ -0,0 +1,74 @@
+from datetime import datetime
+from io import BytesIO
+from itertools import groupby
+from operator import itemgetter
+from tempfile import NamedTemporaryFile
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+import numpy as np
+
+from src.shared.cloud_storage.cloud_storage_base import BackBlazeCloudStorageBase
+from src.shared.columnar import ColumnarFile, write_columns
+
+SUMMARY_COLUMNS = (
+	"labels",
+	"title",
+	"url",
+	"content",
+	"condensed_content",
+	"duplicate_titles",
+	"duplicate_urls",
+)
+
+
+class BackBlazeCloudStorageColumnar(BackBlazeCloudStorageBase):
+	"""this cloud storage reads and writes the columnar npz handoff between the clustering and the generator"""
+
+	def save_columns(
+		self,
+		columns: Dict[str, np.array | List[str]],
+		bucket_name: str,
+		file_name: str | None = None,
+		**kwargs,
+	) -> str:
+		"""Save the columns as a columnar file in the bucket and return the file name"""
+		if file_name is None:
+			date = kwargs.get("date", datetime.now().strftime("%Y-%m-%d"))
+			file_name = self.generate_file_name(date=date, extension="npz")
+		with NamedTemporaryFile(delete=True, suffix=".npz") as temp_file:
+			write_columns(temp_file, columns)
+			temp_file.flush()
+			self.upload_file(
+				bucket_name=bucket_name,
+				file_path=temp_file.name,
+				file_name=file_name,
+				metadata=kwargs,
+			)
+		return file_name
+
+	@staticmethod
+	def generate_centroids_file_name(date: str) -> str:
+		"""the centroids of the clusters of a day, read by the weekly digest"""
+		return f"news-centroids-{date}.npz"
+
+	def read_columns(self, bucket_name: str, file_name: str) -> ColumnarFile:
+		"""Download the columnar file in memory, the columns are decoded when they are read"""
+		buffer = BytesIO()
+		self.download_to(bucket_name=bucket_name, file_name=file_name, destination=buffer)
+		buffer.seek(0)
+		return ColumnarFile(buffer)
+
+	def iter_label_groups(
+		self,
+		bucket_name: str,
+		file_name: str,
+		columns: Iterable[str] = SUMMARY_COLUMNS,
+		label_column: str = "labels",
+	) -> Iterator[Tuple[int, List[Dict]]]:
+		"""Yield the rows of each label, only the given columns that are in the file are read"""
+		columnar_file = self.read_columns(bucket_name=bucket_name, file_name=file_name)
+		columns = [column for column in columns if column in columnar_file.columns]
+		rows = sorted(columnar_file.iter_rows(columns), key=itemgetter(label_column))
+		for label, group in groupby(rows, key=itemgetter(label_column)):
+			yield label, list(group)
+		columnar_file.close()
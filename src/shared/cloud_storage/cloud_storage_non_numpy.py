@@ -1,7 +1,18 @@
+import time
 from csv import DictReader as csv_reader
+from io import TextIOWrapper
+from itertools import groupby
+from operator import itemgetter
 from tempfile import NamedTemporaryFile
+from typing import Dict, Iterator, List, Tuple
+
+from b2sdk._internal.transfer.inbound.downloaded_file import DownloadedFile
 
 from src.shared.cloud_storage.cloud_storage_base import BackBlazeCloudStorageBase
+from src.shared.logger import setup_logger
+from src.shared.metrics import metrics_recorder
+
+logger = setup_logger("cloud_storage_csv")
 
 
 class BackBlazeCloudStorageCSV(BackBlazeCloudStorageBase):
@@ -9,10 +20,72 @@ class BackBlazeCloudStorageCSV(BackBlazeCloudStorageBase):
 
 	def read_file_as_list(self, bucket_name: str, file_name: str) -> list:
 		"""Given the filename, download the file and return it as a numpy array"""
-		documents = self.download_by_name(bucket_name=bucket_name, file_name=file_name)
 		with NamedTemporaryFile(
 			delete=True, suffix=".csv", mode="r", encoding="utf-8"
 		) as temp_file:
-			documents.save_to(temp_file.name)
+			self.download_to(
+				bucket_name=bucket_name, file_name=file_name, destination=temp_file.name
+			)
 			reader = csv_reader(temp_file, delimiter="|")
 			return list(reader)
+
+	@staticmethod
+	def iter_downloaded_rows(documents: DownloadedFile) -> Iterator[Dict]:
+		"""
+		Yield the rows of the csv file straight from the download stream, without a temporary file.
+
+		The download stage times the reads of the rows only, not the work done on them between two rows.
+		"""
+		raw_stream = documents.response.raw
+		raw_stream.decode_content = True
+		download_seconds = 0.0
+		failed = True
+		try:
+			with TextIOWrapper(raw_stream, encoding="utf-8", newline="") as text_stream:
+				rows = csv_reader(text_stream, delimiter="|")
+				while True:
+					start = time.perf_counter()
+					row = next(rows, None)
+					download_seconds += time.perf_counter() - start
+					if row is None:
+						break
+					yield row
+			failed = False
+		finally:
+			stage = metrics_recorder.get_stage("cloud_storage.download")
+			stage.add(bytes=documents.download_version.content_length)
+			stage.finish_call(download_seconds, failed)
+
+	def iter_rows(self, bucket_name: str, file_name: str) -> Iterator[Dict]:
+		documents = self.download_by_name(bucket_name=bucket_name, file_name=file_name)
+		yield from self.iter_downloaded_rows(documents)
+
+	def iter_label_groups(
+		self, bucket_name: str, file_name: str, label_column: str = "labels"
+	) -> Iterator[Tuple[str, List[Dict]]]:
+		"""
+		Yield the rows of each label, as soon as the whole label is downloaded for a file ordered by label.
+
+		The clustering job marks its ordered files with a sorted_by file info. The other files, e.g. the
+		ones written before the clusters were ordered, are grouped in memory before the first label is
+		yielded, so nothing is submitted from a file that turns out to be unordered.
+		"""
+		documents = self.download_by_name(bucket_name=bucket_name, file_name=file_name)
+		rows = self.iter_downloaded_rows(documents)
+		if documents.download_version.file_info.get("sorted_by") != label_column:
+			logger.info(
+				f"{file_name} is not marked as ordered by {label_column}, grouping it in memory"
+			)
+			groups = {}
+			for row in rows:
+				groups.setdefault(row[label_column], []).append(row)
+			yield from groups.items()
+			return
+		seen_labels = set()
+		for label, group in groupby(rows, key=itemgetter(label_column)):
+			if label in seen_labels:
+				raise ValueError(
+					f"{file_name} is marked as ordered by {label_column} but {label} appears twice"
+				)
+			seen_labels.add(label)
+			yield label, list(group)
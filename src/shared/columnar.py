@@ -0,0 +1,98 @@
+import json
+from io import BytesIO
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterable, Iterator, List
+
+import numpy as np
+
+FORMAT_VERSION = 1
+SCHEMA_KEY = "__schema__"
+# the titles, urls and origins of the near duplicates of an article are joined in one value of the handoff
+DUPLICATE_SEPARATOR = "\n"
+
+
+def encode_text_column(values: Iterable[str]) -> tuple[np.array, np.array]:
+	"""Encode strings as one utf-8 buffer and the offsets of every value, like arrow string arrays"""
+	encoded_values = [str(value).encode("utf-8") for value in values]
+	offsets = np.zeros(len(encoded_values) + 1, dtype=np.int64)
+	np.cumsum([len(value) for value in encoded_values], out=offsets[1:])
+	data = np.frombuffer(b"".join(encoded_values), dtype=np.uint8)
+	return data, offsets
+
+
+def decode_text_column(data: np.array, offsets: np.array) -> List[str]:
+	buffer = data.tobytes()
+	return [buffer[start:end].decode("utf-8") for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def write_columns(
+	destination: str | Path | BinaryIO, columns: Dict[str, np.array | List[str]]
+) -> None:
+	"""
+	Write the columns to a compressed npz file.
+
+	A list of strings or a numpy array of strings/objects is stored as a text column, any other numpy
+	array (numbers, datetime64, a 2-D embeddings matrix) is stored with its dtype.
+	"""
+	arrays = {}
+	schema = {"version": FORMAT_VERSION, "columns": {}}
+	for name, values in columns.items():
+		is_text = isinstance(values, list) or np.asarray(values).dtype.kind in "OUS"
+		if is_text:
+			arrays[f"{name}.data"], arrays[f"{name}.offsets"] = encode_text_column(values)
+			schema["columns"][name] = "text"
+		else:
+			arrays[name] = np.asarray(values)
+			schema["columns"][name] = "array"
+	arrays[SCHEMA_KEY] = np.frombuffer(json.dumps(schema).encode("utf-8"), dtype=np.uint8)
+	np.savez_compressed(destination, **arrays)
+
+
+class ColumnarFile:
+	"""
+	Read the columns written by write_columns.
+
+	The npz members are only decompressed when a column is read, so reading a few columns does not
+	pay for the others (the article text or the embeddings).
+	"""
+
+	def __init__(self, source: str | Path | BinaryIO | bytes) -> None:
+		if isinstance(source, bytes):
+			source = BytesIO(source)
+		self.npz_file = np.load(source, allow_pickle=False)
+		schema = json.loads(self.npz_file[SCHEMA_KEY].tobytes().decode("utf-8"))
+		if schema["version"] != FORMAT_VERSION:
+			raise ValueError(f"unsupported columnar format version {schema['version']}")
+		self.schema = schema["columns"]
+
+	@property
+	def columns(self) -> List[str]:
+		return list(self.schema.keys())
+
+	def read_column(self, name: str) -> np.array | List[str]:
+		if name not in self.schema:
+			raise KeyError(f"{name} is not a column, the columns are {self.columns}")
+		if self.schema[name] == "text":
+			return decode_text_column(
+				self.npz_file[f"{name}.data"], self.npz_file[f"{name}.offsets"]
+			)
+		return self.npz_file[name]
+
+	def read(self, columns: Iterable[str] | None = None) -> Dict[str, np.array | List[str]]:
+		"""Read the given columns, all of them by default"""
+		columns = self.columns if columns is None else columns
+		return {name: self.read_column(name) for name in columns}
+
+	def iter_rows(self, columns: Iterable[str]) -> Iterator[Dict]:
+		"""Yield the rows as dictionaries of python values, 1-D columns only"""
+		data = self.read(columns)
+		names = list(data.keys())
+		values = [
+			column.tolist() if isinstance(column, np.ndarray) else column
+			for column in data.values()
+		]
+		for row in zip(*values):
+			yield dict(zip(names, row))
+
+	def close(self) -> None:
+		self.npz_file.close()
@@ -1,10 +1,21 @@
+import json
+import os
+import threading
 from collections.abc import Generator
-from typing import Dict, List
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+from uuid import uuid4
 
+import pandas as pd
 from psycopg2 import connect
 from psycopg2.extras import NamedTupleCursor
+from psycopg2.pool import ThreadedConnectionPool
 from sqlalchemy.engine import Connection
 
+# one pool per database, shared by the stages and the threads of a process
+connection_pools: Dict[str, ThreadedConnectionPool] = {}
+connection_pools_lock = threading.Lock()
+
 
 def generate_database_connection(
 	database_credentials: Dict,
@@ -33,3 +44,112 @@ def execute_query(database_connection, query, params=None) -> Generator[List[Nam
 			raise ValueError(
 				f"an execution error occurred for query {query!r} with params {params!r}"
 			) from e
+
+
+def stream_query(
+	database_connection, query, params=None, chunk_size: int = 2000
+) -> Generator[List[Tuple]]:
+	"""
+	Execute a database query with a server side cursor and yield the results in chunks.
+
+	Only one chunk of rows is held in memory at a time, the rows are plain tuples.
+
+	Args:
+	    database_connection: A connection to the database.
+	    query: The SQL query to execute.
+	    params: Optional parameters to pass to the query.
+	    chunk_size: The number of rows fetched from the server at once.
+
+	Yields:
+	    Lists of at most chunk_size rows.
+	"""
+	with database_connection.cursor(name=f"stream_{uuid4().hex}") as cursor:
+		cursor.itersize = chunk_size
+		try:
+			cursor.execute(query, params)
+			while True:
+				rows = cursor.fetchmany(chunk_size)
+				if not rows:
+					break
+				yield rows
+		except Exception as e:
+			raise ValueError(
+				f"an execution error occurred for query {query!r} with params {params!r}"
+			) from e
+
+
+def get_connection_pool(
+	database_credentials: Dict, min_connections: int = 1, max_connections: int = 4
+) -> ThreadedConnectionPool:
+	"""The pool of the database, created on the first call with these credentials"""
+	pool_key = json.dumps(database_credentials, sort_keys=True, default=str)
+	with connection_pools_lock:
+		if pool_key not in connection_pools:
+			connection_pools[pool_key] = ThreadedConnectionPool(
+				min_connections, max_connections, **database_credentials
+			)
+		return connection_pools[pool_key]
+
+
+@contextmanager
+def pooled_connection(database_credentials: Dict) -> Iterator[Connection]:
+	"""
+	Borrow a connection of the pool and give it back, the open transaction is rolled back.
+
+	A connection closed by the server is dropped from the pool instead of given back.
+	"""
+	pool = get_connection_pool(database_credentials)
+	database_connection = pool.getconn()
+	try:
+		yield database_connection
+	finally:
+		if database_connection.closed:
+			pool.putconn(database_connection, close=True)
+		else:
+			database_connection.rollback()
+			pool.putconn(database_connection)
+
+
+def close_connection_pools() -> None:
+	with connection_pools_lock:
+		for pool in connection_pools.values():
+			pool.closeall()
+		connection_pools.clear()
+
+
+def copy_query_to_dataframe(
+	database_connection, query, params=None, **read_csv_kwargs
+) -> pd.DataFrame:
+	"""
+	Run the query with COPY ... TO STDOUT and parse the csv in a dataframe while it is received.
+
+	The server sends the rows as csv without building python tuples, the copy writes to a pipe read
+	by pandas so the whole export is never held as text. The parameters are bound by psycopg2.
+	"""
+	reader_descriptor, writer_descriptor = os.pipe()
+	copy_errors = []
+	with database_connection.cursor() as cursor:
+		bound_query = cursor.mogrify(query, params).decode("utf-8")
+		copy_statement = f"COPY ({bound_query}) TO STDOUT WITH (FORMAT csv, HEADER true)"
+
+		def copy_rows() -> None:
+			try:
+				with open(writer_descriptor, "wb") as writer:
+					cursor.copy_expert(copy_statement, writer)
+			except Exception as e:
+				copy_errors.append(e)
+
+		copy_thread = threading.Thread(target=copy_rows, daemon=True)
+		copy_thread.start()
+		try:
+			with open(reader_descriptor, "rb") as reader:
+				data = pd.read_csv(reader, **read_csv_kwargs)
+		except pd.errors.EmptyDataError:
+			data = pd.DataFrame()
+		finally:
+			copy_thread.join()
+	if copy_errors:
+		raise ValueError(
+			f"an execution error occurred for query {query!r} with params {params!r}"
+		) from copy_errors[0]
+	return data
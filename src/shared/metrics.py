@@ -0,0 +1,171 @@
+import json
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+from pathlib import Path
+from typing import Callable, Dict, Iterator
+
+from src.shared.logger import setup_logger
+
+logger = setup_logger("metrics")
+
+METRIC_PREFIX = "congo_news"
+# the counters reported as a throughput too
+THROUGHPUT_COUNTERS = ("rows", "tokens", "bytes")
+
+
+def peak_rss_bytes() -> int:
+	"""The peak resident memory of the process, ru_maxrss is in kilobytes on linux and bytes on macos"""
+	peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+class StageMetrics:
+	"""The metrics of one stage, summed over all its calls"""
+
+	def __init__(self, name: str) -> None:
+		self.name = name
+		self.calls = 0
+		self.seconds = 0.0
+		self.max_seconds = 0.0
+		self.retries = 0
+		self.errors = 0
+		self.peak_rss_bytes = 0
+		self.counters: Dict[str, float] = {}
+		self.lock = threading.Lock()
+
+	def add(self, **counters: float) -> None:
+		"""Add to the counters of the stage, like rows=1000 or tokens=25000"""
+		with self.lock:
+			for name, value in counters.items():
+				self.counters[name] = self.counters.get(name, 0) + value
+
+	def add_retries(self, retries: int) -> None:
+		with self.lock:
+			self.retries += retries
+
+	def finish_call(self, seconds: float, failed: bool) -> None:
+		with self.lock:
+			self.calls += 1
+			self.seconds += seconds
+			self.max_seconds = max(self.max_seconds, seconds)
+			self.errors += int(failed)
+			self.peak_rss_bytes = max(self.peak_rss_bytes, peak_rss_bytes())
+
+	def to_dict(self) -> Dict:
+		metrics = {
+			"calls": self.calls,
+			"seconds": round(self.seconds, 6),
+			"max_seconds": round(self.max_seconds, 6),
+			"retries": self.retries,
+			"errors": self.errors,
+			"peak_rss_bytes": self.peak_rss_bytes,
+			**self.counters,
+		}
+		for name in THROUGHPUT_COUNTERS:
+			if name in self.counters and self.seconds > 0:
+				metrics[f"{name}_per_second"] = round(self.counters[name] / self.seconds, 3)
+		return metrics
+
+
+class MetricsRecorder:
+	"""
+	Record the wall time, the counters, the peak RSS and the retries of the stages of a run.
+
+	A stage can run many times, even from many threads like the llama.cpp requests, its metrics are
+	summed over the calls. The peak RSS is the process high-water mark when the stage ends.
+	"""
+
+	def __init__(self) -> None:
+		self.stages: Dict[str, StageMetrics] = {}
+		self.started_at = time.time()
+		self.lock = threading.Lock()
+
+	def get_stage(self, name: str) -> StageMetrics:
+		with self.lock:
+			if name not in self.stages:
+				self.stages[name] = StageMetrics(name)
+			return self.stages[name]
+
+	@contextmanager
+	def stage(self, name: str, **counters: float) -> Iterator[StageMetrics]:
+		"""Time the block as one call of the stage, the block can add counters to the yielded stage"""
+		stage_metrics = self.get_stage(name)
+		stage_metrics.add(**counters)
+		start = time.perf_counter()
+		failed = False
+		try:
+			yield stage_metrics
+		except BaseException:
+			failed = True
+			raise
+		finally:
+			stage_metrics.finish_call(time.perf_counter() - start, failed)
+
+	def timed(self, name: str) -> Callable:
+		"""Decorator version of stage, without counters"""
+
+		def decorator(function: Callable) -> Callable:
+			@wraps(function)
+			def wrapper(*args, **kwargs):
+				with self.stage(name):
+					return function(*args, **kwargs)
+
+			return wrapper
+
+		return decorator
+
+	def to_dict(self, job: str) -> Dict:
+		return {
+			"job": job,
+			"started_at": datetime.fromtimestamp(self.started_at).isoformat(),
+			"seconds": round(time.time() - self.started_at, 6),
+			"peak_rss_bytes": peak_rss_bytes(),
+			"stages": {name: stage.to_dict() for name, stage in self.stages.items()},
+		}
+
+	def to_prometheus(self, job: str) -> str:
+		"""Format the metrics for the textfile collector of the node exporter, one gauge per metric"""
+		run_metrics = self.to_dict(job)
+		lines = [
+			f"# TYPE {METRIC_PREFIX}_run_seconds gauge",
+			f'{METRIC_PREFIX}_run_seconds{{job="{job}"}} {run_metrics["seconds"]}',
+			f"# TYPE {METRIC_PREFIX}_run_timestamp_seconds gauge",
+			f'{METRIC_PREFIX}_run_timestamp_seconds{{job="{job}"}} {self.started_at:.0f}',
+		]
+		metric_names = sorted(
+			{name for stage in run_metrics["stages"].values() for name in stage.keys()}
+		)
+		for metric_name in metric_names:
+			lines.append(f"# TYPE {METRIC_PREFIX}_stage_{metric_name} gauge")
+			for stage_name, stage in run_metrics["stages"].items():
+				if metric_name in stage:
+					lines.append(
+						f'{METRIC_PREFIX}_stage_{metric_name}{{job="{job}",stage="{stage_name}"}} '
+						f"{stage[metric_name]}"
+					)
+		return "\n".join(lines) + "\n"
+
+	def write(self, job: str, directory: str | Path = "cache/metrics") -> Path:
+		"""Write <job>-<date>.json and <job>.prom, the textfile is replaced at every run"""
+		directory = Path(directory)
+		directory.mkdir(parents=True, exist_ok=True)
+		date = datetime.fromtimestamp(self.started_at).strftime("%Y-%m-%d-%H%M%S")
+		json_path = directory.joinpath(f"{job}-{date}.json")
+		with open(json_path, "w") as metrics_file:
+			json.dump(self.to_dict(job), metrics_file, indent=4)
+		prometheus_path = directory.joinpath(f"{job}.prom")
+		temporary_path = prometheus_path.with_suffix(".prom.tmp")
+		with open(temporary_path, "w") as metrics_file:
+			metrics_file.write(self.to_prometheus(job))
+		temporary_path.replace(prometheus_path)
+		logger.info(f"saved the metrics of {job} in {json_path} and {prometheus_path}")
+		return json_path
+
+
+# one recorder per process, the stages of every component are recorded in it
+metrics_recorder = MetricsRecorder()
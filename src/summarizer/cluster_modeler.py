@@ -1,12 +1,18 @@
 from pathlib import Path
+from typing import TYPE_CHECKING
 
 import numpy as np
 import pandas as pd
 from scipy.cluster.hierarchy import fcluster, linkage
-from sentence_transformers import SentenceTransformer
+from scipy.spatial.distance import squareform
 from sklearn.metrics import silhouette_score
 
+from src.shared.columnar import DUPLICATE_SEPARATOR
 from src.shared.logger import setup_logger
+from src.shared.metrics import metrics_recorder
+
+if TYPE_CHECKING:
+	from sentence_transformers import SentenceTransformer
 
 DEFAULT_TRANSFORMER_KWARGS = {
 	"trust_remote_code": True,
@@ -27,27 +33,64 @@ class HierarchicalClusterModeler:
 		current_directory = Path.cwd()
 		self.current_directory = current_directory
 
+	@staticmethod
+	def compute_distance_matrix(today_news_embeddings: np.array) -> np.array:
+		"""Compute the square float32 cosine distance matrix of the embeddings once.
+
+		It is shared by the linkage (in its condensed form) and the silhouette scores.
+		"""
+		embeddings = np.asarray(today_news_embeddings, dtype=np.float32)
+		norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+		embeddings = embeddings / np.where(norms == 0, 1, norms)
+		distance_matrix = embeddings @ embeddings.T
+		np.subtract(1, distance_matrix, out=distance_matrix)
+		np.clip(distance_matrix, 0, 2, out=distance_matrix)
+		np.fill_diagonal(distance_matrix, 0)
+		return distance_matrix
+
+	@staticmethod
+	def compute_centroids(
+		labels: np.array, today_news_embeddings: np.array
+	) -> tuple[np.array, np.array, np.array]:
+		"""Return the labels, the normalized mean embedding and the number of documents of every cluster"""
+		unique_labels, inverse, sizes = np.unique(labels, return_inverse=True, return_counts=True)
+		embeddings = np.asarray(today_news_embeddings, dtype=np.float32)
+		centroids = np.zeros((unique_labels.shape[0], embeddings.shape[1]), dtype=np.float32)
+		np.add.at(centroids, inverse, embeddings)
+		norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+		centroids /= np.where(norms == 0, 1, norms)
+		return unique_labels, centroids, sizes
+
 	def compute_linkage(
 		self,
 		today_news_embeddings: np.array,
 		method: str = "complete",
 		metric: str = "cosine",
 	) -> np.array:
-		"""Compute the sklearn linkage"""
+		"""Compute the scipy linkage, a 1-D array is used as a condensed distance matrix and metric is ignored"""
 		mergings = linkage(today_news_embeddings, method=method, metric=metric)
 		return mergings
 
-	def select_best_distance(self, X: np.array, merging: np.array) -> tuple[np.array, float]:
-		"""start with the document embedding x, and the hierarchical clustering, find the k that maximize the shilouette score"""
+	def select_best_distance(
+		self, distance_matrix: np.array, merging: np.array
+	) -> tuple[np.array, float]:
+		"""start with the square distance matrix of the documents, and the hierarchical clustering, find the k that maximize the shilouette score"""
 		max_shilouette = float("-inf")
-		return_labels = np.zeros(X.shape[0])
+		number_of_documents = distance_matrix.shape[0]
+		return_labels = np.zeros(number_of_documents)
 		best_k = 0
+		previous_number_of_clusters = None
 		for k in np.arange(0.1, 0.4, 0.01):
 			labels = fcluster(merging, k, criterion="distance")
-			if np.unique(labels).shape[0] < 2 or np.unique(labels).shape[0] >= X.shape[0] - 1:
+			number_of_clusters = np.unique(labels).shape[0]
+			if number_of_clusters == previous_number_of_clusters:
+				# the cuts of the same tree are nested, the same number of clusters is the same partition
+				continue
+			previous_number_of_clusters = number_of_clusters
+			if number_of_clusters < 2 or number_of_clusters >= number_of_documents - 1:
 				# to avoid the case where the number of clusters is less than 2 or more than the number of documents
 				continue
-			score = silhouette_score(X, labels)
+			score = silhouette_score(distance_matrix, labels, metric="precomputed")
 			if score > max_shilouette:
 				max_shilouette = score
 				return_labels = labels
@@ -59,7 +102,7 @@ class HierarchicalClusterModeler:
 		documents: pd.DataFrame,
 		embeddings: np.array,
 		index: int,
-		embedding_model: SentenceTransformer,
+		embedding_model: "SentenceTransformer",
 		label_column: str = "labels",
 	) -> np.array:
 		"""take a matrix of embeddings and the labels.
@@ -73,21 +116,38 @@ class HierarchicalClusterModeler:
 		return embedding_model.similarity(vectors, vectors)
 
 	def select_top_clusters(self, news_df: pd.DataFrame) -> pd.DataFrame:
-		"""select the clusters with the more than two documents"""
+		"""select the clusters with the more than two documents, ordered by label so the generator can stream them"""
+		titles_df = news_df[["labels", "title"]]
+		if "duplicate_titles" in news_df.columns:
+			# the titles of the near duplicates removed before the embedding count as well
+			titles_df = pd.DataFrame(
+				{
+					"labels": news_df["labels"],
+					"title": news_df["duplicate_titles"].str.split(DUPLICATE_SEPARATOR),
+				}
+			).explode("title")
 		labels_with_more_than_one = (
-			news_df.groupby("labels")
-			.agg({"title": "nunique", "content": "count"})
+			titles_df.groupby("labels")
+			.agg({"title": "nunique"})
 			.sort_values(by="title", ascending=False)
 			.query("title > 1")
 			.index
 		)
 		important_news_df = news_df.loc[news_df.labels.isin(labels_with_more_than_one)]
-		return important_news_df
+		return important_news_df.sort_values(by="labels", kind="stable")
+
+	def compute_labels(self, today_news_embeddings: np.array) -> tuple[np.array, float]:
+		"""cluster the embeddings, return the labels and the distance threshold"""
+		with metrics_recorder.stage("cluster.linkage", rows=today_news_embeddings.shape[0]):
+			distance_matrix = self.compute_distance_matrix(today_news_embeddings)
+			mergings = self.compute_linkage(squareform(distance_matrix, checks=False))
+		with metrics_recorder.stage("cluster.select_best_distance"):
+			return self.select_best_distance(distance_matrix, mergings)
 
 	def run(self, today_news_embeddings: np.array, documents: pd.DataFrame) -> str:
 		"""start the clustering process"""
-		mergings = self.compute_linkage(today_news_embeddings)
-		return_labels, best_k = self.select_best_distance(today_news_embeddings, mergings)
+		with metrics_recorder.stage("cluster", rows=today_news_embeddings.shape[0]):
+			return_labels, best_k = self.compute_labels(today_news_embeddings)
 		logger.info(
 			f"finished clustering with best_k = {best_k:3f} with and number_of_clusters = {np.unique(return_labels).shape[0]}"
 		)
@@ -0,0 +1,214 @@
+from argparse import ArgumentParser, Namespace
+from urllib.parse import urlparse
+
+import numpy as np
+import pandas as pd
+
+from src.shared.columnar import DUPLICATE_SEPARATOR
+from src.shared.logger import setup_logger
+from src.shared.metrics import metrics_recorder
+from src.summarizer.cluster_modeler import HierarchicalClusterModeler
+
+logger = setup_logger("cluster_ranker")
+
+DEFAULT_SCORE_WEIGHTS = {"size": 0.35, "diversity": 0.3, "recency": 0.2, "cohesion": 0.15}
+# a rough count for french news with the qwen tokenizer, the budget does not need the exact one
+CHARACTERS_PER_TOKEN = 4
+
+
+def add_budget_arguments(parser: ArgumentParser) -> None:
+	"""The options of the summarization budget, shared by the clustering job and the pipeline"""
+	parser.add_argument(
+		"--max_clusters",
+		type=int,
+		default=None,
+		help="summarize at most this number of clusters, the most important ones",
+	)
+	parser.add_argument(
+		"--max_prompt_tokens",
+		type=int,
+		default=None,
+		help="the estimated prompt tokens of all the summarized clusters",
+	)
+	parser.add_argument(
+		"--summary_budget_minutes",
+		type=float,
+		default=None,
+		help="keep the clusters the generator can summarize in this time at --seconds_per_cluster",
+	)
+	parser.add_argument(
+		"--seconds_per_cluster",
+		type=float,
+		default=30,
+		help="the generator time of one cluster, divided by its parallel slots",
+	)
+	parser.add_argument(
+		"--condense_token_budget",
+		type=int,
+		default=None,
+		help="condense the clusters to their most central sentences, about this many prompt tokens each",
+	)
+
+
+class ClusterRanker:
+	"""
+	Rank the clusters by importance and keep the best ones that fit the summarization budget.
+
+	The score is a weighted sum of the number of articles, the number of distinct sources (website_origin,
+	or the domain of the url), the recency of the newest article and the cohesion of the cluster (the
+	mean cosine similarity to its centroid), every term between 0 and 1. The clusters are taken by
+	decreasing score until max_clusters, or until the clusters the generator can summarize in
+	time_budget_seconds at seconds_per_cluster; a cluster whose content would go over max_prompt_tokens
+	is skipped. None is no limit.
+	"""
+
+	def __init__(
+		self,
+		max_clusters: int | None = None,
+		max_prompt_tokens: int | None = None,
+		time_budget_seconds: float | None = None,
+		seconds_per_cluster: float = 30,
+		recency_half_life_hours: float = 12,
+		weights: dict | None = None,
+	) -> None:
+		self.max_clusters = max_clusters
+		self.max_prompt_tokens = max_prompt_tokens
+		self.time_budget_seconds = time_budget_seconds
+		self.seconds_per_cluster = seconds_per_cluster
+		self.recency_half_life_hours = recency_half_life_hours
+		self.weights = weights or DEFAULT_SCORE_WEIGHTS
+
+	@classmethod
+	def from_args(cls, args: Namespace) -> "ClusterRanker":
+		"""The ranker of the options of add_budget_arguments"""
+		return cls(
+			max_clusters=args.max_clusters,
+			max_prompt_tokens=args.max_prompt_tokens,
+			time_budget_seconds=(
+				args.summary_budget_minutes * 60 if args.summary_budget_minutes else None
+			),
+			seconds_per_cluster=args.seconds_per_cluster,
+		)
+
+	def get_cluster_budget(self) -> int | None:
+		"""The number of clusters allowed by max_clusters and the time budget"""
+		budgets = []
+		if self.max_clusters is not None:
+			budgets.append(self.max_clusters)
+		if self.time_budget_seconds is not None:
+			budgets.append(int(self.time_budget_seconds // self.seconds_per_cluster))
+		return min(budgets) if budgets else None
+
+	@staticmethod
+	def list_sources(news_df: pd.DataFrame) -> pd.Series:
+		"""The sources of every article and of its re-posts removed by the deduplication"""
+		if "duplicate_origins" in news_df.columns:
+			return news_df["duplicate_origins"].fillna("").str.split(DUPLICATE_SEPARATOR)
+		if "website_origin" in news_df.columns:
+			return news_df["website_origin"].fillna("").map(lambda origin: [origin])
+		urls = news_df["duplicate_urls"] if "duplicate_urls" in news_df.columns else news_df["url"]
+		return (
+			urls.fillna("")
+			.str.split(DUPLICATE_SEPARATOR)
+			.map(lambda row_urls: [urlparse(url).netloc for url in row_urls])
+		)
+
+	def compute_features(self, news_df: pd.DataFrame, embeddings: np.array) -> pd.DataFrame:
+		"""One row per label with the raw terms of the score and the prompt tokens"""
+		labels = news_df["labels"].to_numpy()
+		normalized = np.asarray(embeddings, dtype=np.float32)
+		norms = np.linalg.norm(normalized, axis=1, keepdims=True)
+		normalized = normalized / np.where(norms == 0, 1, norms)
+		unique_labels, centroids, _ = HierarchicalClusterModeler.compute_centroids(
+			labels, normalized
+		)
+		inverse = np.searchsorted(unique_labels, labels)
+		similarities = np.einsum("ij,ij->i", normalized, centroids[inverse])
+		counts = np.bincount(inverse, minlength=unique_labels.shape[0])
+		cohesion = np.bincount(inverse, weights=similarities) / counts
+
+		articles = news_df.get("duplicate_count", pd.Series(1, index=news_df.index))
+		sources = pd.DataFrame({"labels": labels, "source": self.list_sources(news_df).to_numpy()})
+		sources = sources.explode("source").query("source != ''")
+		posted_at = pd.to_datetime(
+			news_df.get("posted_at", pd.Series(pd.NaT, index=news_df.index)),
+			errors="coerce",
+			utc=True,
+		).dt.tz_convert(None)
+		features = pd.DataFrame(
+			{
+				"labels": labels,
+				"articles": articles.fillna(1).to_numpy(),
+				"prompt_tokens": news_df["content"].str.len().to_numpy() // CHARACTERS_PER_TOKEN,
+				"posted_at": posted_at.to_numpy(),
+			}
+		)
+		features = features.groupby("labels").agg(
+			articles=("articles", "sum"),
+			prompt_tokens=("prompt_tokens", "sum"),
+			newest_posted_at=("posted_at", "max"),
+		)
+		features["sources"] = sources.groupby("labels")["source"].nunique()
+		features["sources"] = features["sources"].fillna(0)
+		features["cohesion"] = pd.Series(cohesion, index=unique_labels)
+		return features
+
+	def compute_scores(self, features: pd.DataFrame) -> pd.Series:
+		"""Weighted sum of the terms, the counts are on a log scale relative to the largest cluster"""
+
+		def log_scale(values: pd.Series) -> pd.Series:
+			return np.log1p(values) / max(np.log1p(values.max()), 1e-9)
+
+		age_hours = (
+			features["newest_posted_at"].max() - features["newest_posted_at"]
+		).dt.total_seconds() / 3600
+		recency = (0.5 ** (age_hours / self.recency_half_life_hours)).fillna(1.0)
+		terms = {
+			"size": log_scale(features["articles"]),
+			"diversity": log_scale(features["sources"]),
+			"recency": recency,
+			"cohesion": features["cohesion"].clip(0, 1),
+		}
+		return sum(self.weights[name] * terms[name] for name in self.weights)
+
+	def select(self, features: pd.DataFrame) -> pd.Index:
+		"""The labels of the best clusters that fit the budget"""
+		cluster_budget = self.get_cluster_budget()
+		selected = []
+		prompt_tokens = 0
+		for label, cluster in features.sort_values("score", ascending=False).iterrows():
+			if cluster_budget is not None and len(selected) >= cluster_budget:
+				break
+			if (
+				self.max_prompt_tokens is not None
+				and prompt_tokens + cluster["prompt_tokens"] > self.max_prompt_tokens
+			):
+				continue
+			selected.append(label)
+			prompt_tokens += cluster["prompt_tokens"]
+		return pd.Index(selected)
+
+	def run(self, news_df: pd.DataFrame, embeddings: np.array) -> pd.DataFrame:
+		"""
+		Keep the news of the selected clusters with their importance score, ordered by label.
+
+		The index of news_df is the row of the article in embeddings.
+		"""
+		if news_df.empty:
+			return news_df
+		with metrics_recorder.stage("cluster.rank", rows=news_df.shape[0]) as stage:
+			features = self.compute_features(news_df, embeddings[news_df.index])
+			features["score"] = self.compute_scores(features)
+			selected_labels = self.select(features)
+			stage.add(
+				clusters=features.shape[0],
+				selected_clusters=selected_labels.shape[0],
+				prompt_tokens=int(features.loc[selected_labels, "prompt_tokens"].sum()),
+			)
+		logger.info(
+			f"selected {selected_labels.shape[0]} of {features.shape[0]} clusters, "
+			f"about {int(features.loc[selected_labels, 'prompt_tokens'].sum())} prompt tokens"
+		)
+		ranked_news_df = news_df.loc[news_df["labels"].isin(selected_labels)].copy()
+		ranked_news_df["importance"] = ranked_news_df["labels"].map(features["score"])
+		return ranked_news_df.sort_values(by="labels", kind="stable")
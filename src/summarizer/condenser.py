@@ -0,0 +1,156 @@
+import re
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from src.shared.logger import setup_logger
+from src.shared.metrics import metrics_recorder
+from src.summarizer.cluster_modeler import HierarchicalClusterModeler
+from src.summarizer.cluster_ranker import CHARACTERS_PER_TOKEN
+from src.summarizer.embeddings_computer import EmbeddingsComputer
+
+logger = setup_logger("condenser")
+
+# the end of a sentence is a punctuation followed by a capital letter, a quote or a line break
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?…])\s+(?=[A-ZÀ-Ý«\"“])|\n+")
+
+
+def split_sentences(text: str, min_characters: int = 40) -> List[str]:
+	"""Split the article in sentences, drop the short ones (bylines, captions, share buttons)"""
+	sentences = (sentence.strip() for sentence in SENTENCE_BOUNDARY.split(text))
+	return [sentence for sentence in sentences if len(sentence) >= min_characters]
+
+
+def select_sentences(
+	sentence_embeddings: np.array,
+	centroid: np.array,
+	sentence_tokens: np.array,
+	token_budget: int,
+	diversity: float = 0.3,
+) -> List[int]:
+	"""
+	Select the sentences with the maximal marginal relevance until the token budget is spent.
+
+	The relevance is the cosine similarity to the centroid of the cluster, the redundancy the highest
+	similarity to a selected sentence; diversity is the weight of the redundancy.
+	"""
+	relevance = sentence_embeddings @ centroid
+	redundancy = np.full(relevance.shape[0], -np.inf)
+	is_available = np.ones(relevance.shape[0], dtype=bool)
+	selected = []
+	used_tokens = 0
+	while is_available.any():
+		redundancy_term = np.where(np.isinf(redundancy), 0, redundancy)
+		scores = (1 - diversity) * relevance - diversity * redundancy_term
+		scores[~is_available] = -np.inf
+		best = int(np.argmax(scores))
+		is_available[best] = False
+		if used_tokens + sentence_tokens[best] > token_budget:
+			# a shorter sentence may still fit
+			continue
+		selected.append(best)
+		used_tokens += sentence_tokens[best]
+		np.maximum(redundancy, sentence_embeddings @ sentence_embeddings[best], out=redundancy)
+	return selected
+
+
+class ExtractiveCondenser:
+	"""
+	Condense every cluster to its most central and least redundant sentences before the summarization.
+
+	The sentences are embedded with the model of the clustering, so they are compared to the centroid of
+	the article embeddings of their cluster. The selected sentences of an article are kept in their order
+	in condensed_content, the generator uses them instead of the whole content. A cluster that already
+	fits the token budget is not condensed, its condensed_content is empty.
+	"""
+
+	def __init__(
+		self,
+		embeddings_computer: EmbeddingsComputer,
+		token_budget: int = 2048,
+		diversity: float = 0.3,
+		min_sentence_characters: int = 40,
+	) -> None:
+		self.embeddings_computer = embeddings_computer
+		self.token_budget = token_budget
+		self.diversity = diversity
+		self.min_sentence_characters = min_sentence_characters
+
+	@staticmethod
+	def normalize(embeddings: np.array) -> np.array:
+		embeddings = np.asarray(embeddings, dtype=np.float32)
+		norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+		return embeddings / np.where(norms == 0, 1, norms)
+
+	def run(self, news_df: pd.DataFrame, embeddings: np.array) -> pd.DataFrame:
+		"""
+		Add condensed_content to the news, the index of news_df is the row of the article in embeddings.
+		"""
+		if news_df.empty:
+			return news_df
+		news_df = news_df.copy()
+		# the clusters that are not condensed keep an empty condensed_content, the generator uses content
+		news_df["condensed_content"] = ""
+		content_tokens = news_df["content"].str.len() // CHARACTERS_PER_TOKEN
+		cluster_tokens = content_tokens.groupby(news_df["labels"]).transform("sum")
+		to_condense = news_df.loc[cluster_tokens > self.token_budget]
+		condensed_labels = []
+		with metrics_recorder.stage("condense", rows=to_condense.shape[0]) as stage:
+			sentence_rows = [
+				(index, sentence)
+				for index, content in to_condense["content"].items()
+				for sentence in split_sentences(content, self.min_sentence_characters)
+			]
+			if sentence_rows:
+				sentences_df = pd.DataFrame(sentence_rows, columns=["article", "sentence"])
+				sentences_df["labels"] = to_condense.loc[
+					sentences_df["article"], "labels"
+				].to_numpy()
+				sentences_df["tokens"] = sentences_df["sentence"].str.len() // CHARACTERS_PER_TOKEN
+				sentence_embeddings = self.normalize(
+					self.embeddings_computer.run(sentences_df["sentence"])
+				)
+				labels, centroids, _ = HierarchicalClusterModeler.compute_centroids(
+					to_condense["labels"].to_numpy(),
+					self.normalize(embeddings[to_condense.index]),
+				)
+				selected_rows = []
+				for label, centroid in zip(labels, centroids):
+					rows = np.flatnonzero(sentences_df["labels"].to_numpy() == label)
+					selected = select_sentences(
+						sentence_embeddings[rows],
+						centroid,
+						sentences_df["tokens"].to_numpy()[rows],
+						self.token_budget,
+						self.diversity,
+					)
+					selected_rows.extend(rows[selected])
+				# the sentences keep the order of the articles and of the text
+				selected_sentences = sentences_df.iloc[np.sort(selected_rows)]
+				condensed = selected_sentences.groupby("article")["sentence"].agg(" ".join)
+				# a cluster without any selected sentence keeps its whole content
+				condensed_labels = selected_sentences["labels"].unique()
+				condensed_articles = to_condense.loc[
+					to_condense["labels"].isin(condensed_labels)
+				].index
+				news_df.loc[condensed_articles, "condensed_content"] = (
+					condensed.reindex(condensed_articles).fillna("").to_numpy()
+				)
+			is_condensed = news_df["labels"].isin(condensed_labels)
+			before_tokens = int(content_tokens.sum())
+			after_tokens = int(
+				content_tokens[~is_condensed].sum()
+				+ (news_df["condensed_content"].str.len() // CHARACTERS_PER_TOKEN).sum()
+			)
+			stage.add(
+				clusters=len(condensed_labels),
+				sentences=len(sentence_rows),
+				prompt_tokens_before=before_tokens,
+				prompt_tokens_after=after_tokens,
+			)
+		logger.info(
+			f"condensed {len(condensed_labels)} of {news_df['labels'].nunique()} clusters, "
+			f"about {before_tokens} prompt tokens to {after_tokens}"
+		)
+		return news_df
@@ -1,3 +1,5 @@
+import json
+from datetime import date, datetime
 from os import getenv
 from pathlib import Path
 from typing import Dict
@@ -7,20 +9,55 @@ import pandas as pd
 from dotenv import load_dotenv
 
 from src.shared.cloud_storage.cloud_storage import BackBlazeCloudStorage
-from src.shared.database import execute_query, generate_database_connection
+from src.shared.database import execute_query, pooled_connection, stream_query
 from src.shared.logger import setup_logger
+from src.shared.metrics import metrics_recorder
 
 logger = setup_logger("data_puller")
 
+ARTICLE_COLUMNS = ["database_id", "content", "title", "posted_at", "url", "website_origin"]
+# a half open range on the raw column, the index on posted_at can be used unlike with posted_at::date,
+# the end is the next day of the database clock like the former BETWEEN ... AND CURRENT_DATE
+ARTICLE_RANGE_QUERY = "SELECT id AS database_id, content, title, posted_at, url, website_origin FROM article WHERE posted_at >= %(start)s AND posted_at < CURRENT_DATE + 1"
+# the csv of a COPY export read like the rows of execute_query: the text columns stay strings, an
+# empty field or a title like "NA" or "null" is not a missing value
+ARTICLE_CSV_OPTIONS = {
+	"parse_dates": ["posted_at"],
+	"keep_default_na": False,
+	"dtype": {"content": str, "title": str, "url": str, "website_origin": str},
+}
+# what changes when an article of the range is added or removed, without reading the articles
+ARTICLE_RANGE_FINGERPRINT_QUERY = "SELECT count(*) AS rows, max(id) AS max_id, CURRENT_DATE AS end_date FROM article WHERE posted_at >= %(start)s AND posted_at < CURRENT_DATE + 1"
+
+
+def load_news_snapshot(file_path: str | Path) -> pd.DataFrame:
+	"""Read one of the news exports in data/, the older ones are comma separated the newer pipe separated"""
+	with open(file_path, encoding="utf-8") as snapshot_file:
+		header = snapshot_file.readline()
+	separator = "|" if "|" in header else ","
+	news_df = pd.read_csv(file_path, sep=separator)
+	news_df = news_df.drop(
+		columns=[column for column in news_df.columns if column.startswith("Unnamed")]
+	)
+	news_df = news_df.dropna(subset=["content"]).drop_duplicates(subset="content")
+	return news_df.reset_index(drop=True)
+
 
 class DataPuller:
 	"""This class will be responsible to read the data for the new summarizer and save the data into a local storage or into a cloud bucket."""
 
-	def __init__(self, environment: str, date: str) -> None:
+	def __init__(
+		self, environment: str, date: str, incremental: bool = False, chunk_size: int = 2000
+	) -> None:
 		current_directory = Path.cwd()
 		self.current_directory = current_directory
 		env_file = current_directory.joinpath(f".env_{environment}")
+		self.environment = environment
 		self.date = date
+		self.incremental = incremental
+		self.chunk_size = chunk_size
+		self.watermark_path = current_directory.joinpath("cache", f"watermark_{environment}.json")
+		self.pulled_watermark = None
 		load_dotenv(dotenv_path=env_file, override=True)
 
 	def load_database_credentials(self) -> Dict[str, str]:
@@ -48,21 +85,100 @@ class DataPuller:
 			"database": database_name,
 		}
 
+	def get_date_range(self) -> Dict[str, date]:
+		"""The start of the pull, the end of the range is computed by the database in the query"""
+		return {"start": date.fromisoformat(self.date)}
+
+	def get_fingerprint(self) -> Dict[str, str]:
+		"""
+		The number of articles of the range, their last id and the day of the database.
+
+		The range of read_data ends with the day of the database, the articles posted since a previous
+		pull of the same date change the fingerprint.
+		"""
+		with pooled_connection(self.load_database_credentials()) as connection:
+			rows = execute_query(connection, ARTICLE_RANGE_FINGERPRINT_QUERY, self.get_date_range())
+		return {field: str(value) for field, value in rows[0]._asdict().items()}
+
 	def read_data(self) -> pd.DataFrame:
-		"""Read the data from the database and return the pandas dataframe of the data."""
+		"""
+		Read the data from the database and return the pandas dataframe of the data.
+
+		The rows are fetched as tuples, scripts/benchmark_data_pull.py found the COPY export parsed by
+		pandas slower on the article text.
+		"""
 
 		database_credentials = self.load_database_credentials()
-		connection = generate_database_connection(database_credentials)
-		logger.info("done connecting to the database")
-		article_query = f"SELECT id AS database_id, content, title, posted_at, url FROM article WHERE posted_at::date BETWEEN '{self.date}' AND CURRENT_DATE"
-		today_articles = execute_query(connection, article_query)
-		news_df = pd.DataFrame(today_articles)
+		with pooled_connection(database_credentials) as connection:
+			logger.info("done connecting to the database")
+			rows = execute_query(connection, ARTICLE_RANGE_QUERY, self.get_date_range())
+		news_df = pd.DataFrame(rows, columns=ARTICLE_COLUMNS)
 		logger.info(f"today news data is of shape: {news_df.shape[0]}")
-		news_df.columns = ["database_id", "content", "title", "posted_at", "url"]
+		if news_df.empty:
+			return pd.DataFrame(columns=ARTICLE_COLUMNS)
+		# the deduplication joins the titles and the urls, a NULL is an empty string
+		text_columns = ["title", "url", "website_origin"]
+		news_df[text_columns] = news_df[text_columns].fillna("")
 		news_df = news_df.drop_duplicates(subset="content").reset_index(drop=True)
 
 		return news_df
 
+	def load_watermark(self) -> Dict | None:
+		"""Load the last posted_at and id pulled in this environment, None if we never pulled"""
+		if not self.watermark_path.exists():
+			return None
+		with open(self.watermark_path) as watermark_file:
+			watermark = json.load(watermark_file)
+		watermark["posted_at"] = datetime.fromisoformat(watermark["posted_at"])
+		return watermark
+
+	def save_watermark(self) -> None:
+		"""Persist the high-water mark of the last pull, call it once the pulled articles are processed"""
+		if self.pulled_watermark is None:
+			return
+		self.watermark_path.parent.mkdir(parents=True, exist_ok=True)
+		watermark = {
+			"posted_at": self.pulled_watermark["posted_at"].isoformat(),
+			"database_id": int(self.pulled_watermark["database_id"]),
+		}
+		with open(self.watermark_path, "w") as watermark_file:
+			json.dump(watermark, watermark_file)
+		logger.info(f"saved the watermark {watermark} for {self.environment}")
+
+	def read_new_data(self) -> pd.DataFrame:
+		"""
+		Read the articles posted after the watermark, stream them in chunks with a server side cursor.
+
+		Without a watermark we pull the articles from self.date like read_data.
+		"""
+		database_credentials = self.load_database_credentials()
+		watermark = self.load_watermark()
+		if watermark is None:
+			logger.info(f"no watermark found for {self.environment}, pulling from {self.date}")
+			article_query = "SELECT id AS database_id, content, title, posted_at, url, website_origin FROM article WHERE posted_at >= %(date)s ORDER BY posted_at, id"
+			params = {"date": self.date}
+		else:
+			logger.info(f"pulling the articles posted after {watermark}")
+			article_query = "SELECT id AS database_id, content, title, posted_at, url, website_origin FROM article WHERE (posted_at, id) > (%(posted_at)s, %(database_id)s) ORDER BY posted_at, id"
+			params = watermark
+		with pooled_connection(database_credentials) as connection:
+			logger.info("done connecting to the database")
+			chunks = [
+				pd.DataFrame.from_records(rows, columns=ARTICLE_COLUMNS)
+				for rows in stream_query(
+					connection, article_query, params, chunk_size=self.chunk_size
+				)
+			]
+		if not chunks:
+			logger.info("no new articles since the last pull")
+			return pd.DataFrame(columns=ARTICLE_COLUMNS)
+		news_df = pd.concat(chunks, ignore_index=True)
+		logger.info(f"new news data is of shape: {news_df.shape[0]}")
+		# rows are ordered by (posted_at, id) so the last one is the new high-water mark
+		self.pulled_watermark = news_df.iloc[-1][["posted_at", "database_id"]].to_dict()
+		news_df = news_df.drop_duplicates(subset="content").reset_index(drop=True)
+		return news_df
+
 	def save_data(self, data: pd.DataFrame, storage_mode="local") -> str:
 		"""Save data either to the local environment or to a cloud bucket."""
 
@@ -81,6 +197,11 @@ class DataPuller:
 		"""
 		Read the data from the database and return the data.
 		"""
-		news_df = self.read_data()
+		with metrics_recorder.stage("pull") as stage:
+			if self.incremental:
+				news_df = self.read_new_data()
+			else:
+				news_df = self.read_data()
+			stage.add(rows=news_df.shape[0])
 		logger.info("done reading the data")
 		return news_df
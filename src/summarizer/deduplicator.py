@@ -0,0 +1,144 @@
+import re
+from collections import defaultdict
+from typing import List
+from unicodedata import normalize
+from zlib import crc32
+
+import numpy as np
+import pandas as pd
+
+from src.shared.columnar import DUPLICATE_SEPARATOR
+from src.shared.logger import setup_logger
+from src.shared.metrics import metrics_recorder
+
+logger = setup_logger("deduplicator")
+
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+WORD_PATTERN = re.compile(r"\w+")
+
+
+class NearDuplicateRemover:
+	"""
+	Find the near duplicate articles with MinHash and LSH and keep one article per group.
+
+	The re-posts of the same article that only differ by a byline, the site name or the whitespaces
+	have almost the same word shingles, their estimated Jaccard similarity is above the threshold.
+	The kept article is the longest one, the titles and urls of the whole group are carried forward in
+	the duplicate_titles and duplicate_urls columns.
+	"""
+
+	def __init__(
+		self,
+		threshold: float = 0.8,
+		shingle_size: int = 5,
+		number_of_bands: int = 16,
+		rows_per_band: int = 8,
+		seed: int = 42,
+	) -> None:
+		self.threshold = threshold
+		self.shingle_size = shingle_size
+		self.number_of_bands = number_of_bands
+		self.rows_per_band = rows_per_band
+		number_of_permutations = number_of_bands * rows_per_band
+		generator = np.random.default_rng(seed)
+		self.permutation_a = generator.integers(
+			1, MERSENNE_PRIME, size=number_of_permutations, dtype=np.uint64
+		)
+		self.permutation_b = generator.integers(
+			0, MERSENNE_PRIME, size=number_of_permutations, dtype=np.uint64
+		)
+
+	def compute_shingles(self, content: str) -> np.array:
+		"""Hash the word shingles of the normalized content"""
+		words = WORD_PATTERN.findall(normalize("NFKD", content).lower())
+		if len(words) < self.shingle_size:
+			shingles = [" ".join(words)]
+		else:
+			shingles = [
+				" ".join(words[index : index + self.shingle_size])
+				for index in range(len(words) - self.shingle_size + 1)
+			]
+		return np.unique(
+			np.array([crc32(shingle.encode("utf-8")) for shingle in shingles], dtype=np.uint64)
+		)
+
+	def compute_signature(self, shingles: np.array) -> np.array:
+		"""MinHash signature, the minimum of every permutation over the shingles"""
+		hashes = (shingles[:, None] * self.permutation_a + self.permutation_b) % MERSENNE_PRIME
+		return np.bitwise_and(hashes, MAX_HASH).min(axis=0)
+
+	def find_groups(self, documents: List[str]) -> np.array:
+		"""Return the group id of every document, near duplicates share the same group id"""
+		signatures = np.stack(
+			[self.compute_signature(self.compute_shingles(document)) for document in documents]
+		)
+		parents = np.arange(len(documents))
+
+		def find(index: int) -> int:
+			while parents[index] != index:
+				parents[index] = parents[parents[index]]
+				index = parents[index]
+			return index
+
+		for band in range(self.number_of_bands):
+			buckets = defaultdict(list)
+			band_signatures = signatures[
+				:, band * self.rows_per_band : (band + 1) * self.rows_per_band
+			]
+			for index, band_signature in enumerate(band_signatures):
+				buckets[band_signature.tobytes()].append(index)
+			for candidates in buckets.values():
+				first = candidates[0]
+				for other in candidates[1:]:
+					if find(first) == find(other):
+						continue
+					similarity = np.mean(signatures[first] == signatures[other])
+					if similarity >= self.threshold:
+						parents[find(other)] = find(first)
+		return np.array([find(index) for index in range(len(documents))])
+
+	def run(self, news_df: pd.DataFrame) -> pd.DataFrame:
+		"""Keep the longest article of every group of near duplicates"""
+		if news_df.empty:
+			return news_df
+		with metrics_recorder.stage("deduplicate", rows=news_df.shape[0]) as stage:
+			representatives = self.remove_duplicates(news_df)
+			stage.add(removed_rows=news_df.shape[0] - representatives.shape[0])
+		return representatives
+
+	def remove_duplicates(self, news_df: pd.DataFrame) -> pd.DataFrame:
+		"""Group the near duplicates and keep the longest article of every group with the group columns"""
+		news_df = news_df.copy()
+		news_df["duplicate_group"] = self.find_groups(news_df["content"].tolist())
+		news_df["content_length"] = news_df["content"].str.len()
+		groups = news_df.groupby("duplicate_group", sort=False)
+		duplicate_titles = groups["title"].agg(
+			lambda titles: DUPLICATE_SEPARATOR.join(dict.fromkeys(titles))
+		)
+		duplicate_urls = groups["url"].agg(
+			lambda urls: DUPLICATE_SEPARATOR.join(dict.fromkeys(urls))
+		)
+		duplicate_count = groups.size()
+		representatives = news_df.loc[groups["content_length"].idxmax()]
+		representatives = representatives.sort_index()
+		representatives["duplicate_titles"] = representatives["duplicate_group"].map(
+			duplicate_titles
+		)
+		representatives["duplicate_urls"] = representatives["duplicate_group"].map(duplicate_urls)
+		representatives["duplicate_count"] = representatives["duplicate_group"].map(duplicate_count)
+		if "website_origin" in news_df.columns:
+			# the sites of the re-posts, the cluster ranking counts them as sources
+			duplicate_origins = groups["website_origin"].agg(
+				lambda origins: DUPLICATE_SEPARATOR.join(dict.fromkeys(origins.fillna("")))
+			)
+			representatives["duplicate_origins"] = representatives["duplicate_group"].map(
+				duplicate_origins
+			)
+		removed = news_df.shape[0] - representatives.shape[0]
+		logger.info(
+			f"removed {removed} near duplicates out of {news_df.shape[0]} articles, saving {removed} embeddings"
+		)
+		return representatives.drop(columns=["duplicate_group", "content_length"]).reset_index(
+			drop=True
+		)
@@ -0,0 +1,43 @@
+import json
+import time
+from typing import List
+from urllib.request import Request, urlopen
+
+import numpy as np
+
+from src.shared.logger import setup_logger
+
+logger = setup_logger("embedding_client")
+
+
+class EmbeddingServerClient:
+	"""Client of the resident embedding server, it does not import torch nor load the model"""
+
+	def __init__(self, server_url: str, timeout: float = 1800) -> None:
+		self.server_url = server_url.rstrip("/")
+		self.timeout = timeout
+
+	def health(self) -> dict:
+		with urlopen(f"{self.server_url}/health", timeout=self.timeout) as response:
+			return json.loads(response.read())
+
+	def encode(self, documents: List[str], model_id: str) -> np.array:
+		"""Encode the documents on the server, raise a ValueError if the server runs another model"""
+		request = Request(
+			f"{self.server_url}/encode",
+			data=json.dumps({"documents": documents}).encode("utf-8"),
+			headers={"Content-Type": "application/json"},
+		)
+		start = time.perf_counter()
+		with urlopen(request, timeout=self.timeout) as response:
+			if response.headers["X-Model-Id"] != model_id:
+				raise ValueError(
+					f"the embedding server runs {response.headers['X-Model-Id']}, expected {model_id}"
+				)
+			shape = tuple(int(size) for size in response.headers["X-Embedding-Shape"].split(","))
+			embeddings = np.frombuffer(response.read(), dtype=np.float32).reshape(shape)
+			logger.info(
+				f"the server encoded {len(documents)} documents in {response.headers['X-Encode-Seconds']}s, "
+				f"{time.perf_counter() - start:.2f}s with the transfer"
+			)
+		return embeddings
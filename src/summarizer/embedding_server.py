@@ -0,0 +1,113 @@
+"""
+A resident embedding server, it loads the embedding model once and encodes the documents it receives.
+
+python src/summarizer/embedding_server.py --port 8765
+
+POST /encode with {"documents": [...]} returns the float32 embeddings as raw bytes, their shape is in the
+X-Embedding-Shape header. GET /health returns the model id and the model load time.
+"""
+
+import json
+import threading
+import time
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from src.shared.logger import setup_logger
+from src.summarizer.embeddings_computer import EmbeddingsComputer
+
+logger = setup_logger("embedding_server")
+
+
+class EmbeddingRequestHandler(BaseHTTPRequestHandler):
+	"""Handle the encode and health requests, the embeddings computer is shared by the server"""
+
+	server: "EmbeddingServer"
+
+	def send_json(self, status: int, payload: dict) -> None:
+		body = json.dumps(payload).encode("utf-8")
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_GET(self) -> None:
+		if self.path != "/health":
+			self.send_json(404, {"error": f"unknown path {self.path}"})
+			return
+		self.send_json(
+			200,
+			{
+				"status": "ok",
+				"model_id": self.server.embeddings_computer.cache_model_id,
+				"load_seconds": self.server.load_seconds,
+				"encoded_documents": self.server.encoded_documents,
+			},
+		)
+
+	def do_POST(self) -> None:
+		if self.path != "/encode":
+			self.send_json(404, {"error": f"unknown path {self.path}"})
+			return
+		try:
+			content_length = int(self.headers["Content-Length"])
+			documents = json.loads(self.rfile.read(content_length))["documents"]
+		except (TypeError, ValueError, KeyError) as e:
+			self.send_json(400, {"error": f"the body must be a json with documents: {e}"})
+			return
+		start = time.perf_counter()
+		# the model is not shared between concurrent encodes
+		with self.server.encode_lock:
+			embeddings = self.server.embeddings_computer.embed_documents(documents)
+			self.server.encoded_documents += len(documents)
+		encode_seconds = time.perf_counter() - start
+		body = np.ascontiguousarray(embeddings, dtype=np.float32).tobytes()
+		self.send_response(200)
+		self.send_header("Content-Type", "application/octet-stream")
+		self.send_header("Content-Length", str(len(body)))
+		self.send_header("X-Embedding-Shape", ",".join(str(size) for size in embeddings.shape))
+		self.send_header("X-Model-Id", self.server.embeddings_computer.cache_model_id)
+		self.send_header("X-Encode-Seconds", f"{encode_seconds:.3f}")
+		self.end_headers()
+		self.wfile.write(body)
+		logger.info(f"encoded {len(documents)} documents in {encode_seconds:.2f}s")
+
+	def log_message(self, format: str, *args) -> None:
+		logger.debug(format % args)
+
+
+class EmbeddingServer(ThreadingHTTPServer):
+	"""Keep the embedding model loaded between the clustering runs"""
+
+	def __init__(
+		self, address: tuple[str, int], embeddings_computer: EmbeddingsComputer, load_seconds: float
+	):
+		super().__init__(address, EmbeddingRequestHandler)
+		self.embeddings_computer = embeddings_computer
+		self.load_seconds = load_seconds
+		self.encoded_documents = 0
+		self.encode_lock = threading.Lock()
+
+
+if __name__ == "__main__":
+	parser = ArgumentParser()
+	parser.add_argument("--host", default="127.0.0.1")
+	parser.add_argument("--port", type=int, default=8765)
+	parser.add_argument("--embedding_model_id", default="dunzhang/stella_en_400M_v5")
+	parser.add_argument("--token_budget", type=int, default=16384)
+	parser.add_argument("--chunk_long_documents", action="store_true")
+	args = parser.parse_args()
+
+	start = time.perf_counter()
+	embeddings_computer = EmbeddingsComputer(
+		embedding_model_id=args.embedding_model_id,
+		token_budget=args.token_budget,
+		chunk_long_documents=args.chunk_long_documents,
+	)
+	load_seconds = time.perf_counter() - start
+	server = EmbeddingServer((args.host, args.port), embeddings_computer, load_seconds)
+	logger.info(f"serving {embeddings_computer.cache_model_id} on {args.host}:{args.port}")
+	server.serve_forever()
@@ -0,0 +1,127 @@
+import sqlite3
+import time
+from hashlib import blake2b
+from pathlib import Path
+from typing import Dict, Iterable, List
+
+import numpy as np
+
+from src.shared.logger import setup_logger
+
+logger = setup_logger("embeddings_cache")
+
+# sqlite limits the number of host parameters in a single statement
+SQLITE_BATCH_SIZE = 500
+
+
+class EmbeddingsCache:
+	"""
+	On disk store of document embeddings keyed by the embedding model id and a hash of the document content.
+
+	The store is a single sqlite file, entries are evicted when they were not used for `max_age_days`
+	or when the store grows over `max_size_mb`, the least recently used entries go first.
+	"""
+
+	def __init__(
+		self,
+		cache_path: str | Path,
+		max_age_days: float = 30,
+		max_size_mb: float = 512,
+	) -> None:
+		self.cache_path = Path(cache_path)
+		self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+		self.max_age_days = max_age_days
+		self.max_size_mb = max_size_mb
+		self.connection = sqlite3.connect(self.cache_path.as_posix())
+		self.connection.execute(
+			"""
+			CREATE TABLE IF NOT EXISTS embeddings (
+				model_id TEXT NOT NULL,
+				content_hash TEXT NOT NULL,
+				embedding BLOB NOT NULL,
+				dimension INTEGER NOT NULL,
+				created_at REAL NOT NULL,
+				last_used_at REAL NOT NULL,
+				PRIMARY KEY (model_id, content_hash)
+			)
+			"""
+		)
+		self.connection.execute(
+			"CREATE INDEX IF NOT EXISTS embeddings_last_used_at ON embeddings (last_used_at)"
+		)
+		self.connection.commit()
+
+	@staticmethod
+	def hash_content(content: str) -> str:
+		"""Hash the document content, any change in the text gives a new key"""
+		return blake2b(content.encode("utf-8"), digest_size=16).hexdigest()
+
+	def get_many(self, model_id: str, content_hashes: Iterable[str]) -> Dict[str, np.array]:
+		"""Return the cached embeddings for the given hashes, missing hashes are not in the result"""
+		content_hashes = list(dict.fromkeys(content_hashes))
+		found = {}
+		for start in range(0, len(content_hashes), SQLITE_BATCH_SIZE):
+			batch = content_hashes[start : start + SQLITE_BATCH_SIZE]
+			placeholders = ",".join("?" * len(batch))
+			rows = self.connection.execute(
+				f"SELECT content_hash, embedding FROM embeddings WHERE model_id = ? AND content_hash IN ({placeholders})",
+				[model_id, *batch],
+			)
+			for content_hash, embedding in rows:
+				found[content_hash] = np.frombuffer(embedding, dtype=np.float32)
+		if found:
+			self._touch(model_id, list(found.keys()))
+		return found
+
+	def put_many(self, model_id: str, content_hashes: List[str], embeddings: np.array) -> None:
+		"""Store the embeddings of the documents, the rows of embeddings follow content_hashes"""
+		now = time.time()
+		embeddings = np.asarray(embeddings, dtype=np.float32)
+		rows = [
+			(model_id, content_hash, embedding.tobytes(), embedding.shape[0], now, now)
+			for content_hash, embedding in zip(content_hashes, embeddings)
+		]
+		self.connection.executemany(
+			"INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?, ?)",
+			rows,
+		)
+		self.connection.commit()
+
+	def _touch(self, model_id: str, content_hashes: List[str]) -> None:
+		"""Mark the entries as recently used so they survive the eviction"""
+		now = time.time()
+		self.connection.executemany(
+			"UPDATE embeddings SET last_used_at = ? WHERE model_id = ? AND content_hash = ?",
+			[(now, model_id, content_hash) for content_hash in content_hashes],
+		)
+		self.connection.commit()
+
+	def evict(self) -> int:
+		"""Remove the entries older than max_age_days then the least recently used ones above max_size_mb"""
+		oldest_allowed = time.time() - self.max_age_days * 24 * 3600
+		deleted = self.connection.execute(
+			"DELETE FROM embeddings WHERE last_used_at < ?", (oldest_allowed,)
+		).rowcount
+		max_size_bytes = int(self.max_size_mb * 1024 * 1024)
+		(total_size,) = self.connection.execute(
+			"SELECT COALESCE(SUM(LENGTH(embedding)), 0) FROM embeddings"
+		).fetchone()
+		if total_size > max_size_bytes:
+			rows = self.connection.execute(
+				"SELECT rowid, LENGTH(embedding) FROM embeddings ORDER BY last_used_at ASC"
+			).fetchall()
+			to_delete = []
+			for rowid, size in rows:
+				if total_size <= max_size_bytes:
+					break
+				to_delete.append((rowid,))
+				total_size -= size
+			self.connection.executemany("DELETE FROM embeddings WHERE rowid = ?", to_delete)
+			deleted += len(to_delete)
+		self.connection.commit()
+		if deleted:
+			logger.info(f"evicted {deleted} embeddings from the cache")
+		return deleted
+
+	def close(self) -> None:
+		self.connection.close()
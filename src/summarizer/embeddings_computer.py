@@ -1,10 +1,16 @@
+import time
 from pathlib import Path
-from typing import Iterable
+from typing import TYPE_CHECKING, Iterable, List
 
 import numpy as np
-from sentence_transformers import SentenceTransformer
 
 from src.shared.logger import setup_logger
+from src.shared.metrics import metrics_recorder
+from src.summarizer.embedding_client import EmbeddingServerClient
+from src.summarizer.embeddings_cache import EmbeddingsCache
+
+if TYPE_CHECKING:
+	from sentence_transformers import SentenceTransformer
 
 DEFAULT_TRANSFORMER_KWARGS = {
 	"trust_remote_code": True,  # this is a risky argument!
@@ -14,34 +20,181 @@ DEFAULT_TRANSFORMER_KWARGS = {
 logger = setup_logger("cluster_modeler")
 
 
+def make_token_budget_batches(token_lengths: np.array, token_budget: int) -> List[np.array]:
+	"""
+	Sort the documents by token length and pack them in batches of at most token_budget padded tokens.
+
+	A batch is padded to its longest document, so sorting puts documents of the same length together and
+	the short briefs are not padded to the length of the long reports.
+	Returns the indices of the documents of every batch.
+	"""
+	order = np.argsort(-token_lengths, kind="stable")
+	batches = []
+	batch_start = 0
+	for position in range(1, len(order) + 1):
+		batch_size = position - batch_start + 1
+		# the first document of a batch is the longest one
+		if position == len(order) or batch_size * token_lengths[order[batch_start]] > token_budget:
+			batches.append(order[batch_start:position])
+			batch_start = position
+	return batches
+
+
 class EmbeddingsComputer:
 	"""class that compute the document embedding"""
 
-	def __init__(self, embedding_model_id: str) -> None:
+	def __init__(
+		self,
+		embedding_model_id: str,
+		embeddings_cache: EmbeddingsCache | None = None,
+		token_budget: int = 16384,
+		chunk_long_documents: bool = False,
+		embedding_server_url: str | None = None,
+	) -> None:
 		self.embedding_model_id = embedding_model_id
+		self.embeddings_cache = embeddings_cache
+		self.token_budget = token_budget
+		self.chunk_long_documents = chunk_long_documents
+		# the pooled chunks do not give the same embedding as the truncated document
+		self.cache_model_id = (
+			f"{embedding_model_id}#chunked" if chunk_long_documents else embedding_model_id
+		)
 		current_directory = Path.cwd()
 		self.current_directory = current_directory
-		self.sentence_transformer_model = self.init_sentence_transformer()
+		self.embedding_server = None
+		self.sentence_transformer_model = None
+		if embedding_server_url:
+			# the resident server has the model loaded, this process does not import torch
+			self.embedding_server = EmbeddingServerClient(embedding_server_url)
+		else:
+			self.sentence_transformer_model = self.init_sentence_transformer()
 
 	def init_sentence_transformer(
 		self, transformer_kwargs: dict = DEFAULT_TRANSFORMER_KWARGS
-	) -> SentenceTransformer:
+	) -> "SentenceTransformer":
 		"""Initialize the sentence transformer model"""
+		from sentence_transformers import SentenceTransformer
 
+		start = time.perf_counter()
 		embedding_model_path = self.current_directory.joinpath("models", self.embedding_model_id)
 		model_path = self.current_directory.joinpath(self.embedding_model_id)
 		transformer_kwargs["cache_folder"] = model_path
 		transformer_kwargs["model_name_or_path"] = embedding_model_path.__str__()
 		sentence_transformer_model = SentenceTransformer(**transformer_kwargs)
+		logger.info(f"loaded {self.embedding_model_id} in {time.perf_counter() - start:.2f}s")
 		return sentence_transformer_model
 
+	def split_long_documents(self, documents: List[str]) -> tuple[List[str], np.array]:
+		"""
+		Split the documents longer than the model max length in chunks of max length tokens.
+
+		Returns the texts to embed and the index of the document of every text.
+		"""
+		tokenizer = self.sentence_transformer_model.tokenizer
+		# leave room for the special tokens added by the model
+		chunk_length = self.sentence_transformer_model.max_seq_length - 2
+		texts = []
+		owners = []
+		token_ids = tokenizer(documents, add_special_tokens=False, truncation=False)["input_ids"]
+		for index, (document, document_token_ids) in enumerate(zip(documents, token_ids)):
+			if len(document_token_ids) <= chunk_length:
+				texts.append(document)
+				owners.append(index)
+				continue
+			for start in range(0, len(document_token_ids), chunk_length):
+				chunk_ids = document_token_ids[start : start + chunk_length]
+				texts.append(tokenizer.decode(chunk_ids, skip_special_tokens=True))
+				owners.append(index)
+		return texts, np.array(owners)
+
+	def pool_chunks(
+		self,
+		embeddings: np.array,
+		owners: np.array,
+		token_lengths: np.array,
+		number_of_documents: int,
+	) -> np.array:
+		"""Average the chunk embeddings of every document, weighted by their number of tokens"""
+		weights = token_lengths.astype(np.float32)[:, None]
+		pooled = np.zeros((number_of_documents, embeddings.shape[1]), dtype=np.float32)
+		np.add.at(pooled, owners, embeddings * weights)
+		total_weights = np.zeros(number_of_documents, dtype=np.float32)
+		np.add.at(total_weights, owners, weights[:, 0])
+		pooled /= total_weights[:, None]
+		norms = np.linalg.norm(embeddings, axis=1)
+		if np.allclose(norms, 1, atol=1e-3):
+			# keep the pooled embeddings normalized like the model output
+			pooled /= np.linalg.norm(pooled, axis=1, keepdims=True)
+		return pooled
+
 	def embed_documents(self, documents: Iterable[str]) -> np.array:
-		"""Embed the documents using the sentence transformer model"""
-		today_news_embeddings = self.sentence_transformer_model.encode(
-			documents, show_progress_bar=True
+		"""
+		Embed the documents using the sentence transformer model.
+
+		The documents are sorted by token length and packed in batches of at most token_budget padded
+		tokens, the embeddings come back in the order of the documents.
+		"""
+		documents = list(documents)
+		if self.embedding_server is not None:
+			return self.embedding_server.encode(documents, model_id=self.cache_model_id)
+		start = time.perf_counter()
+		model = self.sentence_transformer_model
+		tokenizer = getattr(model, "tokenizer", None)
+		if tokenizer is None or not documents:
+			return model.encode(documents, show_progress_bar=True)
+		texts, owners = documents, np.arange(len(documents))
+		if self.chunk_long_documents:
+			texts, owners = self.split_long_documents(documents)
+		token_ids = tokenizer(texts, add_special_tokens=True, truncation=False)["input_ids"]
+		token_lengths = np.minimum([len(ids) for ids in token_ids], model.max_seq_length)
+		batches = make_token_budget_batches(token_lengths, self.token_budget)
+		logger.info(
+			f"embedding {len(texts)} texts in {len(batches)} batches of at most {self.token_budget} tokens"
 		)
-		return today_news_embeddings
+		embeddings = None
+		for batch in batches:
+			batch_embeddings = model.encode(
+				[texts[index] for index in batch],
+				batch_size=len(batch),
+				show_progress_bar=False,
+				convert_to_numpy=True,
+			)
+			if embeddings is None:
+				embeddings = np.empty((len(texts), batch_embeddings.shape[1]), dtype=np.float32)
+			embeddings[batch] = batch_embeddings
+		logger.info(f"encoded {len(texts)} texts in {time.perf_counter() - start:.2f}s")
+		metrics_recorder.get_stage("embed").add(
+			encoded_texts=len(texts), tokens=int(token_lengths.sum())
+		)
+		if len(texts) == len(documents):
+			return embeddings
+		return self.pool_chunks(embeddings, owners, token_lengths, len(documents))
+
+	def embed_documents_with_cache(self, documents: Iterable[str]) -> np.array:
+		"""Embed only the documents missing from the cache, the rows follow the order of the documents"""
+		documents = list(documents)
+		content_hashes = [EmbeddingsCache.hash_content(document) for document in documents]
+		cached_embeddings = self.embeddings_cache.get_many(self.cache_model_id, content_hashes)
+		missing_documents = {}
+		for content_hash, document in zip(content_hashes, documents):
+			if content_hash not in cached_embeddings:
+				missing_documents.setdefault(content_hash, document)
+		logger.info(
+			f"{len(missing_documents)} of {len(documents)} documents are not in the embeddings cache"
+		)
+		metrics_recorder.get_stage("embed").add(cache_misses=len(missing_documents))
+		if missing_documents:
+			new_embeddings = self.embed_documents(list(missing_documents.values()))
+			missing_hashes = list(missing_documents.keys())
+			self.embeddings_cache.put_many(self.cache_model_id, missing_hashes, new_embeddings)
+			cached_embeddings.update(zip(missing_hashes, new_embeddings))
+		self.embeddings_cache.evict()
+		return np.stack([cached_embeddings[content_hash] for content_hash in content_hashes])
 
 	def run(self, documents: Iterable[str]) -> np.array:
-		today_news_embeddings = self.embed_documents(documents)
+		documents = list(documents)
+		with metrics_recorder.stage("embed", rows=len(documents)):
+			if self.embeddings_cache is not None:
+				return self.embed_documents_with_cache(documents)
+			today_news_embeddings = self.embed_documents(documents)
 		return today_news_embeddings
@@ -1,13 +1,21 @@
 # Main summarize pipeline
 
 import argparse
+import os
 from datetime import datetime, timedelta
 
 from src.shared.cloud_storage.cloud_storage import BackBlazeCloudStorage
 from src.shared.logger import setup_logger
+from src.shared.metrics import metrics_recorder
 from src.summarizer.cluster_modeler import HierarchicalClusterModeler
+from src.summarizer.cluster_ranker import ClusterRanker, add_budget_arguments
+from src.summarizer.condenser import ExtractiveCondenser
 from src.summarizer.data_puller import DataPuller
+from src.summarizer.deduplicator import NearDuplicateRemover
+from src.summarizer.embeddings_cache import EmbeddingsCache
 from src.summarizer.embeddings_computer import EmbeddingsComputer
+from src.summarizer.scalable_cluster_modeler import TwoStageClusterModeler
+from src.summarizer.story_tracker import StoryTracker
 
 logger = setup_logger("summarizer_clustering_main")
 
@@ -16,23 +24,160 @@ if __name__ == "__main__":
 	# read arg named environment form the command line
 	parser.add_argument("-e", "--environment", default="dev")
 	parser.add_argument("-d", "--days_ago", type=int, default=1)
+	parser.add_argument(
+		"-c",
+		"--embeddings_cache",
+		default="cache/embeddings.sqlite3",
+		help="the sqlite file where to cache the embeddings, pass an empty string to disable it",
+	)
+	parser.add_argument("--cache_max_age_days", type=float, default=30)
+	parser.add_argument("--cache_max_size_mb", type=float, default=512)
+	parser.add_argument(
+		"-i",
+		"--incremental",
+		action="store_true",
+		help="only pull the articles posted since the last successful run",
+	)
+	parser.add_argument(
+		"-f",
+		"--output_format",
+		default="npz",
+		choices=["npz", "csv"],
+		help="npz is the typed columnar handoff, csv is the legacy pipe separated file",
+	)
+	parser.add_argument(
+		"--save_embeddings",
+		action="store_true",
+		help="add the embeddings of the clustered news to the npz file",
+	)
+	parser.add_argument(
+		"--near_duplicate_threshold",
+		type=float,
+		default=0.8,
+		help="the estimated jaccard similarity above which two articles are re-posts, 0 disables it",
+	)
+	parser.add_argument(
+		"--token_budget",
+		type=int,
+		default=16384,
+		help="the maximum number of padded tokens in an embedding batch",
+	)
+	parser.add_argument(
+		"--chunk_long_documents",
+		action="store_true",
+		help="embed the articles longer than the model max length by chunks and average them",
+	)
+	parser.add_argument(
+		"--embedding_server_url",
+		default=os.getenv("EMBEDDING_SERVER_URL"),
+		help="use the resident embedding server instead of loading the model, e.g. http://127.0.0.1:8765",
+	)
+	parser.add_argument(
+		"--clustering_backend",
+		default="dense",
+		choices=["dense", "two_stage"],
+		help="two_stage clusters k-means blocks separately, for windows of weeks of news",
+	)
+	parser.add_argument(
+		"--max_block_size",
+		type=int,
+		default=2000,
+		help="the maximum number of documents clustered together by the two_stage backend",
+	)
+	parser.add_argument(
+		"-t",
+		"--track_stories",
+		action="store_true",
+		help="assign the articles to the stories of the previous runs, only cluster the new ones",
+	)
+	parser.add_argument(
+		"--story_assignment_threshold",
+		type=float,
+		default=0.2,
+		help="the maximum cosine distance between an article and the centroid of its story",
+	)
+	add_budget_arguments(parser)
 	args = parser.parse_args()
-	environment = args.environment
-	days_ago = args.days_ago
-	embedding_model_id = "dunzhang/stella_en_400M_v5"
-	date = (datetime.now() - timedelta(days=days_ago)).strftime("%Y-%m-%d")
+	# the metrics of a failed run are written too, its retries and stage timings matter most
+	try:
+		environment = args.environment
+		days_ago = args.days_ago
+		embedding_model_id = "dunzhang/stella_en_400M_v5"
+		date = (datetime.now() - timedelta(days=days_ago)).strftime("%Y-%m-%d")
 
-	data_puller = DataPuller(environment=environment, date=date)
-	today_news_data = data_puller.run()
+		data_puller = DataPuller(environment=environment, date=date, incremental=args.incremental)
+		today_news_data = data_puller.run()
+		if today_news_data.empty:
+			logger.info("no articles to cluster, exiting")
+			raise SystemExit(0)
+		if args.near_duplicate_threshold > 0:
+			deduplicator = NearDuplicateRemover(threshold=args.near_duplicate_threshold)
+			today_news_data = deduplicator.run(today_news_data)
 
-	embedding_modeller = EmbeddingsComputer(embedding_model_id=embedding_model_id)
-	embedding_documents = embedding_modeller.run(documents=today_news_data["content"])
+		embeddings_cache = None
+		if args.embeddings_cache:
+			embeddings_cache = EmbeddingsCache(
+				cache_path=args.embeddings_cache,
+				max_age_days=args.cache_max_age_days,
+				max_size_mb=args.cache_max_size_mb,
+			)
+		embedding_modeller = EmbeddingsComputer(
+			embedding_model_id=embedding_model_id,
+			embeddings_cache=embeddings_cache,
+			token_budget=args.token_budget,
+			chunk_long_documents=args.chunk_long_documents,
+			embedding_server_url=args.embedding_server_url,
+		)
+		embedding_documents = embedding_modeller.run(documents=today_news_data["content"])
 
-	cluster_modeler = HierarchicalClusterModeler()
-	important_news_df = cluster_modeler.run(
-		today_news_embeddings=embedding_documents, documents=today_news_data
-	)
+		if args.clustering_backend == "two_stage":
+			cluster_modeler = TwoStageClusterModeler(max_block_size=args.max_block_size)
+		else:
+			cluster_modeler = HierarchicalClusterModeler()
+		story_tracker = None
+		if args.track_stories:
+			story_tracker = StoryTracker(
+				store_path=f"cache/stories_{environment}.npz",
+				date=datetime.now().strftime("%Y-%m-%d"),
+				assignment_threshold=args.story_assignment_threshold,
+			)
+			important_news_df = story_tracker.run(
+				today_news_embeddings=embedding_documents,
+				documents=today_news_data,
+				cluster_modeler=cluster_modeler,
+			)
+		else:
+			important_news_df = cluster_modeler.run(
+				today_news_embeddings=embedding_documents, documents=today_news_data
+			)
+		cluster_ranker = ClusterRanker.from_args(args)
+		important_news_df = cluster_ranker.run(important_news_df, embedding_documents)
+		if args.condense_token_budget:
+			condenser = ExtractiveCondenser(
+				embedding_modeller, token_budget=args.condense_token_budget
+			)
+			important_news_df = condenser.run(important_news_df, embedding_documents)
 
-	cloud_storage = BackBlazeCloudStorage(environment=environment)
-	file_name = cloud_storage.save_df_to_blackbaze_bucket(important_news_df, date=date)
-	logger.info(f"this is the filename {file_name}")
+		cloud_storage = BackBlazeCloudStorage(environment=environment)
+		if args.output_format == "npz":
+			embeddings = (
+				embedding_documents[important_news_df.index] if args.save_embeddings else None
+			)
+			file_name = cloud_storage.save_df_as_columns(
+				important_news_df, embeddings=embeddings, date=date
+			)
+		else:
+			# the generator streams the clusters of a file marked as ordered by label
+			file_name = cloud_storage.save_df_to_blackbaze_bucket(
+				important_news_df, date=date, sorted_by="labels"
+			)
+		logger.info(f"this is the filename {file_name}")
+		labels, centroids, sizes = HierarchicalClusterModeler.compute_centroids(
+			important_news_df["labels"].to_numpy(), embedding_documents[important_news_df.index]
+		)
+		cloud_storage.save_centroids(labels, centroids, sizes, date=date)
+		data_puller.save_watermark()
+		if story_tracker is not None:
+			story_tracker.save()
+	finally:
+		metrics_recorder.write("clustering")
@@ -0,0 +1,95 @@
+from math import ceil
+
+import numpy as np
+from scipy.cluster.hierarchy import fcluster
+from scipy.spatial.distance import squareform
+from sklearn.cluster import MiniBatchKMeans
+
+from src.shared.logger import setup_logger
+from src.shared.metrics import metrics_recorder
+from src.summarizer.cluster_modeler import HierarchicalClusterModeler
+
+logger = setup_logger("cluster_modeler")
+
+DEFAULT_DISTANCE_THRESHOLD = 0.2
+
+
+class TwoStageClusterModeler(HierarchicalClusterModeler):
+	"""
+	Cluster windows too large for a dense distance matrix, like a week or a month of news.
+
+	A coarse MiniBatchKMeans splits the normalized embeddings into blocks of at most max_block_size
+	documents, then every block is clustered with the complete linkage of HierarchicalClusterModeler.
+	The distance threshold is selected once, with the silhouette on a random sample of sample_size
+	documents, and used to cut all the blocks.
+	The memory is O(max_block_size^2) instead of O(n^2), the documents of a story end up in the same
+	block because the k-means groups the close embeddings.
+	"""
+
+	def __init__(self, max_block_size: int = 2000, sample_size: int = 2000, seed: int = 42) -> None:
+		super().__init__()
+		self.max_block_size = max_block_size
+		self.sample_size = sample_size
+		self.seed = seed
+
+	def select_threshold(self, embeddings: np.array) -> float:
+		"""select the distance threshold on a random sample of the documents"""
+		generator = np.random.default_rng(self.seed)
+		sample_size = min(embeddings.shape[0], self.sample_size)
+		sample = generator.choice(embeddings.shape[0], size=sample_size, replace=False)
+		_, best_k = super().compute_labels(embeddings[sample])
+		if best_k == 0:
+			logger.warning(
+				f"no threshold found on the sample, using the default {DEFAULT_DISTANCE_THRESHOLD}"
+			)
+			return DEFAULT_DISTANCE_THRESHOLD
+		return best_k
+
+	def split_block(self, embeddings: np.array, indices: np.array) -> list[np.array]:
+		"""split the documents with k-means until every block has at most max_block_size documents"""
+		if indices.shape[0] <= self.max_block_size:
+			return [indices]
+		# aim for half full blocks, the k-means clusters are not balanced
+		number_of_blocks = ceil(2 * indices.shape[0] / self.max_block_size)
+		kmeans = MiniBatchKMeans(
+			n_clusters=number_of_blocks, random_state=self.seed, batch_size=4096, n_init=3
+		)
+		block_labels = kmeans.fit_predict(embeddings[indices])
+		if np.unique(block_labels).shape[0] == 1:
+			# identical embeddings cannot be split by the k-means
+			return [
+				indices[start : start + self.max_block_size]
+				for start in range(0, indices.shape[0], self.max_block_size)
+			]
+		blocks = []
+		for block_label in np.unique(block_labels):
+			blocks.extend(self.split_block(embeddings, indices[block_labels == block_label]))
+		return blocks
+
+	def compute_labels(self, today_news_embeddings: np.array) -> tuple[np.array, float]:
+		"""cluster every coarse block with the same threshold, the labels are unique across blocks"""
+		number_of_documents = today_news_embeddings.shape[0]
+		if number_of_documents <= self.max_block_size:
+			return super().compute_labels(today_news_embeddings)
+		embeddings = np.asarray(today_news_embeddings, dtype=np.float32)
+		norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+		embeddings = embeddings / np.where(norms == 0, 1, norms)
+		threshold = self.select_threshold(embeddings)
+		with metrics_recorder.stage("cluster.coarse_partition", rows=number_of_documents):
+			blocks = self.split_block(embeddings, np.arange(number_of_documents))
+		logger.info(
+			f"split {number_of_documents} documents in {len(blocks)} blocks, the largest has {max(block.shape[0] for block in blocks)}"
+		)
+		labels = np.zeros(number_of_documents, dtype=np.int64)
+		next_label = 1
+		for block in blocks:
+			if block.shape[0] == 1:
+				labels[block] = next_label
+				next_label += 1
+				continue
+			distance_matrix = self.compute_distance_matrix(embeddings[block])
+			mergings = self.compute_linkage(squareform(distance_matrix, checks=False))
+			block_labels = fcluster(mergings, threshold, criterion="distance")
+			labels[block] = block_labels + next_label - 1
+			next_label += block_labels.max()
+		return labels, threshold
@@ -0,0 +1,221 @@
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from src.shared.columnar import ColumnarFile, write_columns
+from src.shared.logger import setup_logger
+from src.shared.metrics import metrics_recorder
+from src.summarizer.cluster_modeler import HierarchicalClusterModeler
+
+logger = setup_logger("story_tracker")
+
+STORY_COLUMNS = ["story_id", "centroid", "size", "first_seen", "last_seen"]
+# the database ids of the articles already in the centroids and the day they were added
+FOLDED_COLUMNS = ["folded_article_id", "folded_on"]
+
+
+class StoryTracker:
+	"""
+	Keep the stories between the runs so an ongoing story keeps its label.
+
+	A story is the normalized centroid of the embeddings of its articles and a stable story id.
+	The new articles closer than assignment_threshold (cosine distance) to the centroid of a story get
+	its id, only the other ones are clustered, and their clusters become new stories. The stories
+	without a new article for max_idle_days are forgotten, their ids are never given again: the next
+	story id is kept in the store, the centroids and summaries saved with an id stay with its story.
+	The windows of the runs overlap, an article already added to a centroid (by its database_id) is
+	labeled again but not added twice; its id is kept max_idle_days.
+	"""
+
+	def __init__(
+		self,
+		store_path: str | Path,
+		date: str,
+		assignment_threshold: float = 0.2,
+		max_idle_days: int = 7,
+	) -> None:
+		self.store_path = Path(store_path)
+		self.date = np.datetime64(date, "D")
+		self.assignment_threshold = assignment_threshold
+		self.max_idle_days = max_idle_days
+		self.stories, self.next_story_id, self.folded = self.load()
+
+	def load(self) -> tuple[dict, int, dict]:
+		"""Load the saved stories, the next story id and the folded articles, empty if there is no store"""
+		folded = {
+			"folded_article_id": np.zeros(0, dtype=np.int64),
+			"folded_on": np.zeros(0, dtype="datetime64[D]"),
+		}
+		if not self.store_path.exists():
+			logger.info(f"no stories in {self.store_path}, starting from scratch")
+			return (
+				{
+					"story_id": np.zeros(0, dtype=np.int64),
+					"centroid": None,
+					"size": np.zeros(0, dtype=np.int64),
+					"first_seen": np.zeros(0, dtype="datetime64[D]"),
+					"last_seen": np.zeros(0, dtype="datetime64[D]"),
+				},
+				1,
+				folded,
+			)
+		columnar_file = ColumnarFile(self.store_path)
+		try:
+			stories = columnar_file.read(STORY_COLUMNS)
+			if "next_story_id" in columnar_file.columns:
+				next_story_id = int(columnar_file.read_column("next_story_id"))
+			else:
+				# a store saved before the next id was kept, the ids of its forgotten stories are unknown
+				next_story_id = int(stories["story_id"].max(initial=0)) + 1
+			if "folded_article_id" in columnar_file.columns:
+				folded = columnar_file.read(FOLDED_COLUMNS)
+		finally:
+			columnar_file.close()
+		logger.info(
+			f"loaded {stories['story_id'].shape[0]} stories from {self.store_path}, "
+			f"the next story id is {next_story_id}"
+		)
+		return stories, next_story_id, folded
+
+	def save(self) -> None:
+		"""Persist the stories, call it once the clusters are uploaded"""
+		self.store_path.parent.mkdir(parents=True, exist_ok=True)
+		temporary_path = self.store_path.with_suffix(f".{os.getpid()}.tmp")
+		with open(temporary_path, "wb") as store_file:
+			write_columns(
+				store_file,
+				{
+					**self.stories,
+					**self.folded,
+					"next_story_id": np.array(self.next_story_id),
+				},
+			)
+		os.replace(temporary_path, self.store_path)
+		logger.info(f"saved {self.stories['story_id'].shape[0]} stories to {self.store_path}")
+
+	@staticmethod
+	def normalize(embeddings: np.array) -> np.array:
+		embeddings = np.asarray(embeddings, dtype=np.float32)
+		norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+		return embeddings / np.where(norms == 0, 1, norms)
+
+	def assign(self, embeddings: np.array) -> np.array:
+		"""Return the id of the nearest story of every embedding, 0 when no story is close enough"""
+		story_ids = np.zeros(embeddings.shape[0], dtype=np.int64)
+		if self.stories["centroid"] is None or self.stories["story_id"].shape[0] == 0:
+			return story_ids
+		similarities = embeddings @ self.stories["centroid"].T
+		nearest = similarities.argmax(axis=1)
+		distances = 1 - similarities[np.arange(embeddings.shape[0]), nearest]
+		is_assigned = distances <= self.assignment_threshold
+		story_ids[is_assigned] = self.stories["story_id"][nearest[is_assigned]]
+		return story_ids
+
+	def update(self, embeddings: np.array, story_ids: np.array) -> None:
+		"""Move the centroids of the stories with new articles, add the new stories, forget the idle ones"""
+		known_ids = self.stories["story_id"]
+		centroids = self.stories["centroid"]
+		if centroids is None:
+			centroids = np.zeros((0, embeddings.shape[1]), dtype=np.float32)
+		sizes = self.stories["size"].copy()
+		first_seen = self.stories["first_seen"]
+		last_seen = self.stories["last_seen"].copy()
+		positions = {story_id: position for position, story_id in enumerate(known_ids.tolist())}
+		new_ids, new_centroids, new_sizes = [], [], []
+		for story_id in np.unique(story_ids):
+			story_embeddings = embeddings[story_ids == story_id]
+			if story_id in positions:
+				position = positions[story_id]
+				centroid = centroids[position] * sizes[position] + story_embeddings.sum(axis=0)
+				centroids[position] = self.normalize(centroid[None, :])[0]
+				sizes[position] += story_embeddings.shape[0]
+				last_seen[position] = self.date
+			else:
+				new_ids.append(story_id)
+				new_centroids.append(
+					self.normalize(story_embeddings.mean(axis=0, keepdims=True))[0]
+				)
+				new_sizes.append(story_embeddings.shape[0])
+		number_of_new_stories = len(new_ids)
+		stories = {
+			"story_id": np.concatenate([known_ids, np.array(new_ids, dtype=np.int64)]),
+			"centroid": np.concatenate(
+				[
+					centroids,
+					np.array(new_centroids, dtype=np.float32).reshape(-1, embeddings.shape[1]),
+				]
+			),
+			"size": np.concatenate([sizes, np.array(new_sizes, dtype=np.int64)]),
+			"first_seen": np.concatenate(
+				[first_seen, np.full(number_of_new_stories, self.date, dtype="datetime64[D]")]
+			),
+			"last_seen": np.concatenate(
+				[last_seen, np.full(number_of_new_stories, self.date, dtype="datetime64[D]")]
+			),
+		}
+		is_active = (self.date - stories["last_seen"]).astype(int) <= self.max_idle_days
+		self.stories = {name: values[is_active] for name, values in stories.items()}
+		logger.info(
+			f"{number_of_new_stories} new stories, {int((~is_active).sum())} idle stories forgotten, "
+			f"{self.stories['story_id'].shape[0]} stories tracked"
+		)
+
+	def fold(self, database_ids: np.array) -> np.array:
+		"""
+		Whether every article is new to the centroids, remember the new ones and forget the old ones.
+		"""
+		database_ids = np.asarray(database_ids, dtype=np.int64)
+		is_new = ~np.isin(database_ids, self.folded["folded_article_id"])
+		# a window can hold an article twice before the deduplication of the content
+		new_ids = np.unique(database_ids[is_new])
+		folded_ids = np.concatenate([self.folded["folded_article_id"], new_ids])
+		folded_on = np.concatenate(
+			[self.folded["folded_on"], np.full(new_ids.shape[0], self.date, dtype="datetime64[D]")]
+		)
+		is_recent = (self.date - folded_on).astype(int) <= self.max_idle_days
+		self.folded = {
+			"folded_article_id": folded_ids[is_recent],
+			"folded_on": folded_on[is_recent],
+		}
+		return is_new
+
+	def run(
+		self,
+		today_news_embeddings: np.array,
+		documents: pd.DataFrame,
+		cluster_modeler: HierarchicalClusterModeler,
+	) -> pd.DataFrame:
+		"""Label the documents with their story id and return the clusters like cluster_modeler.run"""
+		embeddings = self.normalize(today_news_embeddings)
+		with metrics_recorder.stage("cluster.assign_stories", rows=embeddings.shape[0]) as stage:
+			story_ids = self.assign(embeddings)
+			unassigned = np.flatnonzero(story_ids == 0)
+			stage.add(assigned_rows=embeddings.shape[0] - unassigned.shape[0])
+		logger.info(
+			f"assigned {embeddings.shape[0] - unassigned.shape[0]} of {embeddings.shape[0]} articles to known stories, "
+			f"clustering the {unassigned.shape[0]} others"
+		)
+		next_story_id = self.next_story_id
+		if unassigned.shape[0] > 1:
+			labels, best_k = cluster_modeler.compute_labels(embeddings[unassigned])
+			logger.info(f"clustered the unassigned articles with best_k = {best_k:3f}")
+			if np.unique(labels).shape[0] == 1 and labels[0] == 0:
+				# no threshold gave a valid partition, every article starts its own story
+				labels = np.arange(1, unassigned.shape[0] + 1)
+			story_ids[unassigned] = labels.astype(np.int64) + next_story_id - 1
+		elif unassigned.shape[0] == 1:
+			story_ids[unassigned] = next_story_id
+		self.next_story_id = max(next_story_id, int(story_ids.max(initial=0)) + 1)
+		if "database_id" in documents.columns:
+			is_new = self.fold(documents["database_id"].to_numpy())
+			logger.info(f"{int((~is_new).sum())} articles were already in the stories")
+			self.update(embeddings[is_new], story_ids[is_new])
+		else:
+			self.update(embeddings, story_ids)
+		documents["labels"] = story_ids
+		important_news_df = cluster_modeler.select_top_clusters(documents)
+		logger.info(f"the important news data is of shape: {important_news_df.shape[0]}")
+		logger.info(f"the number of stories are {np.unique(important_news_df.labels).shape[0]}")
+		return important_news_df
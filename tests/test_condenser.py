@@ -0,0 +1,29 @@
+import numpy as np
+import pandas as pd
+
+from src.summarizer.condenser import ExtractiveCondenser
+
+
+class FakeEmbeddingsComputer:
+	"""The sentences mentioning the topic point to the centroid, the others are orthogonal"""
+
+	def run(self, documents) -> np.array:
+		return np.array([[1.0, 0.0] if "barrage" in text else [0.0, 1.0] for text in documents])
+
+
+def test_only_the_clusters_over_the_budget_are_condensed():
+	sentence = "Le barrage de Inga alimente toute la ville de Kinshasa en electricite. "
+	other = "Une coupure generale est annoncee pour la semaine prochaine dans la capitale. "
+	news_df = pd.DataFrame(
+		{
+			"labels": [0, 0, 1],
+			"content": [sentence * 4 + other * 4, sentence + other, "Un court article."],
+		}
+	)
+	condenser = ExtractiveCondenser(FakeEmbeddingsComputer(), token_budget=60)
+	condensed_df = condenser.run(news_df, np.array([[1.0, 0.0]] * 3))
+
+	assert condensed_df.loc[2, "condensed_content"] == ""
+	condensed = condensed_df.loc[[0, 1], "condensed_content"].str.cat(sep=" ")
+	assert "barrage" in condensed
+	assert len(condensed) < news_df.loc[[0, 1], "content"].str.len().sum()
@@ -0,0 +1,41 @@
+import pandas as pd
+
+from src.shared.database import copy_query_to_dataframe
+from src.summarizer.data_puller import ARTICLE_CSV_OPTIONS
+from src.summarizer.deduplicator import NearDuplicateRemover
+
+# what COPY ... TO STDOUT WITH (FORMAT csv, HEADER true) sends, "" is an empty string
+ARTICLE_CSV = (
+	"database_id,content,title,posted_at,url,website_origin\n"
+	'1,La RDC et la Zambie signent un accord minier a Lubumbashi,"",2024-05-02 08:00:00,https://a.cd/1,NA\n'
+	"2,La RDC et la Zambie signent un accord minier a Lubumbashi,null,2024-05-02 09:00:00,https://b.cd/2,None\n"
+)
+
+
+class FakeCursor:
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args) -> None:
+		pass
+
+	def mogrify(self, query: str, params) -> bytes:
+		return query.encode("utf-8")
+
+	def copy_expert(self, statement: str, writer) -> None:
+		writer.write(ARTICLE_CSV.encode("utf-8"))
+
+
+class FakeConnection:
+	def cursor(self) -> FakeCursor:
+		return FakeCursor()
+
+
+def test_copied_text_columns_stay_strings():
+	news_df = copy_query_to_dataframe(FakeConnection(), "SELECT", None, **ARTICLE_CSV_OPTIONS)
+	assert news_df["title"].tolist() == ["", "null"]
+	assert news_df["website_origin"].tolist() == ["NA", "None"]
+	assert news_df["database_id"].tolist() == [1, 2]
+	assert pd.api.types.is_datetime64_any_dtype(news_df["posted_at"])
+	representatives = NearDuplicateRemover(threshold=0.8).remove_duplicates(news_df)
+	assert representatives["duplicate_titles"].tolist() == ["\nnull"]
@@ -0,0 +1,93 @@
+import json
+import random
+import re
+
+import pytest
+
+from src.llm.grammar import compile_grammar, json_schema_to_gbnf
+from src.schemas import SummarySchemas
+
+GBNF_TOKEN = re.compile(
+	r'\s*("(?:[^"\\]|\\.)*"|\[(?:[^\]\\]|\\.)*\]|\{\d+(?:,\d+)?\}|[\w-]+|[|()*+?])'
+)
+
+
+def gbnf_to_regex(grammar: str) -> re.Pattern:
+	"""
+	Translate the grammar to a python regex, to check texts against it without llama.cpp.
+
+	It covers what json_schema_to_gbnf writes: rules without recursion, literals, character classes,
+	groups, alternatives and quantifiers. The character classes have the same syntax in both.
+	"""
+	rules = dict(line.split(" ::= ", 1) for line in grammar.strip().splitlines())
+	translated = {}
+
+	def translate(name: str) -> str:
+		if name not in translated:
+			pattern = []
+			for token in GBNF_TOKEN.findall(rules[name]):
+				if token.startswith('"'):
+					pattern.append(re.escape(json.loads(token)))
+				elif token[0].isalpha() or token[0] == "_":
+					pattern.append(f"(?:{translate(token)})")
+				elif token in "()":
+					pattern.append("(?:" if token == "(" else ")")
+				else:
+					pattern.append(token)
+			translated[name] = "".join(pattern)
+		return translated[name]
+
+	return re.compile(translate("root"), re.DOTALL)
+
+
+def test_summary_grammar_rules():
+	rules = compile_grammar(SummarySchemas).strip().splitlines()
+	assert rules == [
+		'root ::= "{" space "\\"title\\"" space ":" space string "," space '
+		'"\\"summary\\"" space ":" space string "}" space',
+		'space ::= | " " | "\\n" [ \\t]{0,20}',
+		'string ::= "\\"" char* "\\"" space',
+		'char ::= [^"\\\\\\x7F\\x00-\\x1F] | [\\\\] (["\\\\bfnrt] | "u" [0-9a-fA-F]{4})',
+	]
+
+
+def random_text(generator: random.Random) -> str:
+	alphabet = "abcdeéèàçôû KINSHASA-Goma,.;:'\"\\/\n\t«»€0123456789"
+	return "".join(generator.choice(alphabet) for _ in range(generator.randint(0, 80)))
+
+
+def test_outputs_of_the_grammar_are_valid_summaries():
+	grammar = gbnf_to_regex(compile_grammar(SummarySchemas))
+	generator = random.Random(42)
+	for _ in range(200):
+		title, summary = random_text(generator), random_text(generator)
+		separator = generator.choice(["", " ", "\n  "])
+		output = (
+			f"{{{separator}{json.dumps('title')}:{separator}{json.dumps(title, ensure_ascii=False)},"
+			f"{separator}{json.dumps('summary')}: {json.dumps(summary, ensure_ascii=generator.random() < 0.5)}}}"
+		)
+		assert grammar.fullmatch(output), output
+		parsed = SummarySchemas.model_validate_json(output)
+		assert (parsed.title, parsed.summary) == (title, summary)
+
+
+@pytest.mark.parametrize(
+	"output",
+	[
+		'{"summary": "b", "title": "a"}',
+		'{"title": "a"}',
+		'{"title": "a\nb", "summary": "c"}',
+		'{"title": 1, "summary": "c"}',
+	],
+)
+def test_grammar_rejects_other_outputs(output):
+	assert gbnf_to_regex(compile_grammar(SummarySchemas)).fullmatch(output) is None
+
+
+def test_unsupported_schemas_are_rejected():
+	with pytest.raises(ValueError):
+		json_schema_to_gbnf({"type": "object", "properties": {"tags": {"type": "array"}}})
+	with pytest.raises(ValueError):
+		json_schema_to_gbnf(
+			{"type": "object", "properties": {"title": {"type": "string"}}, "required": []}
+		)
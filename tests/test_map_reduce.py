@@ -0,0 +1,59 @@
+import threading
+import time
+
+from src.llm.main import summarize_groups
+from src.schemas import SummarySchemas
+
+
+class FakeGenerator:
+	"""Counts one token per word and keeps the highest number of requests in flight"""
+
+	def __init__(self, parallel_slots: int, max_tokens_per_prompt: int) -> None:
+		self.parallel_slots = parallel_slots
+		self.max_tokens_per_prompt = max_tokens_per_prompt
+		self.generation_parameters = {}
+		self.system_prompt = ""
+		self.in_flight = 0
+		self.max_in_flight = 0
+		self.requests = 0
+		self.lock = threading.Lock()
+
+	def count_tokens(self, text: str) -> int:
+		return len(text.split())
+
+	estimate_tokens = count_tokens
+
+	def count_prompt_overhead_tokens(self, prompt_template: str) -> int:
+		return 0
+
+	def run(
+		self, prompt_data: dict, id_slot: int | None = None, prompt_template: str = ""
+	) -> SummarySchemas:
+		with self.lock:
+			self.in_flight += 1
+			self.requests += 1
+			self.max_in_flight = max(self.max_in_flight, self.in_flight)
+		time.sleep(0.02)
+		with self.lock:
+			self.in_flight -= 1
+		return SummarySchemas(title="titre", summary="un resume")
+
+
+ARTICLE = {"title": "a", "url": "https://a.cd", "content": " ".join(["mot"] * 15)}
+
+
+def test_parts_of_one_cluster_use_several_slots():
+	generator = FakeGenerator(parallel_slots=4, max_tokens_per_prompt=20)
+	summaries, failures = summarize_groups([("0", [ARTICLE] * 6)], generator, max_concurrency=3)
+	assert len(summaries) == 1 and not failures
+	assert generator.max_in_flight == 3
+
+
+def test_map_requests_share_the_slots_of_the_clusters():
+	generator = FakeGenerator(parallel_slots=4, max_tokens_per_prompt=20)
+	groups = [(str(label), [ARTICLE] * 6) for label in range(3)]
+	summaries, failures = summarize_groups(groups, generator, max_concurrency=2)
+	assert len(summaries) == 3 and not failures
+	# six parts and at least one reduce per cluster
+	assert generator.requests >= 3 * 7
+	assert generator.max_in_flight <= 2
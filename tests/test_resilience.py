@@ -0,0 +1,95 @@
+import pytest
+import requests
+
+from src.llm.generator import LLamaCppGeneratorComponent
+from src.llm.resilience import CircuitBreaker, CircuitOpenError
+from src.shared.metrics import metrics_recorder
+
+
+class FakeResponse:
+	def __init__(self, status_code: int = 200, body: dict | None = None) -> None:
+		self.status_code = status_code
+		self.body = body if body is not None else {}
+		self.headers = {}
+
+	def raise_for_status(self) -> None:
+		if self.status_code >= 400:
+			raise requests.HTTPError(f"{self.status_code}", response=self)
+
+	def json(self) -> dict:
+		return self.body
+
+
+def make_generator(circuit_breaker: CircuitBreaker) -> LLamaCppGeneratorComponent:
+	return LLamaCppGeneratorComponent(
+		api_url="http://llama.test",
+		circuit_breaker=circuit_breaker,
+		backoff_seconds=0,
+		warm_up_seconds=30,
+	)
+
+
+def open_circuit(circuit_breaker: CircuitBreaker) -> None:
+	for _ in range(circuit_breaker.failure_threshold):
+		circuit_breaker.before_call()
+		circuit_breaker.record_failure()
+
+
+def test_failed_probe_opens_the_circuit_again():
+	circuit_breaker = CircuitBreaker(failure_threshold=2, reset_seconds=0)
+	open_circuit(circuit_breaker)
+	circuit_breaker.before_call()
+	with pytest.raises(CircuitOpenError):
+		circuit_breaker.before_call()
+	circuit_breaker.record_failure()
+	circuit_breaker.before_call()
+	circuit_breaker.record_success()
+	assert circuit_breaker.opened_at is None
+
+
+def test_probe_failing_with_an_unreadable_answer_is_released():
+	circuit_breaker = CircuitBreaker(failure_threshold=2, reset_seconds=0)
+	open_circuit(circuit_breaker)
+	generator = make_generator(circuit_breaker)
+	# an answer without content raises a KeyError, not a RequestException
+	generator.session.post = lambda *args, **kwargs: FakeResponse(body={})
+	stage = metrics_recorder.get_stage("test.completion")
+	with pytest.raises(KeyError):
+		generator._complete_once("{}", lambda: 10, stage)
+	assert not circuit_breaker.is_probing
+
+	generator.session.post = lambda *args, **kwargs: FakeResponse(body={"content": "{}"})
+	assert generator._complete_once("{}", lambda: 10, stage) == "{}"
+	assert circuit_breaker.opened_at is None
+
+
+def test_ping_does_not_retry_a_client_error():
+	generator = make_generator(CircuitBreaker())
+	calls = []
+
+	def get(*args, **kwargs):
+		calls.append(args)
+		return FakeResponse(status_code=401)
+
+	generator.session.get = get
+	with pytest.raises(requests.HTTPError):
+		generator._ping_api()
+	assert len(calls) == 1
+
+
+def test_ping_retries_an_unavailable_server():
+	generator = make_generator(CircuitBreaker())
+	responses = [FakeResponse(status_code=503), FakeResponse(body={"status": "ok"})]
+	generator.session.get = lambda *args, **kwargs: responses.pop(0)
+	assert generator._ping_api()
+	assert not responses
+
+
+def test_tokenize_is_not_sent_while_the_circuit_is_open():
+	circuit_breaker = CircuitBreaker(failure_threshold=2, reset_seconds=60)
+	open_circuit(circuit_breaker)
+	generator = make_generator(circuit_breaker)
+	calls = []
+	generator.session.post = lambda *args, **kwargs: calls.append(args)
+	assert generator.count_tokens("a" * 40) == generator.estimate_tokens("a" * 40)
+	assert not calls
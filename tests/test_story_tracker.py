@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+
+from src.summarizer.story_tracker import StoryTracker
+
+
+class FakeClusterModeler:
+	"""Puts all the unassigned articles in one cluster and keeps every cluster"""
+
+	def compute_labels(self, embeddings: np.array) -> tuple[np.array, float]:
+		return np.ones(embeddings.shape[0], dtype=np.int64), 0.5
+
+	def select_top_clusters(self, documents: pd.DataFrame) -> pd.DataFrame:
+		return documents
+
+
+def run_tracker(store_path, date: str, database_ids: list, embeddings: np.array) -> StoryTracker:
+	story_tracker = StoryTracker(store_path=store_path, date=date)
+	documents = pd.DataFrame({"database_id": database_ids})
+	story_tracker.run(embeddings, documents, FakeClusterModeler())
+	story_tracker.save()
+	return story_tracker
+
+
+def test_articles_of_an_overlapping_window_are_added_once(tmp_path):
+	store_path = tmp_path / "stories.npz"
+	embeddings = np.array([[1.0, 0.0], [0.99, 0.1], [0.98, 0.15]])
+	first = run_tracker(store_path, "2024-05-01", [1, 2], embeddings[:2])
+	assert first.stories["size"].tolist() == [2]
+
+	rerun = run_tracker(store_path, "2024-05-01", [1, 2], embeddings[:2])
+	assert rerun.stories["size"].tolist() == [2]
+	np.testing.assert_allclose(rerun.stories["centroid"], first.stories["centroid"])
+
+	next_day = run_tracker(store_path, "2024-05-02", [1, 2, 3], embeddings)
+	assert next_day.stories["story_id"].tolist() == [1]
+	assert next_day.stories["size"].tolist() == [3]
+
+
+def test_folded_articles_are_forgotten_after_max_idle_days(tmp_path):
+	story_tracker = StoryTracker(store_path=tmp_path / "stories.npz", date="2024-05-10")
+	story_tracker.folded = {
+		"folded_article_id": np.array([1, 2], dtype=np.int64),
+		"folded_on": np.array(["2024-05-01", "2024-05-09"], dtype="datetime64[D]"),
+	}
+	assert story_tracker.fold(np.array([2, 3])).tolist() == [False, True]
+	assert story_tracker.folded["folded_article_id"].tolist() == [2, 3]
@@ -0,0 +1,101 @@
+import io
+import json
+import threading
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import pytest
+import requests
+from requests.utils import get_encoding_from_headers
+
+from scripts.fake_llama_server import FAKE_SUMMARY, make_server
+from src.llm.generator import LLamaCppGeneratorComponent
+from src.llm.streaming import JsonObjectScanner, iter_server_sent_events
+from src.shared.metrics import metrics_recorder
+
+
+def make_event_stream_response(events: list) -> requests.Response:
+	"""A response like the llama.cpp stream, text/event-stream without a charset"""
+	body = "".join(f"data: {json.dumps(event, ensure_ascii=False)}\n\n" for event in events)
+	response = requests.Response()
+	response.status_code = 200
+	response.headers["Content-Type"] = "text/event-stream"
+	response.encoding = get_encoding_from_headers(response.headers)
+	response.raw = io.BytesIO(body.encode("utf-8"))
+	return response
+
+
+def test_accented_tokens_are_decoded_as_utf8():
+	events = [{"content": "Kinshasa : l'opposition dénonce", "stop": False}, {"stop": True}]
+	received = list(iter_server_sent_events(make_event_stream_response(events)))
+	assert received[0]["content"] == "Kinshasa : l'opposition dénonce"
+
+
+def test_scanner_stops_at_the_end_of_the_object():
+	scanner = JsonObjectScanner()
+	assert scanner.feed('{"title": "a}') is None
+	assert scanner.feed('", "summary": "é"}  ') == '{"title": "a}", "summary": "é"}'
+
+
+@contextmanager
+def running_fake_server(**overrides):
+	server_args = {
+		"slots": 1,
+		"latency_distribution": "constant",
+		"prompt_seconds": 0,
+		"tokens_per_second": 200,
+		"output_tokens": 40,
+		"error_rate_429": 0,
+		"error_rate_503": 0,
+		"reject_when_busy": False,
+		"cold_start_seconds": 0,
+		"trailing_tokens": 5,
+		"stall_rate": 0,
+		"stall_seconds": 0,
+		"prefill_tokens_per_second": 0,
+		**overrides,
+	}
+	server = make_server(SimpleNamespace(**server_args))
+	thread = threading.Thread(target=server.serve_forever, daemon=True)
+	thread.start()
+	try:
+		yield f"http://127.0.0.1:{server.server_address[1]}"
+	finally:
+		server.shutdown()
+		server.server_close()
+
+
+def test_prefill_longer_than_the_stall_timeout_is_not_retried():
+	with running_fake_server(prompt_seconds=1.5) as api_url:
+		generator = LLamaCppGeneratorComponent(
+			api_url=api_url, stream=True, stall_seconds=1, max_attempts=1
+		)
+		summary = generator.generate_response("une invite")
+		generator.close()
+	assert summary.summary == FAKE_SUMMARY["summary"]
+
+
+def test_stall_after_the_first_token_fails_the_attempt():
+	with running_fake_server(stall_rate=1, stall_seconds=3) as api_url:
+		generator = LLamaCppGeneratorComponent(
+			api_url=api_url, stream=True, stall_seconds=1, max_attempts=1
+		)
+		with pytest.raises(requests.ConnectionError):
+			generator.generate_response("une invite")
+		generator.close()
+
+
+def test_stream_records_the_prompt_tokens_and_the_prefill_time():
+	stage = metrics_recorder.get_stage("llm.completion")
+	before = dict(stage.counters)
+	with running_fake_server(prompt_seconds=0.2) as api_url:
+		generator = LLamaCppGeneratorComponent(api_url=api_url, stream=True, max_attempts=1)
+		generator.generate_response("une invite de cinq mots")
+		generator.close()
+
+	def added(name: str) -> float:
+		return stage.counters.get(name, 0) - before.get(name, 0)
+
+	assert added("prompt_tokens") == 5
+	assert added("prompt_seconds") == pytest.approx(0.2)
+	assert added("prompt_characters") == len("une invite de cinq mots")